@@ -1,21 +1,48 @@
-from openai import OpenAI
-import logging
+from openai import OpenAI, AsyncOpenAI
+import asyncio
+import weakref
 from datetime import datetime
 from functools import wraps
 from dotenv import load_dotenv
 import os
+from response_cache import ResponseCache
+from metrics import METRICS, get_batched_logger
 
 load_dotenv()
 
-# Instantiate the OpenAI client
-client = OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
+# The OpenAI clients are instantiated on first use, so that importing this module does not need an API key.
+# Assign `client` / `async_client` to replace them (e.g. with the fake chat model of the benchmarks).
+client = None
+async_client = None
 
-# Set up logging
-logging.basicConfig(filename='llm_interactions.log', level=logging.INFO,
-                    format='%(asctime)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+def get_client():
+    global client
+    if client is None:
+        client = OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
+    return client
 
-# Global variable to keep track of total price
-total_price = 0
+# The async client's connection pool is bound to the event loop it was first used in,
+# so we keep one client per event loop (e.g. Flask runs every async view in its own loop)
+_async_clients = weakref.WeakKeyDictionary()
+
+def get_async_client():
+    if async_client is not None:
+        return async_client
+    loop = asyncio.get_running_loop()
+    if loop not in _async_clients:
+        _async_clients[loop] = AsyncOpenAI(api_key=os.getenv('OPENAI_API_KEY'))
+    return _async_clients[loop]
+
+# Set up logging: the records are written to the file in batches by a background thread, not on the request thread
+# LLM_LOG_PATH: the log file of the interactions (default: llm_interactions.log)
+logger = get_batched_logger('llm_interactions', os.getenv('LLM_LOG_PATH', 'llm_interactions.log'))
+
+# The tokens, costs and cache savings are tracked by model and dataflow in metrics.METRICS
+
+# Exact-match cache of the responses (all calls are made with temperature=0), optionally persisted to disk
+response_cache = ResponseCache(  max_entries=int(os.getenv('LLM_CACHE_MAX_ENTRIES', 1024))
+                               , ttl=int(os.getenv('LLM_CACHE_TTL', 24 * 3600))
+                               , path=os.getenv('LLM_CACHE_PATH'))
 
 # TODO: not all model names are working...
 MODEL_PRICING_PER_M_TOKENS = {
@@ -26,31 +53,113 @@ MODEL_PRICING_PER_M_TOKENS = {
     'o1-preview': {'prompt_tokens': 15.00, 'completion_tokens': 60.00}
 }
 
+def record_cache_hit(message, saved, tier='exact', model="gpt-4o-mini"):
+    """Log an answer that was served from a cache and add the cost of the original call to the savings."""
+    METRICS.record_cache_hit(model, saved, tier=tier)
+    logger.info(f"LLM ({tier} cache hit): {message}")
+    logger.info(f"Saved by the cache: ${saved:.6f}, total saved so far: ${METRICS.total_saved():.6f}")
+
 def log_interaction(func):
+    """
+    Log the interaction, answering it from the exact-match cache if this very prompt was answered before. With
+    `cache=False` the response is not stored (e.g. when the prompt was grounded on an index still being built).
+    """
     @wraps(func)
-    def wrapper(persona, prompt, model="gpt-4o-mini"):
-        global total_price
-        
+    def wrapper(persona, prompt, model="gpt-4o-mini", cache=True):
         # Log user message
-        logging.info(f"User: {prompt}")
+        logger.info(f"User: {prompt}")
+
+        # Answer from the cache, if we have seen this very prompt before
+        cached = response_cache.get(model, persona, prompt)
+        if cached is not None:
+            message, saved = cached
+            record_cache_hit(message, saved, model=model)
+            return message, 0.0
         
         # Call the original function
         message, cost = func(persona, prompt, model)
+        if cache:
+            response_cache.put(model, persona, prompt, message, cost)
         
-        # Log LLM response and cost
-        logging.info(f"LLM: {message}")
-        logging.info(f"Cost of this interaction: ${cost:.6f}")
-        
-        # Update total price
-        total_price += cost
-        logging.info(f"Total price so far: ${total_price:.6f}")
+        # Log LLM response and cost (the cost itself is booked by `_record_usage`)
+        logger.info(f"LLM: {message}")
+        logger.info(f"Cost of this interaction: ${cost:.6f}")
+        logger.info(f"Total price so far: ${METRICS.total_cost():.6f}")
         
         return message, cost
     return wrapper
 
+def alog_interaction(func):
+    """The same as `log_interaction`, for coroutine functions."""
+    @wraps(func)
+    async def wrapper(persona, prompt, model="gpt-4o-mini", cache=True):
+        logger.info(f"User: {prompt}")
+
+        cached = response_cache.get(model, persona, prompt)
+        if cached is not None:
+            message, saved = cached
+            record_cache_hit(message, saved, model=model)
+            return message, 0.0
+
+        message, cost = await func(persona, prompt, model)
+        if cache:
+            response_cache.put(model, persona, prompt, message, cost)
+
+        logger.info(f"LLM: {message}")
+        logger.info(f"Cost of this interaction: ${cost:.6f}")
+        logger.info(f"Total price so far: ${METRICS.total_cost():.6f}")
+
+        return message, cost
+    return wrapper
+
+def stream_log_interaction(func):
+    """
+    The same as `log_interaction`, for generator functions that yield the message in pieces and return
+    (message, cost) when the stream is finished: the response is cached, logged and booked only then.
+    """
+    @wraps(func)
+    def wrapper(persona, prompt, model="gpt-4o-mini", cache=True):
+        logger.info(f"User: {prompt}")
+
+        cached = response_cache.get(model, persona, prompt)
+        if cached is not None:
+            message, saved = cached
+            record_cache_hit(message, saved, model=model)
+            yield message
+            return message, 0.0
+
+        message, cost = yield from func(persona, prompt, model)
+        if cache:
+            response_cache.put(model, persona, prompt, message, cost)
+
+        logger.info(f"LLM: {message}")
+        logger.info(f"Cost of this interaction: ${cost:.6f}")
+        logger.info(f"Total price so far: ${METRICS.total_cost():.6f}")
+
+        return message, cost
+    return wrapper
+
+def _completion_cost(completion):
+    # Get the pricing for the model used in the completion
+    pricing = MODEL_PRICING_PER_M_TOKENS[completion.model]
+
+    # Calculate the cost of the completion
+    prompt_cost = completion.usage.prompt_tokens * pricing['prompt_tokens']
+    generation_cost = completion.usage.completion_tokens * pricing['completion_tokens']
+    return (prompt_cost + generation_cost) / 10**6
+
+def _record_usage(completion):
+    """Book the tokens and the cost of the completion on its model and on the current dataflow, return the cost."""
+    cost = _completion_cost(completion)
+    METRICS.record_llm_usage(  completion.model
+                             , prompt_tokens=completion.usage.prompt_tokens
+                             , completion_tokens=completion.usage.completion_tokens
+                             , cost=cost)
+    return cost
+
 @log_interaction
 def model(persona, prompt, model="gpt-4o-mini"):
-    completion = client.chat.completions.create(
+    completion = get_client().chat.completions.create(
           model=model
         , messages=[
             { "role": "system", "content": persona},
@@ -58,19 +167,67 @@ def model(persona, prompt, model="gpt-4o-mini"):
     ]
         , temperature=0
     )
-    # Get the pricing for the model used in the completion
-    pricing = MODEL_PRICING_PER_M_TOKENS[completion.model]
-
-    # Calculate the cost of the completion
-    prompt_cost = completion.usage.prompt_tokens * pricing['prompt_tokens']
-    generation_cost = completion.usage.completion_tokens * pricing['completion_tokens']
-    total_cost = (prompt_cost + generation_cost) / 10**6
+    total_cost = _record_usage(completion)
 
     # Extract the message from the completion
     message = completion.choices[0].message.content
 
     return message, total_cost
 
+@alog_interaction
+async def amodel(persona, prompt, model="gpt-4o-mini"):
+    """Async variant of `model`: the event loop can run other requests while waiting for the completion."""
+    completion = await get_async_client().chat.completions.create(
+          model=model
+        , messages=[
+            { "role": "system", "content": persona},
+            { "role": "user", "content": prompt}
+    ]
+        , temperature=0
+    )
+    total_cost = _record_usage(completion)
+    message = completion.choices[0].message.content
+
+    return message, total_cost
+
+@stream_log_interaction
+def model_stream(persona, prompt, model="gpt-4o-mini"):
+    """
+    Streaming variant of `model`: yields the message piece by piece as it is generated and returns
+    (message, cost) at the end (use `yield from`, or read the StopIteration value).
+    The usage is sent in the last chunk of the stream, so the cost is known once the stream is finished.
+    """
+    stream = get_client().chat.completions.create(
+          model=model
+        , messages=[
+            { "role": "system", "content": persona},
+            { "role": "user", "content": prompt}
+    ]
+        , temperature=0
+        , stream=True
+        , stream_options={"include_usage": True}
+    )
+
+    pieces, usage_chunk = [], None
+    try:
+        for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                pieces.append(chunk.choices[0].delta.content)
+                yield chunk.choices[0].delta.content
+            if getattr(chunk, 'usage', None) is not None:
+                usage_chunk = chunk
+    except GeneratorExit:
+        # The consumer went away (e.g. the browser tab was closed): the usage of the unfinished stream is not reported
+        logger.info(f"LLM (stream cancelled after {len(pieces)} pieces): {''.join(pieces)}")
+        raise
+    finally:
+        if hasattr(stream, 'close'):
+            stream.close()
+
+    message = ''.join(pieces)
+    total_cost = _record_usage(usage_chunk) if usage_chunk is not None else 0.0
+    return message, total_cost
+
 # Example usage
 if __name__ == "__main__":
     persona = "You are a helpful assistant."
@@ -78,5 +235,6 @@ if __name__ == "__main__":
     response, cost = model(persona, prompt)
     print(f"Response: {response}")
     print(f"Cost: ${cost:.6f}")
-    print(f"Total cost of all interactions: ${total_price:.6f}")
+    print(f"Total cost of all interactions: ${METRICS.total_cost():.6f}")
+    print(f"Total saved by the cache: ${METRICS.total_saved():.6f}")
 
@@ -10,26 +10,36 @@ Key Features:
 - Extracts and organizes dimension names, codes, and their human-readable labels
 - Handles time range constraints in the data
 - Provides methods to populate all variables with a single call
+- Shares the codelists between dataflows through the process-wide codelist store (see codelist_store.py)
+- Optional streaming mode for large structure messages: only the constrained codes are ever kept in memory
 
 Class Overview:
 Dataflow:
     Attributes:
         url (str): The URL of the SDMX dataflow
-        df_details_json (dict): Raw JSON data of the dataflow
+        df_details_json (dict): Raw JSON data of the dataflow (only while it is being parsed)
         df_name (str): Name of the dataflow
         df_description (str): Description of the dataflow
         df_dimension_names (dict[str, str]): Mapping of dimension IDs to their names
         df_code_names (dict[str, dict[str, str]]): Nested dictionary of dimension codes and their labels
+        df_code_list_keys (dict[str, tuple[str, str, str]]): Mapping of dimension IDs to the (agency, id, version) of their codelist
+        df_dimension_order (list[str]): The dimension IDs in the order of the series key (used to build data queries, see data_engine.py)
+        df_time_range (list[int]): The first and the last year with data, according to the content constraint (empty if unknown)
+        streaming (bool): Parse the structure message incrementally (requires ijson) instead of loading it as a whole
+        session (CachedSession): The pooled, caching HTTP session used for fetching (shared by default)
+        share_codelists (bool): Take the codelists from (and add them to) the codelist store; off to see the labels as published
 
     Methods:
         populate_variables(): Fetches data and populates all class variables
-        _get_df_details_json(): Fetches the raw JSON data from the URL
+        _get_df_details_json(): Loads the raw JSON data of the fetched body (or from the URL, through the cached, pooled HTTP session)
+        _stream_df_details_json(): Loads the data with an incremental parser, keeping only the constrained codes
         _extract_dataflow_info(): Extracts basic dataflow information (name and description)
         _extract_dimension_names(): Extracts names of dimensions from the dataflow
         _extract_constrained_codes_and_names(): Extracts codes and their labels for each dimension
         _get_code_list_urns(): Retrieves URNs (Uniform Resource Names) for code lists
         _get_code_list_id_urns(): Retrieves ID URNs for code lists
         _parse_content_constraints(): Parses content constraints from the dataflow
+        _get_year_range(): Extracts the year range of a time range constraint
 
 Usage:
     1. Create a Dataflow instance with the SDMX dataflow URL
@@ -45,9 +55,10 @@ Example:
     ```
 
 Dependencies:
-    - requests: For making HTTP requests
+    - requests: For making HTTP requests (see http_cache.py)
     - dataclasses: For the @dataclass decorator
     - datetime: For parsing date information
+    - ijson (optional): For the streaming mode
 
 Note:
     This implementation uses modern Python type hints and requires Python 3.7 or later for proper type checking.
@@ -62,7 +73,17 @@ Date: 2024-sep-29
 #from __future__ import annotations  # This allows us to use | for union types in Python 3.7+
 from dataclasses import dataclass, field
 from datetime import datetime
-import requests
+import json
+import sys
+import time
+from codelist_store import CODELISTS
+from http_cache import get_shared_session
+from metrics import METRICS
+
+try:
+    import ijson
+except ImportError:  # optional, only needed for the streaming mode
+    ijson = None
 
 @dataclass
 class Dataflow:
@@ -75,21 +96,145 @@ class Dataflow:
     df_description: str = ""
     df_dimension_names: dict[str, str] = field(default_factory=dict)
     df_code_names: dict[str, dict[str, str]] = field(default_factory=dict)
+    df_code_list_keys: dict[str, tuple[str, str, str]] = field(default_factory=dict)
+    df_dimension_order: list[str] = field(default_factory=list)
+    df_time_range: list[int] = field(default_factory=list)
+    streaming: bool = False
+    session: object = None  # a http_cache.CachedSession, the process-wide one by default
+    share_codelists: bool = True
 
     ACCEPT_HEADER = {'Accept': 'application/vnd.sdmx.structure+json;version=1.0;urn=true'}
+    # The sections of the structure message that are small enough to be built in memory in streaming mode
+    STREAMED_SECTIONS = ('dataflows', 'conceptSchemes', 'dataStructures', 'contentConstraints')
 
     def populate_variables(self) -> None:
         """Populate all variables with data from the dataflow."""
-        self._get_df_details_json()
+        if self.streaming and ijson is None:
+            print('ijson is not installed, falling back to parsing the whole structure in memory')
+            self.streaming = False
+
+        # Download (or revalidate) the structure message first, so that the fetch and the parse are timed separately.
+        # The body of this very fetch is parsed: opening the URL again would revalidate it again (e.g. with a TTL of 0)
+        session = self._get_session()
+        with METRICS.timer('fetch'):
+            cached = session.fetch(self.url, headers=self.ACCEPT_HEADER)
+        METRICS.inc('structure_fetches', status=cached['status'])
+        fetched = time.perf_counter()
+
+        with session.open_fetched(cached) as f:
+            if self.streaming:
+                self._stream_df_details_json(f)
+            else:
+                self._get_df_details_json(f)
         self._extract_dataflow_info()
         self._extract_dimension_names()
+        self._extract_dimension_order()
         self._extract_constrained_codes_and_names()
+        METRICS.observe('parse', time.perf_counter() - fetched)
+
+        # Everything we use has been extracted: the raw structure message is not kept
+        self.df_details_json = {}
+
+    def _get_session(self):
+        if self.session is None:
+            self.session = get_shared_session()
+        return self.session
+
+    def _get_df_details_json(self, stream=None) -> None:
+        """Load the dataflow details JSON from `stream`, or fetch it from the URL (or from the on-disk cache)."""
+        if stream is None:
+            with self._get_session().open(self.url, headers=self.ACCEPT_HEADER) as f:
+                return self._get_df_details_json(f)
+        self.df_details_json = json.load(stream)['data']
+
+    def _stream_df_details_json(self, stream=None) -> None:
+        """
+        Fetch the dataflow details with an incremental JSON parser, keeping only what we index.
+
+        The response body is read from the on-disk cache twice: the first pass builds the small sections
+        (dataflow, concept scheme, data structure and content constraint), the second pass walks the codelists
+        and keeps only the codes allowed by the content constraint. The whole document is never built in memory.
+        `stream` is the (seekable) body, fetched from the URL if it is not given.
+        """
+        if stream is None:
+            with self._get_session().open(self.url, headers=self.ACCEPT_HEADER) as f:
+                return self._stream_df_details_json(f)
+        self.df_details_json = self._collect_first_items(stream, self.STREAMED_SECTIONS)
+        constrained_codes = self._parse_content_constraints()
+        code_list_urns = self._get_code_list_urns()
+
+        stream.seek(0)
+        self.df_details_json['codelists'] = self._collect_constrained_codelists(
+            stream, code_list_urns, constrained_codes, skip_shared=self.share_codelists)
+
+    @staticmethod
+    def _collect_first_items(stream, sections) -> dict[str, list[dict]]:
+        """Build the first item of each of the given sections of the structure message, skipping everything else."""
+        prefixes = {f'data.{section}.item': section for section in sections}
+        collected = {}
+        builder, depth, section = None, 0, None
+
+        for prefix, event, value in ijson.parse(stream):
+            if builder is None:
+                if event != 'start_map' or prefix not in prefixes or prefixes[prefix] in collected:
+                    continue
+                builder, depth, section = ijson.ObjectBuilder(), 0, prefixes[prefix]
+
+            builder.event(event, value)
+            if event in ('start_map', 'start_array'):
+                depth += 1
+            elif event in ('end_map', 'end_array'):
+                depth -= 1
 
-    def _get_df_details_json(self) -> None:
-        """Fetch the dataflow details JSON from the URL."""
-        response = requests.get(self.url, headers=self.ACCEPT_HEADER)
-        response.raise_for_status()
-        self.df_details_json = response.json()['data']
+            if depth == 0:
+                collected[section] = [builder.value]
+                builder = None
+                if len(collected) == len(sections):
+                    break
+        return collected
+
+    @staticmethod
+    def _collect_constrained_codelists(stream, code_list_urns, constrained_codes, skip_shared=True) -> list[dict]:
+        """
+        Walk the codelists of the structure message and keep the id and name of the constrained codes only.
+        Codelists that are already in the codelist store are not collected again (unless `skip_shared` is False).
+        """
+        allowed_codes = {}
+        for dimension_code, urn in code_list_urns.items():
+            if dimension_code in constrained_codes and not (skip_shared and urn in CODELISTS):
+                allowed_codes.setdefault(urn, set()).update(constrained_codes[dimension_code])
+        # Used while the URN of the codelist is not known yet (i.e. the links come after the codes)
+        any_allowed_code = set().union(*allowed_codes.values())
+        referenced_urns = set(code_list_urns.values())
+
+        codelists = []
+        urn, codes, code = None, [], None
+        for prefix, event, value in ijson.parse(stream):
+            if not prefix.startswith('data.codelists.item'):
+                continue
+            if prefix == 'data.codelists.item':
+                if event == 'start_map':
+                    urn, codes = None, []
+                elif event == 'end_map' and urn in referenced_urns:
+                    allowed = allowed_codes.get(urn, set())
+                    codelists.append({  'links': [{'urn': urn}]
+                                      , 'codes': [code for code in codes if code['id'] in allowed]
+                                      , 'partial': True})
+            elif prefix == 'data.codelists.item.links.item.urn' and urn is None:
+                urn = value
+            elif prefix == 'data.codelists.item.codes.item':
+                if event == 'start_map':
+                    code = {}
+                elif event == 'end_map':
+                    allowed = allowed_codes.get(urn, set()) if urn is not None else any_allowed_code
+                    if code.get('id') in allowed:
+                        code.setdefault('name', code['id'])
+                        codes.append(code)
+            elif prefix == 'data.codelists.item.codes.item.id':
+                code['id'] = value
+            elif prefix == 'data.codelists.item.codes.item.name':
+                code['name'] = value
+        return codelists
 
     def _extract_dataflow_info(self) -> None:
         """Extract basic dataflow information."""
@@ -102,6 +247,12 @@ class Dataflow:
         concepts = self.df_details_json['conceptSchemes'][0]['concepts']
         self.df_dimension_names = {item['id']: item['name'] for item in concepts}
 
+    def _extract_dimension_order(self) -> None:
+        """Extract the dimension IDs in the order of the series key (the time dimension is not part of it)."""
+        dimensions = self.df_details_json['dataStructures'][0]['dataStructureComponents']['dimensionList']['dimensions']
+        ordered = sorted(enumerate(dimensions), key=lambda item: (item[1].get('position', item[0]), item[0]))
+        self.df_dimension_order = [dim['id'] for _, dim in ordered]
+
     def _extract_constrained_codes_and_names(self) -> None:
         """Extract constrained codes and names from the dataflow."""
         code_list_urns = self._get_code_list_urns()
@@ -110,15 +261,28 @@ class Dataflow:
 
         for dimension_code, codes in attributes.items():
             try:
-                all_codes_and_names = dict(code_list_id_urns[code_list_urns[dimension_code]])
+                code_list_urn = code_list_urns[dimension_code]
+                all_codes_and_names = code_list_id_urns[code_list_urn]
             except KeyError:
                 all_codes_and_names = {code: 'No codelist found' for code in codes}
                 print(f'No codelist found for {dimension_code}')
-            
-            self.df_code_names[dimension_code] = {
-                code: all_codes_and_names.get(code, 'Unknown code')
-                for code in codes
-            }
+                self.df_code_names[dimension_code] = all_codes_and_names
+                continue
+
+            self.df_code_list_keys[dimension_code] = CODELISTS.key_from_urn(code_list_urn)
+            # The codes are always in the order of the content constraint: the codelist may be complete or partial
+            # (streaming), in codelist order, and the content hash of the documents depends on the order
+            if self.share_codelists:
+                # The codelist itself for an unconstrained dimension, else the subset shared by the same constraints
+                self.df_code_names[dimension_code] = CODELISTS.subset(code_list_urn, all_codes_and_names, codes)
+            elif tuple(all_codes_and_names) == tuple(codes):
+                self.df_code_names[dimension_code] = all_codes_and_names
+            else:
+                # The names are the interned strings of the shared codelist, only the (smaller) dictionary is new
+                self.df_code_names[dimension_code] = {
+                    code: all_codes_and_names.get(code, 'Unknown code')
+                    for code in codes
+                }
 
     def _get_code_list_urns(self) -> dict[str, str]:
         """Get code list URNs from the dataflow."""
@@ -128,12 +292,20 @@ class Dataflow:
             for dim in dimensions
         }
 
-    def _get_code_list_id_urns(self) -> dict[str, list[tuple[str, str]]]:
-        """Get code list ID URNs from the dataflow."""
-        return {
-            codelist['links'][0]['urn']: [(code['id'], code['name']) for code in codelist['codes']]
-            for codelist in self.df_details_json['codelists']
-        }
+    def _get_code_list_id_urns(self) -> dict[str, dict[str, str]]:
+        """Get the (shared) codes and names of the code lists of the dataflow, keyed by code list URN."""
+        code_list_id_urns = {}
+        for codelist in self.df_details_json['codelists']:
+            urn = codelist['links'][0]['urn']
+            codes_and_names = ((code['id'], code['name']) for code in codelist['codes'])
+            if not self.share_codelists:
+                code_list_id_urns[urn] = {sys.intern(code): sys.intern(name) for code, name in codes_and_names}
+            elif codelist.get('partial'):
+                # Streaming mode only kept the constrained codes: not the complete codelist, interned apart from it
+                code_list_id_urns[urn] = CODELISTS.intern_partial(urn, codes_and_names)
+            else:
+                code_list_id_urns[urn] = CODELISTS.intern(urn, codes_and_names)
+        return code_list_id_urns
 
     def _parse_content_constraints(self) -> dict[str, list[str] | list[int]]:
         """Parse content constraints from the dataflow."""
@@ -145,16 +317,23 @@ class Dataflow:
             if value_type == 'values':
                 attributes[attr_id] = item[value_type]
             elif value_type == 'timeRange':
-                # for simplicity's sake, let's not deal with time for now
-                # attributes[attr_id] = self._get_year_range(item[value_type])
-                continue
+                # Not a list of codes: the years are kept apart, to bound the data queries (see data_engine.py)
+                self.df_time_range = self._get_year_range(item[value_type])
             else:
                 raise ValueError(f'Unknown value type: {value_type}')
         return attributes
 
-    # @staticmethod
-    # def _get_year_range(time_period_obj: dict[str, dict[str, str]]) -> list[int]:
-    #     """Extract year range from a time period object."""
-    #     start_year = datetime.fromisoformat(time_period_obj['startPeriod']['period']).year
-    #     end_year = datetime.fromisoformat(time_period_obj['endPeriod']['period']).year
-    #     return [start_year, end_year]
\ No newline at end of file
+    @staticmethod
+    def _get_year_range(time_period_obj: dict[str, dict[str, str]]) -> list[int]:
+        """Extract year range from a time period object (an open end is left out)."""
+        years = []
+        for end in ('startPeriod', 'endPeriod'):
+            period = time_period_obj.get(end, {}).get('period')
+            if period is None:
+                return []
+            try:
+                years.append(datetime.fromisoformat(period).year)
+            except ValueError:
+                # Reporting periods such as '2020' or '2020-Q1'
+                years.append(int(period[:4]))
+        return years
\ No newline at end of file
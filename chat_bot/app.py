@@ -1,7 +1,23 @@
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, Response, render_template, request, jsonify, session, stream_with_context
+from dotenv import load_dotenv
+import asyncio
+import json
+import os
+import time
+from bot_registry import BotRegistry, IdleEvictor
+from init_jobs import InitJobManager
+from reindex import CatalogueRefresher
+from compact_dataflow import SNAPSHOTS
+from catalogue_index import get_catalogue_bot, catalogue_bot_error
+from metrics import METRICS
+import LLM
 import grounded_llm
 
+load_dotenv()
+
 app = Flask(__name__)
+# The session cookie remembers which dataflow the user has selected
+app.secret_key = os.getenv('FLASK_SECRET_KEY') or os.urandom(24)
 
 # Here are some example categories to make things simpler, but in a real application we would also have to read them from SDMX
 categories_data = {
@@ -11,8 +27,28 @@ categories_data = {
     'WT Indicators': ['OECD.EDU.IMEP:DSD_EAG_WT@DF_ACT_TCH(2.0)', 'OECD.EDU.IMEP:DSD_EAG_WT@DF_ALL(2.0)']
 }
 
-# Global bot instance (for demonstration purposes)
-bot_instance = None
+# Search the raw question while it is being rephrased (see Bot.aanswer_question)
+SPECULATIVE_RETRIEVAL = os.getenv('SPECULATIVE_RETRIEVAL', 'false').lower() == 'true'
+
+# Preload the parsed dataflows of the catalogue from their snapshot, if there is one (see compact_dataflow.py)
+if os.getenv('SDMX_SNAPSHOT'):
+    print(f"{SNAPSHOTS.load(os.getenv('SDMX_SNAPSHOT'))} dataflows preloaded from {os.getenv('SDMX_SNAPSHOT')}")
+
+# Warm bots shared by all sessions, one per dataflow
+bot_registry = BotRegistry(  max_bots=int(os.getenv('MAX_RESIDENT_BOTS', 8))
+                           , idle_timeout=int(os.getenv('BOT_IDLE_TIMEOUT', 30 * 60)))
+# Release the bots that have been idle for BOT_IDLE_TIMEOUT seconds, checked every BOT_IDLE_CHECK_INTERVAL seconds
+idle_evictor = IdleEvictor(bot_registry, interval=float(os.getenv('BOT_IDLE_CHECK_INTERVAL', 60))).start()
+# The bots are built in the background, see /initialize_bot
+init_jobs = InitJobManager(bot_registry, workers=int(os.getenv('BOT_INIT_WORKERS', 2)))
+
+# Re-index the dataflows whose structure changed every CATALOGUE_REFRESH_INTERVAL seconds (0: never), see reindex.py
+CATALOGUE_REFRESH_INTERVAL = float(os.getenv('CATALOGUE_REFRESH_INTERVAL', 0))
+catalogue_refresher = None
+if CATALOGUE_REFRESH_INTERVAL > 0:
+    catalogue_refresher = CatalogueRefresher(  [name for names in categories_data.values() for name in names]
+                                             , interval=CATALOGUE_REFRESH_INTERVAL
+                                             , bot_registry=bot_registry).start()
 
 @app.route('/')
 def index():
@@ -28,28 +64,199 @@ def get_dataflows(category):
 
 @app.route('/initialize_bot', methods=['POST'])
 def initialize_bot():
-    global bot_instance
+    # Building a bot can take minutes: it is started in the background and followed with /initialize_status/<job_id>
     data = request.json
     dataflow = data.get('dataflow')
 
-    bot_instance = grounded_llm.Bot(dataflow) 
+    job = init_jobs.submit(dataflow)
+    session['dataflow'] = dataflow
 
-    return jsonify({'status': 'success', 'message': f'Bot initialized with dataflow: {dataflow}'})
+    return jsonify({'status': 'success', 'message': f'Initializing the bot with dataflow: {dataflow}', **job.to_dict()})
+
+@app.route('/initialize_status/<job_id>', methods=['GET'])
+def initialize_status(job_id):
+    job = init_jobs.get(job_id)
+    if job is None:
+        return jsonify({'status': 'error', 'message': f'Unknown initialization job: {job_id}'}), 404
+    return jsonify(job.to_dict())
+
+def _resident_bot(dataflow):
+    # (bot, None) if the bot of the dataflow is resident. Otherwise (None, answer): the bot is never built on the
+    # request thread but by a background job (after an eviction, or for a dataflow given in the request), and the
+    # answer says so, or that the last build failed ('status': 'error')
+    bot = bot_registry.get(dataflow)
+    if bot is not None:
+        return bot, None
+    job = init_jobs.last_job(dataflow)
+    if job is not None and job.status == 'failed':
+        message = f"Initializing the bot failed: {job.error}. Please click 'Initialize Bot' to try again."
+        return None, {'status': 'error', 'message': message, 'response': message, 'job_id': job.job_id}
+    job = init_jobs.submit(dataflow)
+    message = f"The bot is still initializing ({job.stage.replace('_', ' ')}, {job.percent}%). Please try again in a moment."
+    return None, {'status': 'initializing', 'message': message, 'response': message, 'job_id': job.job_id}
 
 @app.route('/chat', methods=['POST'])
-def chat():
-    global bot_instance
+async def chat():
     data = request.json
     user_message = data['message']
+    dataflow = data.get('dataflow') or session.get('dataflow')
 
-    if not bot_instance:
-        return jsonify({'response': "Bot is not initialized. Please select a category and dataflow, and click 'Initialize Bot'."})
+    if not dataflow:
+        # Without a dataflow the question goes to the whole catalogue, if its index has been built
+        catalogue_bot = await asyncio.to_thread(get_catalogue_bot)
+        if catalogue_bot is None:
+            return jsonify({'response': "Bot is not initialized. Please select a category and dataflow, and click 'Initialize Bot'."})
+        result = await asyncio.to_thread(catalogue_bot.answer, user_message)
+        return jsonify({'response': result['answer'], 'dataflows': result['dataflows']})
 
-    # Placeholder for bot's response
-    # response = f"[Bot]: You said '{user_message}' (using dataflow: {bot_instance})"
-    response = bot_instance.answer_question(user_message)
+    # The bot may have been evicted since initialization, in that case it is rebuilt (from the index cache)
+    bot, pending = _resident_bot(dataflow)
+    if pending is not None:
+        return jsonify(pending), 500 if pending['status'] == 'error' else 200
+    response = await bot.aanswer_question(user_message, speculative=SPECULATIVE_RETRIEVAL)
     return jsonify({'response': response})
 
+# The largest batch accepted by /chat/batch
+CHAT_BATCH_MAX = int(os.getenv('CHAT_BATCH_MAX', 500))
+
+@app.route('/chat/batch', methods=['POST'])
+async def chat_batch():
+    # Many questions at once (e.g. an evaluation run): {"questions": [...]} -> the results in the same order,
+    # with the latency and the cost of every question (see Bot.answer_questions)
+    data = request.json
+    questions = data.get('questions')
+    dataflow = data.get('dataflow') or session.get('dataflow')
+
+    if not isinstance(questions, list) or not all(isinstance(question, str) for question in questions):
+        return jsonify({'status': 'error', 'message': "'questions' must be a list of strings."}), 400
+    if len(questions) > CHAT_BATCH_MAX:
+        return jsonify({'status': 'error', 'message': f'At most {CHAT_BATCH_MAX} questions per batch.'}), 400
+    if not dataflow:
+        return jsonify({'status': 'error', 'message': "Bot is not initialized. Please select a category and dataflow, and click 'Initialize Bot'."}), 400
+
+    bot, pending = _resident_bot(dataflow)
+    if pending is not None:
+        return jsonify(pending), 500 if pending['status'] == 'error' else 409
+    start = time.perf_counter()
+    results = await asyncio.to_thread(bot.answer_questions, questions)
+    return jsonify({  'results': results
+                    , 'questions': len(results)
+                    , 'unique_questions': sum(result['path'] != 'duplicate' for result in results)
+                    , 'cost': sum(result['cost'] for result in results)
+                    , 'seconds': time.perf_counter() - start})
+
+def _sse(data, event=None):
+    # One server-sent event; the data is JSON so that newlines in the answer survive the framing
+    return (f'event: {event}\n' if event else '') + f'data: {json.dumps(data)}\n\n'
+
+@app.route('/chat/stream', methods=['POST'])
+def chat_stream():
+    # The same as /chat, but the answer is sent as server-sent events while it is being generated:
+    # 'data: {"delta": ...}' events with the pieces of the answer, then an 'end' event (or an 'error' event)
+    data = request.json
+    user_message = data['message']
+    dataflow = data.get('dataflow') or session.get('dataflow')
+
+    catalogue_bot = None if dataflow else get_catalogue_bot()
+    if not dataflow and catalogue_bot is None:
+        return jsonify({'response': "Bot is not initialized. Please select a category and dataflow, and click 'Initialize Bot'."})
+    if catalogue_bot is not None:
+        # Without a dataflow the question goes to the whole catalogue; its answer is not streamed
+        def catalogue_events():
+            try:
+                result = catalogue_bot.answer(user_message)
+            except Exception as e:
+                app.logger.exception('Answering from the catalogue failed')
+                yield _sse({'message': str(e)}, event='error')
+                return
+            yield _sse({'delta': result['answer'], 'dataflows': result['dataflows']})
+            yield _sse({}, event='end')
+
+        return Response(  stream_with_context(catalogue_events())
+                        , mimetype='text/event-stream'
+                        , headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+    bot, pending = _resident_bot(dataflow)
+    if pending is not None:
+        if pending['status'] == 'error':
+            return jsonify(pending), 500
+        return Response(  _sse({'delta': pending['message'], 'job_id': pending['job_id']}) + _sse({}, event='end')
+                        , mimetype='text/event-stream'
+                        , headers={'Cache-Control': 'no-cache'})
+
+    def events():
+        try:
+            for piece in bot.answer_question_stream(user_message):
+                yield _sse({'delta': piece})
+        except Exception as e:
+            app.logger.exception('Streaming the answer failed')
+            yield _sse({'message': str(e)}, event='error')
+            return
+        yield _sse({}, event='end')
+
+    return Response(  stream_with_context(events())
+                    , mimetype='text/event-stream'
+                    , headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+def _catalogue_bot_or_error():
+    catalogue_bot = get_catalogue_bot()
+    if catalogue_bot is None:
+        error = catalogue_bot_error()
+        if isinstance(error, ValueError):
+            return None, (jsonify({'status': 'error', 'message': f'The catalogue index cannot be used: {error}'}), 503)
+        return None, (jsonify({'status': 'error', 'message': 'The catalogue index has not been built (python catalogue_index.py).'}), 404)
+    return catalogue_bot, None
+
+def _catalogue_index_stats():
+    catalogue_bot = get_catalogue_bot()
+    if catalogue_bot is None:
+        error = catalogue_bot_error()
+        return {'status': 'unavailable', 'error': 'not built' if isinstance(error, FileNotFoundError) else str(error)}
+    return catalogue_bot.index.stats()
+
+@app.route('/catalogue/chat', methods=['POST'])
+async def catalogue_chat():
+    # A question about the whole catalogue: routed to the most relevant dataflows, no bot has to be initialized
+    catalogue_bot, error = await asyncio.to_thread(_catalogue_bot_or_error)
+    if error is not None:
+        return error
+    result = await asyncio.to_thread(catalogue_bot.answer, request.json['message'])
+    return jsonify({'response': result['answer'], 'dataflows': result['dataflows']})
+
+@app.route('/catalogue/route', methods=['POST'])
+def catalogue_route():
+    # Only the dataflows a question would be routed to, e.g. to suggest one to initialize
+    catalogue_bot, error = _catalogue_bot_or_error()
+    if error is not None:
+        return error
+    return jsonify({'dataflows': [{'dataflow': route['name'], 'title': route['title'], 'categories': route['categories'],
+                                   'score': route['score']} for route in catalogue_bot.route(request.json['message'])]})
+
+@app.route('/lookup_stats', methods=['GET'])
+def lookup_stats():
+    # Hit / miss counters of the exact-match fast path of the resident bots
+    return jsonify({name: bot.lookup_index.stats() for name, bot in bot_registry.bots().items()})
+
+@app.route('/catalogue_refresh', methods=['GET'])
+def catalogue_refresh():
+    # The report of the last scheduled refresh of the catalogue
+    if catalogue_refresher is None:
+        return jsonify({'status': 'disabled', 'message': 'Set CATALOGUE_REFRESH_INTERVAL to refresh the catalogue.'})
+    return jsonify(catalogue_refresher.last_report or {'status': 'pending'})
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    # Stage latencies, counters and LLM usage by model and dataflow, plus the state of the caches and of the bots
+    return jsonify({
+        **METRICS.snapshot(),
+        'response_cache': LLM.response_cache.stats(),
+        'semantic_cache': grounded_llm.semantic_cache.stats() if grounded_llm.semantic_cache is not None else None,
+        'lookup': {name: bot.lookup_index.stats() for name, bot in bot_registry.bots().items()},
+        'resident_bots': bot_registry.status(),
+        'snapshot': {'dataflows': len(SNAPSHOTS)},
+        'catalogue_index': _catalogue_index_stats(),
+    })
+
 if __name__ == '__main__':
     print("Starting the app... on http://127.0.0.1:5000/")
     app.run(debug=True)
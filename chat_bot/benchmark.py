@@ -0,0 +1,435 @@
+"""
+Benchmark Module
+
+Measures the performance of the chat bot offline, with the stand-ins of fakes.py instead of the SDMX registry,
+the OpenAI chat model and the OpenAI embeddings. Every run starts in a fresh working directory (vector store,
+HTTP cache, LLM log), so the numbers only depend on the code and on the parameters.
+
+Reported (in seconds unless stated otherwise):
+- bot_init: cold (nothing cached) and warm (HTTP cache and index cache hit) `Bot` initialization times
+- answer_question: p50 / p95 / p99 latency of a mix of lookup and free-text questions
+- answer_question_stream: time to the first piece of the answer and to the whole answer, when streamed
+- chat: `/chat` throughput (requests per second) and latency under N concurrent clients
+- memory: resident set size per resident bot and the peak RSS of the process
+- vector_backends: build time and query latency (single and batched) of ChromaDB vs the NumPy index
+- stages: the latencies of the pipeline stages (fetch, parse, flatten, embed, retrieve, rephrase, generate, ...)
+- llm: the number of chat model calls and the average prompt size in tokens
+
+The results are written as JSON, so that runs can be compared; `--compare` reports the relative change of every
+metric against an earlier result file and flags the regressions above a tolerance.
+
+Usage:
+    python benchmark.py --dimensions 6 --codes-per-dimension 1000 --chat-latency 0.2 --output bench.json
+    python benchmark.py --payload recorded_structure.json --compare bench.json --fail-on-regression
+"""
+
+import argparse
+import gc
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+import numpy as np
+
+from fakes import FakeSDMXServer, install_fake_chat_model
+
+try:
+    import resource
+except ImportError:  # not available on Windows, the peak RSS is not reported there
+    resource = None
+
+MB = 1024 * 1024
+
+# Metrics where a larger value is an improvement, every other metric is better when smaller
+HIGHER_IS_BETTER = ('requests_per_second', 'questions_per_second', 'speedup', 'lookup_hit_rate')
+
+
+def percentiles(samples):
+    samples = np.asarray(samples, dtype=np.float64)
+    if samples.size == 0:
+        return {}
+    p50, p95, p99 = np.percentile(samples, [50, 95, 99])
+    return {  'count': int(samples.size)
+            , 'mean': float(samples.mean())
+            , 'p50': float(p50)
+            , 'p95': float(p95)
+            , 'p99': float(p99)
+            , 'max': float(samples.max())}
+
+
+def peak_rss():
+    """Peak resident set size of the process in bytes, or None if it cannot be measured."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def current_rss():
+    """Current resident set size of the process in bytes (falls back to the peak where /proc is not available)."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return peak_rss()
+
+
+def sample_questions(df_info, n):
+    """A deterministic mix of questions: templated lookups (fast path) and free-text questions (full pipeline)."""
+    dimensions = list(df_info.df_dimension_names.items())
+    codes = [(dim, code, name) for dim, code_names in df_info.df_code_names.items() for code, name in code_names.items()]
+    free_text = [
+        'What are the columns in this table?',
+        'What is this table about?',
+        'Which categories does the column {dim_name} have?',
+        'Is there information about {name} in this table?',
+        'How is {dim_name} broken down?',
+    ]
+
+    questions = []
+    for i in range(n):
+        dim_code, dim_name = dimensions[i % len(dimensions)]
+        dim, code, name = codes[(i * 7919) % len(codes)]
+        if i % 4 == 0:
+            questions.append(f"What is the English name of the code '{code}' within the code list ID '{dim}'?")
+        elif i % 4 == 1:
+            questions.append(f"What name corresponds to the column code: '{dim_code}'?")
+        else:
+            # The index makes every free-text question unique, so that none of them is a cache hit
+            template = free_text[i % len(free_text)]
+            questions.append(template.format(dim_name=dim_name, name=name) + f' ({i})')
+    return questions
+
+
+def bench_bot_init(server, runs):
+    """Cold and warm initialization of the bots of `runs` new dataflows."""
+    from codelist_store import CODELISTS
+    from grounded_llm import Bot
+
+    cold, warm, bot = [], [], None
+    for i in range(runs):
+        dataflow_name = server.dataflow_name(i)
+        # Nothing of this dataflow is cached yet, and the codelists of the earlier dataflows are forgotten
+        CODELISTS.clear()
+        start = time.perf_counter()
+        Bot(dataflow_name)
+        cold.append(time.perf_counter() - start)
+
+        # The structure is in the HTTP cache and the collection is in the index cache
+        start = time.perf_counter()
+        bot = Bot(dataflow_name)
+        warm.append(time.perf_counter() - start)
+    return {'cold': percentiles(cold), 'warm': percentiles(warm)}, bot
+
+
+def bench_answer_question(bot, questions):
+    latencies = []
+    for question in questions:
+        start = time.perf_counter()
+        bot.answer_question(question)
+        latencies.append(time.perf_counter() - start)
+    return {**percentiles(latencies), 'lookup_hit_rate': bot.lookup_index.stats()['hit_rate']}
+
+
+def bench_answer_questions(bot, questions):
+    """The same questions as one batch: the throughput compared to answering them one at a time."""
+    start = time.perf_counter()
+    results = bot.answer_questions(questions)
+    elapsed = time.perf_counter() - start
+    return {  'questions': len(questions)
+            , 'seconds': elapsed
+            , 'questions_per_second': len(questions) / elapsed
+            , 'latency': percentiles([result['latency'] for result in results if result['path'] != 'duplicate'])}
+
+
+def bench_answer_question_stream(bot, questions):
+    first_piece, total = [], []
+    for question in questions:
+        start = time.perf_counter()
+        for i, _ in enumerate(bot.answer_question_stream(question)):
+            if i == 0:
+                first_piece.append(time.perf_counter() - start)
+        total.append(time.perf_counter() - start)
+    return {'first_token': percentiles(first_piece), 'total': percentiles(total)}
+
+
+def bench_vector_backends(df_info, queries):
+    """Build the vector store of the same documents with both backends and compare the query latencies."""
+    from chromaDB import ChromaDBWrapper
+    from data_prep_for_indenxing import flatten_info
+    from embeddings import get_embedding_function
+    from vector_index import NumpyVectorIndex
+
+    flat_info = flatten_info(df_info)
+    embedding_function = get_embedding_function()
+    # The documents are embedded once up front, so that the build times are the times of the stores themselves
+    precomputed = dict(zip(  [str(question) for question, _ in flat_info]
+                           , embedding_function([str(question) for question, _ in flat_info])))
+
+    results = {}
+    for backend in ('chroma', 'numpy'):
+        start = time.perf_counter()
+        if backend == 'chroma':
+            store = ChromaDBWrapper(  flat_info
+                                    , collection_name='vector-backend-benchmark'
+                                    , precomputed_embeddings=precomputed
+                                    , embedding_function=embedding_function)
+        else:
+            store = NumpyVectorIndex(  flat_info
+                                     , dataflow_name='vector-backend-benchmark'
+                                     , precomputed_embeddings=precomputed
+                                     , embedding_function=embedding_function)
+        build = time.perf_counter() - start
+
+        latencies = []
+        for query in queries:
+            start = time.perf_counter()
+            store.query(query, n_results=3)
+            latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        store.query_many(queries, n_results=3)
+        batched = (time.perf_counter() - start) / len(queries)
+
+        results[backend] = {'documents': len(precomputed), 'build': build, 'query': percentiles(latencies),
+                            'query_many_per_query': batched}
+    return results
+
+
+def bench_chat(dataflow_name, questions, clients, requests_per_client):
+    """`/chat` throughput with `clients` concurrent clients, each sending `requests_per_client` requests."""
+    from app import app
+
+    # The bot is built in the background: wait until it is done, so that only the answers are measured
+    client = app.test_client()
+    response = client.post('/initialize_bot', json={'dataflow': dataflow_name})
+    if response.status_code != 200:
+        raise RuntimeError(f'/initialize_bot failed with status {response.status_code}')
+    job = response.get_json()
+    while not job['done']:
+        time.sleep(0.05)
+        job = client.get(f"/initialize_status/{job['job_id']}").get_json()
+    if job['error']:
+        raise RuntimeError(f"Initializing the bot failed: {job['error']}")
+
+    def run_client(k):
+        client = app.test_client()
+        latencies = []
+        for j in range(requests_per_client):
+            question = questions[(k * requests_per_client + j) % len(questions)]
+            start = time.perf_counter()
+            response = client.post('/chat', json={'message': question, 'dataflow': dataflow_name})
+            latencies.append(time.perf_counter() - start)
+            if response.status_code != 200:
+                raise RuntimeError(f'/chat failed with status {response.status_code}')
+        return latencies
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as executor:
+        latencies = [latency for client_latencies in executor.map(run_client, range(clients)) for latency in client_latencies]
+    elapsed = time.perf_counter() - start
+
+    return {  'clients': clients
+            , 'requests': len(latencies)
+            , 'requests_per_second': len(latencies) / elapsed
+            , 'latency': percentiles(latencies)}
+
+
+def bench_memory(server, n_bots, first_dataflow):
+    """Resident memory of `n_bots` bots of different dataflows, held by a bot registry."""
+    from bot_registry import BotRegistry
+
+    gc.collect()
+    before = current_rss()
+    registry = BotRegistry(max_bots=n_bots)
+    for i in range(n_bots):
+        registry.get_or_create(server.dataflow_name(first_dataflow + i))
+    gc.collect()
+    after = current_rss()
+
+    peak = peak_rss()
+    return {  'resident_bots': len(registry)
+            , 'rss_per_bot_mb': (after - before) / n_bots / MB if before is not None else None
+            , 'rss_mb': after / MB if after is not None else None
+            , 'peak_rss_mb': peak / MB if peak is not None else None}
+
+
+def flatten_metrics(results, prefix=''):
+    """{'a': {'b': 1}} -> {'a.b': 1}, numeric values only."""
+    flat = {}
+    for key, value in results.items():
+        name = f'{prefix}{key}'
+        if isinstance(value, dict):
+            flat.update(flatten_metrics(value, f'{name}.'))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[name] = value
+    return flat
+
+
+def compare(results, baseline, tolerance=0.1):
+    """Print the relative change of every metric against the baseline; return the regressions above the tolerance."""
+    current, previous = flatten_metrics(results), flatten_metrics(baseline)
+    regressions = []
+    for name in sorted(current.keys() & previous.keys()):
+        if previous[name] == 0 or name.endswith('.count') or name.endswith('clients') or name.endswith('requests'):
+            continue
+        change = (current[name] - previous[name]) / abs(previous[name])
+        worse = -change if name.rsplit('.', 1)[-1] in HIGHER_IS_BETTER else change
+        flag = ''
+        if worse > tolerance:
+            regressions.append(name)
+            flag = '  <-- regression'
+        print(f'{name:45} {previous[name]:12.4f} -> {current[name]:12.4f} ({change:+.1%}){flag}')
+    return regressions
+
+
+def git_revision():
+    try:
+        return subprocess.run(  ['git', 'rev-parse', '--short', 'HEAD']
+                              , cwd=os.path.dirname(os.path.abspath(__file__))
+                              , capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    with FakeSDMXServer(  payload_path=args.payload
+                        , dimensions=args.dimensions
+                        , codes_per_dimension=args.codes_per_dimension
+                        , constrained_fraction=args.constrained_fraction
+                        , latency=args.registry_latency) as server:
+        # The modules of the bot read their configuration at import time, so they are imported only now
+        os.environ['SDMX_REST_URL'] = server.url
+        os.environ['SDMX_CACHE_DIR'] = os.path.join(os.getcwd(), '.sdmx_cache')
+        os.environ['EMBEDDING_BACKEND'] = 'hashing'
+        os.environ['VECTOR_BACKEND'] = args.vector_backend
+        import LLM
+        import grounded_llm
+        from response_cache import ResponseCache
+
+        install_fake_chat_model(latency=args.chat_latency, token_latency=args.chat_token_latency)
+        if not args.with_response_cache:
+            LLM.response_cache = ResponseCache(max_entries=0)
+            grounded_llm.semantic_cache = None
+
+        results = {}
+        print(f'Bot initialization ({args.init_runs} dataflows)...')
+        results['bot_init'], bot = bench_bot_init(server, args.init_runs)
+
+        questions = sample_questions(bot.df_info, args.questions)
+        print(f'answer_question ({len(questions)} questions)...')
+        results['answer_question'] = bench_answer_question(bot, questions)
+
+        print(f'answer_questions ({len(questions)} questions in a batch)...')
+        batch_questions = [f'{question} (batched)' for question in questions]
+        results['answer_questions'] = bench_answer_questions(bot, batch_questions)
+        sequential = results['answer_question']['mean']
+        results['answer_questions']['speedup'] = sequential * len(questions) / results['answer_questions']['seconds']
+
+        print(f'answer_question_stream ({len(questions)} questions)...')
+        stream_questions = [f'{question} (streamed)' for question in questions]
+        results['answer_question_stream'] = bench_answer_question_stream(bot, stream_questions)
+
+        print(f'/chat ({args.clients} clients x {args.requests_per_client} requests)...')
+        chat_questions = sample_questions(bot.df_info, args.clients * args.requests_per_client)
+        results['chat'] = bench_chat(bot.dataflow_name, chat_questions, args.clients, args.requests_per_client)
+
+        print(f'Memory ({args.resident_bots} resident bots)...')
+        results['memory'] = bench_memory(server, args.resident_bots, first_dataflow=args.init_runs)
+
+        print('Vector backends...')
+        results['vector_backends'] = bench_vector_backends(bot.df_info, questions)
+        results['registry_requests'] = server.requests
+
+        # Where the time went, by pipeline stage (see metrics.py)
+        from metrics import METRICS
+        snapshot = METRICS.snapshot()
+        results['stages'] = {stage: {key: value for key, value in histogram.items() if key != 'buckets'}
+                             for stage, histogram in snapshot['stages'].items()}
+
+        # The size of the prompts drives the latency and the cost of the real model
+        calls = sum(usage['calls'] for usage in snapshot['llm_usage'])
+        prompt_tokens = sum(usage['prompt_tokens'] for usage in snapshot['llm_usage'])
+        results['llm'] = {'calls': calls, 'prompt_tokens_per_call': prompt_tokens / calls if calls else 0.0}
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline benchmark of the SDMX chat bot.')
+    parser.add_argument('--payload', help='Recorded references=all structure message to serve (default: synthetic)')
+    parser.add_argument('--dimensions', type=int, default=5, help='Dimensions of the synthetic dataflows')
+    parser.add_argument('--codes-per-dimension', type=int, default=200, help='Codes of every synthetic codelist')
+    parser.add_argument('--constrained-fraction', type=float, default=0.25, help='Share of the codes used by a dataflow')
+    parser.add_argument('--registry-latency', type=float, default=0.0, help='Latency of the fake SDMX registry (s)')
+    parser.add_argument('--chat-latency', type=float, default=0.2, help='Latency of the fake chat model (s)')
+    parser.add_argument('--chat-token-latency', type=float, default=0.005, help='Time per generated token (s)')
+    parser.add_argument('--init-runs', type=int, default=3, help='Dataflows used for the cold / warm init times')
+    parser.add_argument('--questions', type=int, default=100, help='Questions for the answer_question latencies')
+    parser.add_argument('--clients', type=int, default=8, help='Concurrent /chat clients')
+    parser.add_argument('--requests-per-client', type=int, default=10, help='/chat requests of every client')
+    parser.add_argument('--resident-bots', type=int, default=4, help='Bots built for the memory measurement')
+    parser.add_argument('--vector-backend', choices=('chroma', 'numpy'), default='chroma', help='Vector store of the bots')
+    parser.add_argument('--with-response-cache', action='store_true', help='Keep the LLM response caches enabled')
+    parser.add_argument('--workdir', help='Working directory (default: a new temporary directory, removed afterwards)')
+    parser.add_argument('--output', help='Write the results to this JSON file (default: print them)')
+    parser.add_argument('--compare', help='Earlier result file to compare the results with')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='Relative change that counts as a regression')
+    parser.add_argument('--fail-on-regression', action='store_true', help='Exit with status 1 if there is a regression')
+    args = parser.parse_args()
+
+    # Resolve the paths before moving to the working directory
+    output = os.path.abspath(args.output) if args.output else None
+    baseline_path = os.path.abspath(args.compare) if args.compare else None
+    if args.payload:
+        args.payload = os.path.abspath(args.payload)
+
+    original_dir = os.getcwd()
+    workdir = args.workdir or tempfile.mkdtemp(prefix='sdmx-bench-')
+    os.makedirs(workdir, exist_ok=True)
+    os.chdir(workdir)
+    try:
+        started_at = datetime.now(timezone.utc).isoformat(timespec='seconds')
+        results = run(args)
+    finally:
+        os.chdir(original_dir)
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        'meta': {
+            'started_at': started_at,
+            'git_revision': git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'parameters': {key: value for key, value in vars(args).items()
+                           if key not in ('output', 'compare', 'workdir', 'fail_on_regression')},
+        },
+        'results': results,
+    }
+
+    if output:
+        with open(output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+        print(f'Results written to {output}')
+    else:
+        print(json.dumps(report, indent=2))
+
+    if baseline_path:
+        with open(baseline_path, encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline['results'], tolerance=args.tolerance)
+        print(f'{len(regressions)} regression(s) above {args.tolerance:.0%}')
+        if regressions and args.fail_on_regression:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
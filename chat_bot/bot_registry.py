@@ -0,0 +1,171 @@
+"""
+Bot Registry Module
+
+A thread-safe registry of warm `Bot` instances, one per dataflow, so that several users can chat with
+different dataflows at the same time.
+
+Key Features:
+- One bot (and one vector store collection) per dataflow, shared by every session that selected it
+- Bots are built outside of the registry lock: building a bot for one dataflow does not block the others
+- Concurrent requests for the same dataflow wait for the single build instead of starting their own
+- The number of resident bots is capped, the least recently used ones are evicted first
+- Every use of a bot marks the vector store collection it answers from as used (`Bot.touch`), so that the index cache
+  does not evict the collection of a bot that is serving answers
+- Bots that have not been used for `idle_timeout` seconds are evicted: `get` never returns one, and an `IdleEvictor`
+  thread drops them every `interval` seconds, so that their memory is released even if nobody asks for them
+- The evictions are counted in METRICS ('bot_evictions' by reason: 'idle', 'capacity', or 'error' for a failed check)
+
+Usage:
+    ```python
+    registry = BotRegistry(max_bots=8, idle_timeout=1800)
+    bot = registry.get_or_create('OECD.EDU.IMEP:DSD_EAG_IT@DF_EAG_IT_AGE(1.1)')
+    bot.answer_question('What are the columns in this table?')
+
+    evictor = IdleEvictor(registry, interval=60).start()
+    ```
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+from metrics import METRICS
+
+
+class BotRegistry:
+    """Maps dataflow names to warm bots."""
+
+    def __init__(self, bot_factory=None, max_bots=8, idle_timeout=30 * 60):
+        if bot_factory is None:
+            from grounded_llm import Bot
+            bot_factory = Bot
+        self.bot_factory = bot_factory
+        self.max_bots = max_bots
+        self.idle_timeout = idle_timeout
+        self._bots = OrderedDict()  # dataflow name -> [bot, last used timestamp], least recently used first
+        self._build_locks = {}
+        self._lock = threading.Lock()
+
+    def get(self, dataflow_name):
+        """Return the resident bot of the dataflow, or None if it has not been built (or was evicted, or is idle)."""
+        with self._lock:
+            entry = self._bots.get(dataflow_name)
+            if entry is None:
+                return None
+            now = time.monotonic()
+            if now - entry[1] > self.idle_timeout:
+                del self._bots[dataflow_name]
+                _record_evictions({dataflow_name: 'idle'})
+                return None
+            entry[1] = now
+            self._bots.move_to_end(dataflow_name)
+            bot = entry[0]
+        touch = getattr(bot, 'touch', None)
+        if touch is not None:
+            touch()
+        return bot
+
+    def get_or_create(self, dataflow_name, **factory_kwargs):
+        """Return the bot of the dataflow, building it first if needed (with `factory_kwargs`, e.g. callbacks)."""
+        bot = self.get(dataflow_name)
+        if bot is not None:
+            return bot
+
+        with self._lock:
+            build_lock = self._build_locks.setdefault(dataflow_name, threading.Lock())
+
+        # Only one thread builds a given dataflow, the others wait for it and pick up the result
+        with build_lock:
+            bot = self.get(dataflow_name)
+            if bot is None:
+                bot = self.bot_factory(dataflow_name, **factory_kwargs)
+                self.put(dataflow_name, bot)
+
+        with self._lock:
+            self._build_locks.pop(dataflow_name, None)
+        return bot
+
+    def put(self, dataflow_name, bot):
+        """Register an already built bot."""
+        with self._lock:
+            self._bots[dataflow_name] = [bot, time.monotonic()]
+            self._bots.move_to_end(dataflow_name)
+            self._evict()
+
+    def remove(self, dataflow_name):
+        """Drop the bot of the dataflow from the registry. Returns True if there was one."""
+        with self._lock:
+            return self._bots.pop(dataflow_name, None) is not None
+
+    def evict_idle(self):
+        """Evict the bots that have been idle for longer than `idle_timeout`. Returns the evicted dataflow names."""
+        with self._lock:
+            return self._evict()
+
+    def bots(self):
+        """Return the resident bots by dataflow name."""
+        with self._lock:
+            return {name: bot for name, (bot, _) in self._bots.items()}
+
+    def status(self):
+        """Return the resident dataflows and their idle time in seconds, least recently used first."""
+        now = time.monotonic()
+        with self._lock:
+            return {name: round(now - last_used, 1) for name, (_, last_used) in self._bots.items()}
+
+    def __len__(self):
+        with self._lock:
+            return len(self._bots)
+
+    def __contains__(self, dataflow_name):
+        """True if the dataflow has a resident bot that is not past its idle timeout (like `get`)."""
+        with self._lock:
+            entry = self._bots.get(dataflow_name)
+            return entry is not None and time.monotonic() - entry[1] <= self.idle_timeout
+
+    def _evict(self):
+        evicted = {}
+        now = time.monotonic()
+        for name, (_, last_used) in list(self._bots.items()):
+            if now - last_used > self.idle_timeout:
+                evicted[name] = 'idle'
+            elif len(self._bots) > self.max_bots:
+                evicted[name] = 'capacity'
+            else:
+                continue
+            del self._bots[name]
+        _record_evictions(evicted)
+        return list(evicted)
+
+
+def _record_evictions(evicted):
+    """Count the evicted bots (dataflow name -> reason) in METRICS, and log them."""
+    for reason in evicted.values():
+        METRICS.inc('bot_evictions', reason=reason)
+    if evicted:
+        print(f"Evicted bots: {evicted}")
+
+
+class IdleEvictor(threading.Thread):
+    """Evicts the idle bots of a registry every `interval` seconds in the background."""
+
+    def __init__(self, registry, interval=60):
+        super().__init__(name='bot-idle-eviction', daemon=True)
+        self.registry = registry
+        self.interval = interval
+        self._stop_event = threading.Event()
+
+    def start(self):
+        super().start()
+        return self
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            try:
+                self.registry.evict_idle()
+            except Exception as e:
+                METRICS.inc('bot_evictions', reason='error')
+                print(f"Evicting the idle bots failed: {e}")
+
+    def stop(self):
+        self._stop_event.set()
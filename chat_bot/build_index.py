@@ -0,0 +1,203 @@
+"""
+Bulk Catalogue Indexer
+
+Builds the vector store collections of every dataflow in a catalogue file (by default `grouped_edu_dataflows.json`)
+ahead of time, so that "Initialize Bot" only has to pick up a cached collection.
+
+The catalogue is processed in groups of dataflows:
+    1. fetch:   the structures of the group are fetched and parsed concurrently, with a bounded number of workers
+    2. flatten: the dataflows are flattened into question/answer pairs
+    3. embed:   the documents are de-duplicated across the group (dataflows of a category share most of their
+                codelists, e.g. countries, ISCED levels or sex) and embedded in batches of up to `--batch-size` texts;
+                code documents of codelists that were embedded in an earlier group come from the codelist store
+    4. write:   one collection is written per dataflow and registered in the index cache
+
+The finished dataflows are recorded in a state file after every group, so an interrupted run picks up where it stopped.
+Dataflows whose collection is already in the index cache are not embedded again.
+
+Usage:
+    python build_index.py
+    python build_index.py --catalogue grouped_edu_dataflows.json --workers 8 --group-size 10
+    python build_index.py --refresh   # re-fetch everything, only the changed dataflows are re-embedded
+"""
+
+import argparse
+import json
+import os
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+
+from SDMX_DataFlow import Dataflow
+from data_prep_for_indenxing import flatten_info
+from chromaDB import ChromaDBWrapper, get_index_cache, CHROMA_DB_PATH
+from embeddings import get_embedding_function, embed_in_batches, embedding_model_name
+from index_cache import IndexCache
+from codelist_store import CODELISTS
+from grounded_llm import Bot
+
+DEFAULT_CATALOGUE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'grouped_edu_dataflows.json')
+DEFAULT_STATE_FILE = os.path.join(CHROMA_DB_PATH, 'bulk_index_state.json')
+
+
+class StageStats:
+    """Wall clock time and number of processed items per stage."""
+
+    UNITS = {'fetch': 'dataflows', 'flatten': 'documents', 'embed': 'embeddings', 'write': 'documents'}
+
+    def __init__(self):
+        self.seconds = defaultdict(float)
+        self.items = defaultdict(int)
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds[name] += time.perf_counter() - start
+
+    def count(self, name, items):
+        self.items[name] += items
+
+    def report(self):
+        lines = []
+        for name, seconds in self.seconds.items():
+            items = self.items[name]
+            rate = items / seconds if seconds else 0.0
+            lines.append(f"{name:>8}: {items:>8} {self.UNITS.get(name, 'items')} in {seconds:8.2f}s ({rate:10.2f}/s)")
+        return '\n'.join(lines)
+
+
+def load_catalogue(path):
+    """Return the dataflow names of the catalogue file, without duplicates, in catalogue order."""
+    with open(path, encoding='utf-8') as f:
+        categories = json.load(f)
+    return list(dict.fromkeys(name for dataflows in categories.values() for name in dataflows))
+
+
+def load_state(path):
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def save_state(path, state):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(state, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def fetch_dataflow(dataflow_name):
+    df_info = Dataflow(Bot._get_dataflow_url_from_name(dataflow_name))
+    df_info.populate_variables()
+    return df_info
+
+
+def fetch_group(dataflow_names, workers):
+    """Fetch and parse the dataflows with at most `workers` concurrent requests. Returns the successes and the errors."""
+    fetched, errors = {}, {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(fetch_dataflow, name): name for name in dataflow_names}
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                fetched[name] = future.result()
+            except Exception as e:
+                errors[name] = str(e)
+                print(f"Failed to fetch {name}: {e}")
+    # Keep the catalogue order
+    return {name: fetched[name] for name in dataflow_names if name in fetched}, errors
+
+
+def build_catalogue_index(dataflow_names, workers=8, group_size=10, batch_size=2048,
+                          state_file=DEFAULT_STATE_FILE, refresh=False):
+    """Build the collections of the dataflows. Returns the stage statistics and the failed dataflows."""
+    stats = StageStats()
+    index_cache = get_index_cache()
+    # A bulk run should not evict what it has just built, nor should the app afterwards (the cap is in the manifest)
+    index_cache.reserve(len(dataflow_names) + index_cache.default_max_collections)
+    embedding_function = get_embedding_function()
+    state = {} if refresh else load_state(state_file)
+    errors = {}
+
+    todo = [name for name in dataflow_names
+            if name not in state or index_cache.lookup(name, state[name]['content_hash']) is None]
+    print(f"{len(dataflow_names) - len(todo)} of {len(dataflow_names)} dataflows are already indexed.")
+
+    for start in range(0, len(todo), group_size):
+        group = todo[start:start + group_size]
+        print(f"Processing dataflows {start + 1}-{start + len(group)} of {len(todo)}...")
+
+        with stats.stage('fetch'):
+            fetched, group_errors = fetch_group(group, workers)
+        stats.count('fetch', len(fetched))
+        errors.update(group_errors)
+
+        with stats.stage('flatten'):
+            flat_infos = {name: flatten_info(df_info) for name, df_info in fetched.items()}
+        stats.count('flatten', sum(len(flat_info) for flat_info in flat_infos.values()))
+
+        content_hashes = {name: IndexCache.content_hash(flat_info, embedding_model_name(embedding_function))
+                          for name, flat_info in flat_infos.items()}
+        to_build = [name for name in flat_infos if index_cache.lookup(name, content_hashes[name]) is None]
+
+        # Every distinct document text is embedded once, however many dataflows of the group contain it,
+        # and the code documents of codelists embedded by earlier groups are taken from the codelist store
+        with stats.stage('embed'):
+            embeddings = {}
+            for name in to_build:
+                embeddings.update(CODELISTS.shared_embeddings(fetched[name]))
+            texts = list(dict.fromkeys(str(question) for name in to_build for question, _ in flat_infos[name]
+                                       if str(question) not in embeddings))
+            embeddings.update(zip(texts, embed_in_batches(texts, embedding_function, batch_size, workers=workers)))
+            for name in to_build:
+                CODELISTS.share_embeddings(fetched[name], embeddings)
+        stats.count('embed', len(texts))
+
+        with stats.stage('write'):
+            for name in flat_infos:
+                ChromaDBWrapper(  flat_infos[name]
+                                , dataflow_name=name
+                                , index_cache=index_cache
+                                , precomputed_embeddings=embeddings
+                                , embedding_function=embedding_function)
+                state[name] = {'content_hash': content_hashes[name], 'finished': time.time()}
+        stats.count('write', sum(len(flat_infos[name]) for name in to_build))
+
+        save_state(state_file, state)
+
+    return stats, errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Pre-build the vector stores of every dataflow in the catalogue.')
+    parser.add_argument('--catalogue', default=DEFAULT_CATALOGUE, help='JSON file of categories -> dataflow names')
+    parser.add_argument('--workers', type=int, default=8, help='number of concurrent structure requests')
+    parser.add_argument('--group-size', type=int, default=10, help='number of dataflows processed (and checkpointed) together')
+    parser.add_argument('--batch-size', type=int, default=2048, help='maximum number of texts per embedding request')
+    parser.add_argument('--state-file', default=DEFAULT_STATE_FILE, help='progress file used to resume an interrupted run')
+    parser.add_argument('--refresh', action='store_true', help='ignore the progress file and re-check every dataflow')
+    args = parser.parse_args()
+
+    dataflow_names = load_catalogue(args.catalogue)
+    start = time.perf_counter()
+    stats, errors = build_catalogue_index(  dataflow_names
+                                          , workers=args.workers
+                                          , group_size=args.group_size
+                                          , batch_size=args.batch_size
+                                          , state_file=args.state_file
+                                          , refresh=args.refresh)
+    print(stats.report())
+    print(f"Finished in {time.perf_counter() - start:.2f}s, {len(errors)} dataflows failed.")
+    for name, error in errors.items():
+        print(f"  {name}: {error}")
+
+
+if __name__ == '__main__':
+    main()
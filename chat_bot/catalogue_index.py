@@ -0,0 +1,470 @@
+"""
+Catalogue Index Module
+
+One index of the documents of every dataflow of the catalogue, with a router that picks the dataflows a question is
+about, so that questions like "Which table has teacher salaries?" can be answered without selecting a dataflow and
+without building a bot (and a vector store) per dataflow.
+
+Key Features:
+- Every distinct document is stored (and embedded) once, however many dataflows contain it: the dataflows of a
+  category share most of their codelists (countries, ISCED levels, sex, ...), so the index grows with the unique
+  content, not with dataflows x documents
+- The dataflows, categories and dimension of a document are filterable metadata: a dataflow is an array of the
+  indices of its documents, a document has the index of its dimension
+- `DataflowRouter`: BM25 over the names, descriptions and categories of the dataflows, a few microseconds per question
+- Filtered retrieval: the question is only compared with the documents of the routed dataflows
+- Built offline (`python catalogue_index.py`), opened memory-mapped: nothing is built at query time
+
+Usage:
+    ```python
+    index = CatalogueIndex.load()
+    index.router.route('Which table has teacher salaries?', k=3)        # [(dataflow name, score), ...]
+    index.query('What is the salary of teachers?', dataflows=[...], n_results=10)
+
+    bot = CatalogueBot(index)
+    bot.answer('Which table has teacher salaries?')  # {'answer': ..., 'dataflows': [{'dataflow': ..., 'score': ...}]}
+    ```
+
+    python catalogue_index.py                          # build the index of grouped_edu_dataflows.json
+    python catalogue_index.py --catalogue my.json      # of another catalogue
+
+Configuration (environment variables):
+    CATALOGUE_INDEX_PATH: directory of the index files (default: .catalogue_index)
+    CATALOGUE_ROUTED_DATAFLOWS: the number of dataflows a question is routed to (default: 3)
+"""
+
+import argparse
+import hashlib
+import json
+import math
+import os
+import re
+import threading
+import time
+from collections import Counter
+
+import numpy as np
+
+import LLM
+from chromaDB import document_id
+from codelist_store import CODELISTS
+from context_builder import ContextBuilder
+from data_prep_for_indenxing import flatten_info_by_dimension
+from embeddings import get_embedding_function, embed_in_batches, embedding_model_name
+from metrics import METRICS, dataflow_context
+
+CATALOGUE_INDEX_PATH = os.getenv('CATALOGUE_INDEX_PATH', '.catalogue_index')
+CATALOGUE_ROUTED_DATAFLOWS = int(os.getenv('CATALOGUE_ROUTED_DATAFLOWS', 3))
+DEFAULT_CATALOGUE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'grouped_edu_dataflows.json')
+
+# The words that say nothing about which table a question is about
+STOPWORDS = frozenset(('a', 'an', 'and', 'are', 'by', 'can', 'data', 'dataflow', 'dataflows', 'do', 'does', 'find', 'for',
+                       'has', 'have', 'how', 'i', 'in', 'is', 'it', 'many', 'me', 'much', 'of', 'on', 'or', 'show',
+                       'table', 'tables', 'that', 'the', 'there', 'to', 'what', 'where', 'which', 'who', 'with'))
+
+
+def tokenize(text):
+    """Lower-cased words without the stop words, with a crude singular form (salaries -> salary, teachers -> teacher)."""
+    tokens = []
+    for word in re.findall(r'[a-z0-9]+', str(text).casefold().replace('_', ' ')):
+        if word in STOPWORDS:
+            continue
+        if len(word) > 4 and word.endswith('ies'):
+            word = word[:-3] + 'y'
+        elif len(word) > 3 and word.endswith('s') and not word.endswith('ss'):
+            word = word[:-1]
+        tokens.append(word)
+    return tokens
+
+
+class DataflowRouter:
+    """BM25 over a short text per dataflow: its name, description, category and identifier."""
+
+    def __init__(self, texts, k1=1.2, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.term_frequencies = [Counter(tokenize(text)) for text in texts]
+        lengths = np.array([sum(frequencies.values()) for frequencies in self.term_frequencies], dtype=np.float64)
+        self.length_norm = k1 * (1 - b + b * lengths / max(lengths.mean(), 1.0)) if len(lengths) else lengths
+        document_frequencies = Counter(term for frequencies in self.term_frequencies for term in frequencies)
+        n = len(texts)
+        self.idf = {term: math.log(1 + (n - df + 0.5) / (df + 0.5)) for term, df in document_frequencies.items()}
+        # term -> [(dataflow position, frequency)], so that a question only touches the dataflows that share a word
+        self.postings = {}
+        for i, frequencies in enumerate(self.term_frequencies):
+            for term, frequency in frequencies.items():
+                self.postings.setdefault(term, []).append((i, frequency))
+
+    def scores(self, question):
+        scores = np.zeros(len(self.term_frequencies))
+        for term in set(tokenize(question)):
+            idf = self.idf.get(term)
+            if idf is None:
+                continue
+            for i, frequency in self.postings[term]:
+                scores[i] += idf * frequency * (self.k1 + 1) / (frequency + self.length_norm[i])
+        return scores
+
+    def route(self, question, k=CATALOGUE_ROUTED_DATAFLOWS):
+        """The positions and scores of the (at most) `k` best matching dataflows; empty if no word matches."""
+        scores = self.scores(question)
+        best = [i for i in np.argsort(-scores, kind='stable')[:k] if scores[i] > 0]
+        return [(int(i), float(scores[i])) for i in best]
+
+
+class CatalogueIndex:
+    """The unique documents of the catalogue, their embeddings and which dataflows (and dimension) they belong to."""
+
+    FILES = ('matrix', 'doc_text', 'doc_answer', 'doc_dimension', 'dataflow_docs', 'dataflow_offsets')
+
+    def __init__(self, meta, arrays, embedding_function=None):
+        self.meta = meta
+        self.dataflows = meta['dataflows']            # [{'name', 'title', 'description', 'categories'}]
+        self.texts = meta['texts']                    # the distinct embedded texts (the questions)
+        self.answers = meta['answers']                # the distinct answers
+        self.dimensions = meta['dimensions']          # the distinct dimension ids
+        self.positions = {dataflow['name']: i for i, dataflow in enumerate(self.dataflows)}
+
+        self.matrix = arrays['matrix']                # (texts, dimensions) normalized float32
+        self.doc_text = arrays['doc_text']            # document -> row of the matrix
+        self.doc_answer = arrays['doc_answer']        # document -> answer
+        self.doc_dimension = arrays['doc_dimension']  # document -> dimension (-1: about the whole table)
+        self.dataflow_docs = arrays['dataflow_docs']  # the sorted documents of every dataflow, one after the other
+        self.dataflow_offsets = arrays['dataflow_offsets']
+
+        self.embedding_function = embedding_function or get_embedding_function()
+        if meta['embedding_model'] != embedding_model_name(self.embedding_function):
+            raise ValueError(f"The catalogue index was built with {meta['embedding_model']}, "
+                             f"not with {embedding_model_name(self.embedding_function)}")
+        self.router = DataflowRouter([' '.join([dataflow['title'], dataflow['description'], *dataflow['categories'],
+                                                dataflow['name'].split(':')[-1].split('(')[0]])
+                                      for dataflow in self.dataflows])
+
+    @classmethod
+    def build(cls, catalogue, dataflows, embedding_function=None, path=CATALOGUE_INDEX_PATH, workers=4):
+        """
+        Index the dataflows (name -> Dataflow or CompactDataflow) of the catalogue (category -> dataflow names),
+        embedding every distinct text once, and save the index.
+        """
+        embedding_function = embedding_function or get_embedding_function()
+        categories = {}
+        for category, names in catalogue.items():
+            for name in names:
+                categories.setdefault(name, []).append(category)
+
+        texts, answers, dimensions = {}, {}, {}   # value -> position
+        documents = {}                            # document id -> (text, answer, dimension)
+        members, described = [], []
+        for name, df_info in dataflows.items():
+            own = set()
+            for dimension, pairs in flatten_info_by_dimension(df_info).items():
+                for question, answer in pairs:
+                    id_ = document_id(question, answer)
+                    if id_ not in documents:
+                        documents[id_] = (  texts.setdefault(str(question), len(texts))
+                                          , answers.setdefault(str(answer), len(answers))
+                                          , -1 if dimension is None else dimensions.setdefault(dimension, len(dimensions)))
+                    own.add(id_)
+            members.append(own)
+            described.append({'name': name, 'title': str(df_info.df_name), 'description': str(df_info.df_description),
+                              'categories': categories.get(name, [])})
+
+        positions = {id_: i for i, id_ in enumerate(documents)}
+        rows = np.array(list(documents.values()), dtype=np.int64).reshape(-1, 3)
+        dataflow_docs = [np.sort(np.fromiter((positions[id_] for id_ in own), dtype=np.uint32, count=len(own)))
+                         for own in members]
+
+        # The code documents of codelists embedded before (e.g. by the bots of this process) are not embedded again
+        known = {}
+        for df_info in dataflows.values():
+            known.update(CODELISTS.shared_embeddings(df_info))
+        text_list = list(texts)
+        missing = [text for text in text_list if text not in known]
+        with METRICS.timer('embed'):
+            known.update(zip(missing, embed_in_batches(missing, embedding_function, workers=workers)))
+        matrix = np.asarray([known[text] for text in text_list], dtype=np.float32)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        matrix = matrix / np.where(norms == 0, 1.0, norms)
+
+        meta = {  'embedding_model': embedding_model_name(embedding_function)
+                , 'content_hash': cls.content_hash(dataflows)
+                , 'built': time.time()
+                , 'embedded': len(missing)
+                , 'dataflows': described
+                , 'texts': text_list
+                , 'answers': list(answers)
+                , 'dimensions': list(dimensions)}
+        arrays = {  'matrix': matrix
+                  , 'doc_text': rows[:, 0].astype(np.uint32)
+                  , 'doc_answer': rows[:, 1].astype(np.uint32)
+                  , 'doc_dimension': rows[:, 2].astype(np.int32)
+                  , 'dataflow_docs': np.concatenate(dataflow_docs) if dataflow_docs else np.zeros(0, dtype=np.uint32)
+                  , 'dataflow_offsets': np.cumsum([0] + [len(docs) for docs in dataflow_docs]).astype(np.int64)}
+        cls.save(path, meta, arrays)
+        return cls.load(path, embedding_function)
+
+    @staticmethod
+    def content_hash(dataflows):
+        digest = hashlib.sha256()
+        for name, df_info in dataflows.items():
+            digest.update(name.encode('utf-8'))
+            for dimension, pairs in flatten_info_by_dimension(df_info).items():
+                digest.update(json.dumps([dimension, [[str(q), str(a)] for q, a in pairs]], ensure_ascii=False).encode('utf-8'))
+        return digest.hexdigest()
+
+    @classmethod
+    def save(cls, path, meta, arrays):
+        # Written next to each other and renamed, so that a reader never sees a half-written index
+        os.makedirs(path, exist_ok=True)
+        suffix = f'.{os.getpid()}.tmp'
+        for name in cls.FILES:
+            with open(os.path.join(path, f'{name}.npy{suffix}'), 'wb') as f:
+                np.save(f, arrays[name])
+        with open(os.path.join(path, f'catalogue.json{suffix}'), 'w', encoding='utf-8') as f:
+            json.dump(meta, f, ensure_ascii=False)
+        for name in [f'{name}.npy' for name in cls.FILES] + ['catalogue.json']:
+            os.replace(os.path.join(path, name + suffix), os.path.join(path, name))
+
+    @classmethod
+    def load(cls, path=CATALOGUE_INDEX_PATH, embedding_function=None):
+        """
+        Open a built index (the arrays memory-mapped). Raises FileNotFoundError if it has not been built, ValueError if
+        it was built with another embedding model.
+        """
+        with open(os.path.join(path, 'catalogue.json'), encoding='utf-8') as f:
+            meta = json.load(f)
+        arrays = {name: np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r') for name in cls.FILES}
+        return cls(meta, arrays, embedding_function)
+
+    def documents_of(self, position):
+        return self.dataflow_docs[self.dataflow_offsets[position]:self.dataflow_offsets[position + 1]]
+
+    def candidates(self, dataflows=None, categories=None, dimensions=None):
+        """The documents matching the filters (None: no filter), sorted."""
+        positions = None
+        if dataflows is not None:
+            positions = {self.positions[name] for name in dataflows if name in self.positions}
+        if categories is not None:
+            in_categories = {i for i, dataflow in enumerate(self.dataflows) if set(dataflow['categories']) & set(categories)}
+            positions = in_categories if positions is None else positions & in_categories
+
+        if positions is None:
+            documents = np.arange(len(self.doc_text), dtype=np.uint32)
+        elif positions:
+            documents = np.unique(np.concatenate([self.documents_of(i) for i in sorted(positions)]))
+        else:
+            documents = np.zeros(0, dtype=np.uint32)
+
+        if dimensions is not None:
+            wanted = [self.dimensions.index(dimension) for dimension in dimensions if dimension in self.dimensions]
+            documents = documents[np.isin(self.doc_dimension[documents], wanted)]
+        return documents
+
+    def search(self, query_embeddings, n_results=3, dataflows=None, categories=None, dimensions=None):
+        """Chroma-shaped result sets of the nearest documents among the ones matching the filters."""
+        documents = self.candidates(dataflows, categories, dimensions)
+        queries = np.asarray(query_embeddings, dtype=np.float32).reshape(len(query_embeddings), -1)
+        queries = queries / np.where((norms := np.linalg.norm(queries, axis=1, keepdims=True)) == 0, 1.0, norms)
+        n_results = min(n_results, len(documents))
+
+        result_sets = {'ids': [], 'documents': [], 'metadatas': [], 'distances': []}
+        if n_results == 0:
+            for key in result_sets:
+                result_sets[key] = [[] for _ in range(len(queries))]
+            return result_sets
+
+        # One product over the distinct texts, then the columns of the candidates: indexing the matrix by the
+        # candidates would copy a (candidates, dimensions) block on every query
+        similarities = (queries @ self.matrix.T)[:, self.doc_text[documents]]  # (queries, candidate documents)
+        top = np.argpartition(-similarities, n_results - 1, axis=1)[:, :n_results]
+        top_similarities = np.take_along_axis(similarities, top, axis=1)
+        order = np.argsort(-top_similarities, axis=1)
+        top = np.take_along_axis(top, order, axis=1)
+        distances = np.maximum(2.0 - 2.0 * np.take_along_axis(top_similarities, order, axis=1), 0.0)
+
+        allowed = None if dataflows is None else set(dataflows)
+        for row, row_distances in zip(top, distances):
+            docs = documents[row]
+            result_sets['ids'].append([str(int(doc)) for doc in docs])
+            result_sets['documents'].append([self.texts[self.doc_text[doc]] for doc in docs])
+            result_sets['metadatas'].append([self.metadata(doc, allowed) for doc in docs])
+            result_sets['distances'].append(row_distances.tolist())
+        return result_sets
+
+    def metadata(self, doc, allowed_dataflows=None):
+        dimension = int(self.doc_dimension[doc])
+        members = [dataflow['name'] for i, dataflow in enumerate(self.dataflows)
+                   if (allowed_dataflows is None or dataflow['name'] in allowed_dataflows) and self._contains(i, doc)]
+        return {  'answer': self.answers[self.doc_answer[doc]]
+                , 'dimension': None if dimension < 0 else self.dimensions[dimension]
+                , 'dataflows': members}
+
+    def _contains(self, position, doc):
+        documents = self.documents_of(position)
+        i = np.searchsorted(documents, doc)
+        return i < len(documents) and documents[i] == doc
+
+    def query(self, query_text, n_results=3, **filters):
+        return self.query_many([query_text], n_results=n_results, **filters)
+
+    def query_many(self, query_texts, n_results=3, **filters):
+        with METRICS.timer('retrieve'):
+            return self.search(self.embedding_function(list(query_texts)), n_results=n_results, **filters)
+
+    def stats(self):
+        """The size of the index, and the number of documents one collection per dataflow would hold."""
+        return {  'dataflows': len(self.dataflows)
+                , 'documents': len(self.doc_text)
+                , 'embedded_texts': len(self.texts)
+                , 'documents_per_dataflow_total': int(len(self.dataflow_docs))
+                , 'matrix_bytes': int(self.matrix.nbytes)
+                , 'membership_bytes': int(self.dataflow_docs.nbytes + self.doc_text.nbytes + self.doc_answer.nbytes
+                                          + self.doc_dimension.nbytes)}
+
+
+class CatalogueBot:
+    """Answers questions about the whole catalogue: routes the question to a few dataflows and searches only those."""
+
+    # Documents retrieved per question (see Bot.RETRIEVAL_CANDIDATES)
+    RETRIEVAL_CANDIDATES = 10
+
+    def __init__(self, index, routed_dataflows=CATALOGUE_ROUTED_DATAFLOWS):
+        self.index = index
+        self.routed_dataflows = routed_dataflows
+        self.context_builder = ContextBuilder()
+
+    def route(self, question):
+        """The dataflows the question is most likely about, best first."""
+        with METRICS.timer('route'):
+            routes = self.index.router.route(question, k=self.routed_dataflows)
+        return [{**self.index.dataflows[i], 'score': score} for i, score in routes]
+
+    def answer_question(self, user_question):
+        return self.answer(user_question)['answer']
+
+    def answer(self, user_question):
+        with dataflow_context('catalogue'), METRICS.timer('answer'):
+            routes = self.route(user_question)
+
+            # The same rephrasing as the bots of single dataflows
+            from grounded_llm import Bot
+            with METRICS.timer('rephrase'):
+                rephrased_question, rephrase_cost = LLM.model(*Bot._rephrase_prompt(user_question))
+
+            if routes:
+                result_sets = self.index.query(  rephrased_question
+                                               , n_results=self.RETRIEVAL_CANDIDATES
+                                               , dataflows=[route['name'] for route in routes])
+            else:
+                # No word of the question is in the names or descriptions: search the whole catalogue, and take the
+                # dataflows of the closest documents
+                result_sets = self.index.query(rephrased_question, n_results=self.RETRIEVAL_CANDIDATES)
+                found = dict.fromkeys(name for metadata in result_sets['metadatas'][0] for name in metadata['dataflows'])
+                routes = [{**self.index.dataflows[self.index.positions[name]], 'score': 0.0}
+                          for name in list(found)[:self.routed_dataflows]]
+            METRICS.inc('catalogue_routes', routed='lexical' if routes and routes[0]['score'] > 0 else 'semantic')
+
+            persona, prompt = self._answer_prompt(user_question, routes, result_sets)
+            with METRICS.timer('generate'):
+                ans, cost = LLM.model(persona, prompt)
+
+        return {  'answer': ans
+                , 'dataflows': [{'dataflow': route['name'], 'title': route['title'], 'categories': route['categories'],
+                                 'score': route['score']} for route in routes]
+                , 'cost': rephrase_cost + cost}
+
+    def _answer_prompt(self, user_question, routes, result_sets):
+        tables = '\n'.join(f"- {route['title']} ({route['name']}): {route['description']}" for route in routes)
+        context = self.context_builder.build(result_sets)
+        persona = """You are a helpful data analyst working for OECD."""
+        prompt = f"""
+        Please provide the answer to the following user question about the OECD education statistics:
+        {user_question}
+        These are the tables (DataFlows) that are the most likely to be relevant, best match first:
+{tables}
+        The information in your knowledgebase about these tables that corresponds most to the question is (closest first):
+        '''
+{context}
+        '''
+
+        Please name the table(s) (with their DataFlow ID) that your answer is based on.
+        Very important: Not having any relevant information in your knowledgebase related to the user's question is likely and acceptable. So, please make sure to:
+            - ask for clarification, if the question is not clear.
+            - let the user know if you don't have relevant information in your knowledgebase.
+        """
+        return persona, prompt
+
+
+_catalogue_bot = None
+_catalogue_bot_version = None
+_catalogue_bot_error = None
+_catalogue_bot_lock = threading.Lock()
+
+
+def get_catalogue_bot(path=CATALOGUE_INDEX_PATH):
+    """
+    The process-wide bot of the catalogue index, opened on first use; None if the index has not been built or cannot
+    be used (e.g. it was built with another embedding model), see `catalogue_bot_error`. The index is opened again
+    when its files have been rewritten (its catalogue.json is replaced last, see `CatalogueIndex.save`), so a rebuilt
+    index is picked up.
+    """
+    global _catalogue_bot, _catalogue_bot_version, _catalogue_bot_error
+    try:
+        stat = os.stat(os.path.join(path, 'catalogue.json'))
+        version = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+    except FileNotFoundError:
+        version = None
+    with _catalogue_bot_lock:
+        if _catalogue_bot is None or version != _catalogue_bot_version:
+            _catalogue_bot = None
+            try:
+                _catalogue_bot = CatalogueBot(CatalogueIndex.load(path))
+            except (FileNotFoundError, ValueError) as e:
+                if isinstance(e, ValueError) and str(e) != str(_catalogue_bot_error):
+                    print(f"The catalogue index cannot be used: {e}")
+                _catalogue_bot_error = e
+                return None
+            _catalogue_bot_version, _catalogue_bot_error = version, None
+        return _catalogue_bot
+
+
+def catalogue_bot_error():
+    """Why the last `get_catalogue_bot` returned None: FileNotFoundError (not built) or ValueError (unusable)."""
+    return _catalogue_bot_error
+
+
+def main():
+    from build_index import load_catalogue, fetch_group
+    from compact_dataflow import SNAPSHOTS
+
+    parser = argparse.ArgumentParser(description='Build the single index of every dataflow of the catalogue.')
+    parser.add_argument('--catalogue', default=DEFAULT_CATALOGUE, help='JSON file of categories -> dataflow names')
+    parser.add_argument('--output', default=CATALOGUE_INDEX_PATH, help='directory of the index files')
+    parser.add_argument('--snapshot', default=os.getenv('SDMX_SNAPSHOT'), help='take the dataflows from this snapshot')
+    parser.add_argument('--workers', type=int, default=8, help='number of concurrent structure / embedding requests')
+    args = parser.parse_args()
+
+    with open(args.catalogue, encoding='utf-8') as f:
+        catalogue = json.load(f)
+    names = load_catalogue(args.catalogue)
+
+    start = time.perf_counter()
+    if args.snapshot:
+        SNAPSHOTS.load(args.snapshot)
+    dataflows = {name: SNAPSHOTS.get(name) for name in names if name in SNAPSHOTS}
+    fetched, errors = fetch_group([name for name in names if name not in dataflows], args.workers)
+    dataflows.update(fetched)
+    dataflows = {name: dataflows[name] for name in names if name in dataflows}
+
+    index = CatalogueIndex.build(catalogue, dataflows, path=args.output, workers=args.workers)
+    stats = index.stats()
+    print(f"Indexed {stats['dataflows']} dataflows in {time.perf_counter() - start:.2f}s: {stats['documents']} distinct "
+          f"documents ({stats['documents_per_dataflow_total']} in per-dataflow collections), "
+          f"{stats['embedded_texts']} embedded texts ({index.meta['embedded']} new), "
+          f"{stats['matrix_bytes'] / 2**20:.1f} MB of embeddings")
+    for name, error in errors.items():
+        print(f"  {name}: {error}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,38 +1,113 @@
 import chromadb
-from chromadb.utils import embedding_functions
 from chromadb.config import Settings
-from uuid import uuid4 as uuid
-import os
-from dotenv import load_dotenv
+import hashlib
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from index_cache import IndexCache
+from metrics import METRICS
+from embeddings import (get_embedding_function, embed_with_backoff, embedding_model_name, chunk_by_token_budget,
+                        RateLimitBackoff, MAX_TOKENS_PER_REQUEST)
+
+CHROMA_DB_PATH = '.chroma.db'
+
+_clients = {}
+_index_caches = {}
+_lock = threading.Lock()
+
+
+def get_client(path=CHROMA_DB_PATH):
+    """Return the (process-wide) ChromaDB persistent client for the given path."""
+    with _lock:
+        if path not in _clients:
+            _clients[path] = chromadb.PersistentClient(settings=Settings(anonymized_telemetry=False), path=path)
+        return _clients[path]
+
+
+def get_index_cache(path=CHROMA_DB_PATH, max_collections=20):
+    """Return the (process-wide) index cache of the collections stored at the given path."""
+    client = get_client(path)
+    with _lock:
+        if path not in _index_caches:
+            _index_caches[path] = IndexCache(client, path=path, max_collections=max_collections)
+        return _index_caches[path]
+
+
+def document_id(question, answer):
+    """Deterministic ID of a question/answer pair: re-running an ingest finds the rows that are already there."""
+    return hashlib.sha256(f'{question}\x00{answer}'.encode('utf-8')).hexdigest()[:32]
+
 
 class ChromaDBWrapper:
     def __init__(  self
                  , flat_info_for_embedding
                  , openai_api_key=None
-                 , collection_name="dataflow-meta-information-embeddings"):
+                 , collection_name="dataflow-meta-information-embeddings"
+                 , dataflow_name=None
+                 , index_cache=None
+                 , precomputed_embeddings=None
+                 , embedding_function=None
+                 , workers=4
+                 , max_tokens_per_request=MAX_TOKENS_PER_REQUEST
+                 , ingest=True):
+        """
+        With `ingest=False` the collection is only opened: the caller adds the documents (possibly in stages, with
+        `add_data_to_collection(flat_info=...)`) and calls `complete()` at the end. A cached collection is complete.
+        """
         self.flat_info_for_embedding = flat_info_for_embedding
+        # Optional mapping of document text -> embedding, e.g. from a bulk indexing run
+        self.precomputed_embeddings = precomputed_embeddings or {}
+        self.computed_embeddings = {}
         self.collection_name = collection_name
-        
-        load_dotenv()
-        if openai_api_key is None:
-            openai_api_key = os.getenv('OPENAI_API_KEY')
+        self.from_cache = False
+        self.workers = workers
+        self.max_tokens_per_request = max_tokens_per_request
+        self.dataflow_name = dataflow_name
+        self.index_cache = index_cache
+        self.content_hash = None
         
         # Initialize ChromaDB client
-        self.client = chromadb.PersistentClient(settings=Settings(anonymized_telemetry=False), path='.chroma.db')
-        
-        # Set up embedding function
-        self.embedding_function = embedding_functions.OpenAIEmbeddingFunction(
-            model_name='text-embedding-3-small',
-            api_key=openai_api_key
-        )
+        self.client = get_client()
         
-        # Create or get the collection
-        self.create_collection()
+        # Set up embedding function (pluggable, e.g. a deterministic local fake for tests and benchmarks)
+        self.embedding_function = embedding_function or get_embedding_function(openai_api_key)
+
+        # Every dataflow gets its own collection, so that bots of different dataflows do not overwrite each other
+        if dataflow_name is not None:
+            content_hash = IndexCache.content_hash(flat_info_for_embedding, embedding_model_name(self.embedding_function))
+            self.collection_name = IndexCache.collection_name(dataflow_name, content_hash)
+            self.content_hash = content_hash
+
+        # Reuse the collection of an unchanged dataflow, if we have already embedded it
+        if index_cache is not None and dataflow_name is not None:
+            cached_collection_name = index_cache.lookup(dataflow_name, content_hash)
+            if cached_collection_name is not None:
+                self.collection_name = cached_collection_name
+                self.collection = self.client.get_collection(name=self.collection_name, embedding_function=self.embedding_function)
+                self.from_cache = True
+                print(f"Reusing cached collection {self.collection_name} for {dataflow_name}")
+                return
+
+        # Create or get the collection. A content-addressed collection that exists but is not in the index cache
+        # is the leftover of an interrupted ingest: it is resumed instead of being rebuilt from scratch.
+        self.create_collection(resume=dataflow_name is not None)
         
         # Add data to the collection
-        self.add_data_to_collection()
+        if ingest:
+            self.add_data_to_collection()
+            self.complete()
+
+    def complete(self):
+        """Register the fully ingested collection in the index cache."""
+        if self.index_cache is not None and self.dataflow_name is not None and not self.from_cache:
+            self.index_cache.register(self.dataflow_name, self.content_hash, self.collection_name)
+
+    def create_collection(self, resume=False):
+        if resume:
+            self.collection = self.client.get_or_create_collection(name=self.collection_name, embedding_function=self.embedding_function)
+            print(f"Collection {self.collection_name} opened with {self.collection.count()} documents")
+            return
 
-    def create_collection(self):
         # # Clear the collection if it already exists
         try:
             self.client.get_collection(name=self.collection_name, embedding_function=self.embedding_function)
@@ -43,24 +118,83 @@ class ChromaDBWrapper:
         print(f"Collection {self.collection_name} created successfully")
 
 
-    def add_data_to_collection(self):
-        ids = []
-        documents = []
-        metadatas = []
+    def add_data_to_collection(self, progress_callback=None, flat_info=None):
+        """
+        Embed and write the documents in chunks, each chunk as soon as its embeddings are ready.
+
+        The chunks stay within the per-request token budget of the embedding API and are embedded by a pool of
+        workers, backing off together on rate-limit errors. Rows have deterministic IDs, so the rows that are
+        already in the collection (e.g. from an interrupted ingest) are skipped.
+        `progress_callback(done, total)` is called after every chunk written.
+        `flat_info` is the part of the documents to add (default: all of them).
+        """
+        rows = {}
+        for question, answer in (self.flat_info_for_embedding if flat_info is None else flat_info):
+            rows.setdefault(document_id(question, answer), (str(question), {"answer": answer}))
+
+        existing_ids = self._existing_ids(list(rows))
+        todo = [id_ for id_ in rows if id_ not in existing_ids]
+        if existing_ids:
+            print(f"{len(existing_ids)} documents are already in the vector store, skipping them.")
 
-        for question, answer in self.flat_info_for_embedding:
-            ids.append(str(uuid()))
-            documents.append(str(question))
-            metadatas.append({"answer": answer})
+        # Only the documents that actually have to be embedded count towards the token budget of a chunk
+        chunks, start = [], 0
+        for documents in chunk_by_token_budget(  [rows[id_][0] for id_ in todo]
+                                               , max_tokens=self.max_tokens_per_request
+                                               , precomputed=self.precomputed_embeddings):
+            chunks.append(todo[start:start + len(documents)])
+            start += len(documents)
 
-        to_vectorize = {'ids': ids, 'documents': documents, 'metadatas': metadatas}
-        self.collection.add(**to_vectorize)
-        print(f"{len(ids)} embeddings created from documents were and added to the vector store.")
+        backoff = RateLimitBackoff()
+        computed_lock = threading.Lock()
+
+        def embed_chunk(chunk):
+            documents = [rows[id_][0] for id_ in chunk]
+            missing = list(dict.fromkeys(document for document in documents if document not in self.precomputed_embeddings))
+            computed = {}
+            if missing:
+                with METRICS.timer('embed'):
+                    computed = dict(zip(missing, embed_with_backoff(missing, self.embedding_function, backoff)))
+            with computed_lock:
+                self.computed_embeddings.update(computed)
+            return [computed[document] if document in computed else self.precomputed_embeddings[document] for document in documents]
+
+        done = 0
+        with ThreadPoolExecutor(max_workers=max(1, self.workers)) as executor:
+            futures = {executor.submit(embed_chunk, chunk): chunk for chunk in chunks}
+            for future in as_completed(futures):
+                chunk = futures[future]
+                # The writes happen on this thread, one chunk at a time
+                self.collection.upsert(  ids=chunk
+                                       , documents=[rows[id_][0] for id_ in chunk]
+                                       , metadatas=[rows[id_][1] for id_ in chunk]
+                                       , embeddings=future.result())
+                done += len(chunk)
+                if progress_callback is not None:
+                    progress_callback(done, len(todo))
+
+        print(f"{done} embeddings created from documents were and added to the vector store.")
+
+    def _existing_ids(self, ids, batch_size=5000):
+        existing = set()
+        for start in range(0, len(ids), batch_size):
+            existing.update(self.collection.get(ids=ids[start:start + batch_size], include=[])['ids'])
+        return existing
 
     def query(self, query_text, n_results=3):
-        result_sets = self.collection.query(query_texts=[query_text], n_results=n_results)
+        with METRICS.timer('retrieve'):
+            result_sets = self.collection.query(query_texts=[query_text], n_results=n_results)
         return result_sets
 
+    def query_many(self, query_texts, n_results=3):
+        """Search several queries at once; the result sets have one list per query."""
+        with METRICS.timer('retrieve'):
+            return self.collection.query(query_texts=list(query_texts), n_results=n_results)
+
+    async def aquery(self, query_text, n_results=3):
+        # Chroma has no async API: embed and search in a worker thread to keep the event loop free
+        return await asyncio.to_thread(self.query, query_text, n_results)
+
 # Example usage:
 if __name__ == "__main__":
     # Assuming flat_info_for_embedding is defined
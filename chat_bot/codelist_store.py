@@ -0,0 +1,187 @@
+"""
+Codelist Store Module
+
+A process-wide registry of the SDMX codelists, shared by every dataflow.
+
+Many OECD dataflows reference the same codelists (countries, ISCED levels, sex, ...). Instead of every `Dataflow`
+keeping its own copy of them, the codes and names of a codelist are stored once, keyed by the (agency, id, version)
+triple of its URN, and the dataflows hold references to the shared dictionaries. The embeddings of the code documents
+produced by `flatten_codes` are shared the same way, so a codelist is only embedded once per process, whichever
+dataflow collection it ends up in. The embeddings are keyed by the document text: the code and name documents are
+shared by every dataflow using the codelist, the two question documents of a code name the dimension ID, so they are
+only shared by dataflows with the same dimension ID for the codelist (the usual case: CL_AREA is REF_AREA everywhere).
+The shared embeddings are capped (CODELIST_EMBEDDINGS_MAX vectors): the ones of the least recently used codelists
+are dropped first.
+
+The streaming parser only collects the constrained codes of a codelist: these partial codelists are interned too
+(`intern_partial`), and so are the constrained subsets of the dimensions (`subset`), so that the dataflows with the
+same content constraint hold the same dictionary.
+
+Usage:
+    ```python
+    codes = CODELISTS.intern(urn, ((code['id'], code['name']) for code in codelist['codes']))
+    codes = CODELISTS.intern_partial(urn, constrained_codes_and_names)   # the complete codelist, if it is known
+    CODELISTS.subset(urn, codes, ['FRA', 'DEU'])  # {code: name} of the constrained codes, in this order
+    CODELISTS.shared_embeddings(df_info)           # document text -> embedding, for the codelists of the dataflow
+    CODELISTS.share_embeddings(df_info, computed)  # remember the newly computed code document embeddings
+    ```
+
+Configuration (environment variables):
+    CODELIST_EMBEDDINGS_MAX: the most shared code document embeddings kept (default: 20000, ~120 MB at 1536 dimensions)
+"""
+
+import hashlib
+import os
+import re
+import sys
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from data_prep_for_indenxing import flatten_codes_of_dimension
+
+# e.g. urn:sdmx:org.sdmx.infomodel.codelist.Codelist=OECD.SDD.TPS:CL_AREA(1.0)
+URN_PATTERN = re.compile(r'=(?P<agency>[^:]+):(?P<id>[^(]+)\((?P<version>[^)]+)\)$')
+
+CODELIST_EMBEDDINGS_MAX = int(os.getenv('CODELIST_EMBEDDINGS_MAX', 20000))
+
+
+class CodelistStore:
+    """Interned codelists and the embeddings of their code documents."""
+
+    def __init__(self, max_embeddings=CODELIST_EMBEDDINGS_MAX):
+        self._codelists = {}   # (agency, id, version) -> {code: name}
+        self._partial = {}     # (agency, id, version) -> {code: name} of the codes collected so far (streaming)
+        self._subsets = {}     # ((agency, id, version), digest of the codes) -> {code: name} of constrained codes
+        # (agency, id, version) -> {document text: embedding}, least recently used first
+        self._embeddings = OrderedDict()
+        self._embedding_count = 0
+        self.max_embeddings = max_embeddings
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key_from_urn(urn):
+        """Return the (agency, id, version) key of a codelist URN. Unparsable URNs are used as they are."""
+        match = URN_PATTERN.search(urn)
+        if match is None:
+            return (urn, '', '')
+        return (match['agency'], match['id'], match['version'])
+
+    def __contains__(self, urn):
+        with self._lock:
+            return self.key_from_urn(urn) in self._codelists
+
+    def get(self, urn):
+        """Return the shared {code: name} dictionary of the codelist, or None if it is not known yet."""
+        with self._lock:
+            return self._codelists.get(self.key_from_urn(urn))
+
+    def intern(self, urn, codes_and_names):
+        """
+        Return the shared {code: name} dictionary of the codelist, storing it first if it is new.
+        The returned dictionary is shared between dataflows and must not be modified.
+        """
+        key = self.key_from_urn(urn)
+        with self._lock:
+            codelist = self._codelists.get(key)
+            if codelist is None:
+                codelist = {sys.intern(code): sys.intern(name) for code, name in codes_and_names}
+                self._codelists[key] = codelist
+            return codelist
+
+    def intern_partial(self, urn, codes_and_names):
+        """
+        Return the shared {code: name} dictionary of the codes of the codelist collected so far: the complete codelist
+        if it is known, otherwise the given codes merged with the ones collected for other dataflows. A returned
+        dictionary is never modified: new codes are merged into a new dictionary.
+        """
+        key = self.key_from_urn(urn)
+        with self._lock:
+            if key in self._codelists:
+                return self._codelists[key]
+            known = self._partial.get(key, {})
+            new = {sys.intern(code): sys.intern(name) for code, name in codes_and_names if code not in known}
+            if new or key not in self._partial:
+                known = {**known, **new}
+                self._partial[key] = known
+            return known
+
+    def subset(self, urn, codelist, codes):
+        """
+        Return the shared {code: name} dictionary of the given codes of the codelist, in the given order (e.g. the
+        constrained codes of a dimension): the dataflows with the same constraint get the same dictionary, and an
+        unconstrained dimension gets the codelist itself. Codes missing from the codelist are named 'Unknown code'.
+        """
+        codes = tuple(codes)
+        if tuple(codelist) == codes:
+            return codelist
+        key = (self.key_from_urn(urn), hashlib.sha1('\0'.join(codes).encode('utf-8')).hexdigest())
+        with self._lock:
+            subset = self._subsets.get(key)
+            if subset is None:
+                subset = {sys.intern(code): codelist.get(code, 'Unknown code') for code in codes}
+                self._subsets[key] = subset
+            return subset
+
+    def shared_embeddings(self, df_info):
+        """Return the already computed embeddings of the code documents of the dataflow (document text -> embedding)."""
+        embeddings = {}
+        with self._lock:
+            for key in set(df_info.df_code_list_keys.values()):
+                if key in self._embeddings:
+                    self._embeddings.move_to_end(key)
+                    embeddings.update(self._embeddings[key])
+        return embeddings
+
+    def share_embeddings(self, df_info, computed_embeddings):
+        """Store the embeddings of the code documents of the dataflow, so that other dataflows can reuse them."""
+        with self._lock:
+            for dim_code, key in df_info.df_code_list_keys.items():
+                stored = self._embeddings.setdefault(key, {})
+                self._embeddings.move_to_end(key)
+                for question, _ in flatten_codes_of_dimension(dim_code, df_info.df_code_names.get(dim_code, {})):
+                    document = str(question)
+                    if document not in stored and document in computed_embeddings:
+                        # float32 halves the memory of the float64 vectors returned by the API
+                        stored[document] = np.asarray(computed_embeddings[document], dtype=np.float32)
+                        self._embedding_count += 1
+            self._evict_embeddings(keep=set(df_info.df_code_list_keys.values()))
+
+    def _evict_embeddings(self, keep=()):
+        """Drop the embeddings of the least recently used codelists (but the ones of `keep`) above the cap."""
+        for key in [key for key in self._embeddings if key not in keep]:
+            if self._embedding_count <= self.max_embeddings:
+                break
+            self._embedding_count -= len(self._embeddings.pop(key))
+
+    def discard(self, key):
+        """Forget a codelist (by its (agency, id, version) key) and its embeddings, e.g. after its labels changed."""
+        with self._lock:
+            self._codelists.pop(key, None)
+            self._partial.pop(key, None)
+            self._embedding_count -= len(self._embeddings.pop(key, {}))
+            for subset_key in [subset_key for subset_key in self._subsets if subset_key[0] == key]:
+                del self._subsets[subset_key]
+
+    def stats(self):
+        with self._lock:
+            return {
+                'codelists': len(self._codelists),
+                'codes': sum(len(codelist) for codelist in self._codelists.values()),
+                'partial_codelists': len(self._partial),
+                'subsets': len(self._subsets),
+                'embeddings': self._embedding_count,
+            }
+
+    def clear(self):
+        with self._lock:
+            self._codelists.clear()
+            self._partial.clear()
+            self._subsets.clear()
+            self._embeddings.clear()
+            self._embedding_count = 0
+
+
+# The process-wide store used by the Dataflow class
+CODELISTS = CodelistStore()
@@ -0,0 +1,84 @@
+"""
+Context Builder Module
+
+Assembles the knowledge base context of the answer prompt from the retrieved documents, within a token budget.
+
+Every meta statement is indexed under several questions (flatten_dimensions and flatten_codes emit each one four
+times), so the nearest documents of a question often carry the very same statement. Pasting the raw result sets
+into the prompt repeats it, and a single code list of a large dimension (countries, ISCED levels) costs thousands
+of tokens. The builder:
+- de-duplicates the statements, keeping the rank of their closest document
+- measures every statement with the tokenizer (see embeddings.count_tokens)
+- adds them in rank order until the budget (or the maximum number of statements) is used up, cutting the last one
+  (a code list page) at a line boundary
+
+Usage:
+    ```python
+    builder = ContextBuilder(max_tokens=1000, max_statements=3)
+    context = builder.build(vector_store.query(question, n_results=10))
+    ```
+
+Configuration (environment variables):
+    CONTEXT_TOKEN_BUDGET: the token budget of the retrieved context in the answer prompt (default: 1000)
+    CONTEXT_MAX_STATEMENTS: the maximum number of distinct statements in the context (default: 3)
+"""
+
+import os
+
+from embeddings import count_tokens
+
+CONTEXT_TOKEN_BUDGET = int(os.getenv('CONTEXT_TOKEN_BUDGET', 1000))
+CONTEXT_MAX_STATEMENTS = int(os.getenv('CONTEXT_MAX_STATEMENTS', 3))
+
+
+class ContextBuilder:
+    """Turns Chroma-shaped result sets into a de-duplicated, ranked and token-budgeted context."""
+
+    # A statement is only cut to fit if at least this many tokens of it fit, otherwise it is left out
+    MIN_PARTIAL_TOKENS = 50
+
+    def __init__(self, max_tokens=CONTEXT_TOKEN_BUDGET, max_statements=CONTEXT_MAX_STATEMENTS):
+        self.max_tokens = max_tokens
+        self.max_statements = max_statements
+
+    def statements(self, result_sets, query_index=0):
+        """The distinct statements of the result sets of one query, closest first."""
+        best = {}
+        for metadata, distance in zip(result_sets['metadatas'][query_index], result_sets['distances'][query_index]):
+            statement = str(metadata['answer']).strip()
+            if statement not in best or distance < best[statement]:
+                best[statement] = distance
+        return sorted(best, key=best.get)
+
+    def build(self, result_sets, query_index=0):
+        """Return the context of one query of the result sets: the statements separated by blank lines."""
+        parts, used = [], 0
+        for statement in self.statements(result_sets, query_index)[:self.max_statements]:
+            tokens = count_tokens(statement)
+            remaining = self.max_tokens - used
+            if tokens <= remaining:
+                parts.append(statement)
+                used += tokens
+            elif remaining >= self.MIN_PARTIAL_TOKENS:
+                parts.append(self.truncate(statement, remaining))
+                break
+            else:
+                break
+        return '\n\n'.join(parts)
+
+    @staticmethod
+    def truncate(statement, max_tokens):
+        """Cut the statement to `max_tokens` at a line boundary, noting how many lines were left out."""
+        lines = statement.split('\n')
+        kept, used = [], 0
+        for line in lines:
+            tokens = count_tokens(line) + 1
+            if used + tokens > max_tokens - 10:  # room for the note
+                break
+            kept.append(line)
+            used += tokens
+
+        if not kept:
+            # A single long line: cut it proportionally
+            return statement[:max(1, len(statement) * max_tokens // max(count_tokens(statement), 1) - 3)] + '...'
+        return '\n'.join(kept) + f'\n... ({len(lines) - len(kept)} more lines not shown)'
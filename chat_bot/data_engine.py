@@ -0,0 +1,404 @@
+"""
+Data Engine Module
+
+Queries the observations of a dataflow, so that the bots can answer questions such as "What was the value for France
+in 2020?" from the actual data, not only from the structure.
+
+Key Features:
+- Builds SDMX REST data URLs from dimension filters and a year range, with the series key in the order of the
+  dimensions of the data structure (`Dataflow.df_dimension_order`)
+- Streams the SDMX-CSV response in chunks of rows into columnar arrays: one small integer array of category codes per
+  dimension (like a pandas categorical) and a float64 array of the values. The response is never held as a whole,
+  and stops being read after `max_observations` rows
+- On-disk columnar cache keyed by the query URL: a directory of `.npy` arrays and a JSON file of categories, opened
+  memory-mapped, revalidated after DATA_CACHE_TTL seconds
+- Vectorized selections and aggregations (sum, mean, min, max, count, grouped by any dimensions) over the arrays
+- `parse_data_request`: the codes and the years a question mentions (resolved with the LookupIndex of the dataflow)
+
+Usage:
+    ```python
+    table = DATA_ENGINE.query(  'OECD.EDU.IMEP:DSD_EAG_UOE_FIN@DF_UOE_FIN_INDIC_SHARE_EDU_GOV(3.0)'
+                              , df_info
+                              , filters={'REF_AREA': ['FRA', 'DEU']}
+                              , start_year=2015
+                              , end_year=2020)
+    table.aggregate(by=['REF_AREA'], how='mean')  # [{'REF_AREA': 'DEU', 'value': ..., 'count': ...}, ...]
+    table.to_frame()                              # pandas DataFrame with categorical dimension columns
+    table.describe(df_info)                       # the observations as statements for the prompt of the bot
+    ```
+
+Configuration (environment variables):
+    DATA_CACHE_PATH: directory of the cached query results (default: .data_cache)
+    DATA_CACHE_TTL: seconds before a cached query result is downloaded again (default: 86400)
+    DATA_CHUNK_ROWS: rows parsed at a time from a response (default: 100000)
+    DATA_MAX_OBSERVATIONS: the most observations kept of one query (default: 1000000)
+"""
+
+import hashlib
+import json
+import os
+import re
+import shutil
+import threading
+import time
+from dataclasses import dataclass, field
+
+import numpy as np
+import pandas as pd
+
+from http_cache import get_shared_session
+from metrics import METRICS
+
+DATA_CACHE_PATH = os.getenv('DATA_CACHE_PATH', '.data_cache')
+DATA_CACHE_TTL = float(os.getenv('DATA_CACHE_TTL', 24 * 3600))
+DATA_CHUNK_ROWS = int(os.getenv('DATA_CHUNK_ROWS', 100_000))
+DATA_MAX_OBSERVATIONS = int(os.getenv('DATA_MAX_OBSERVATIONS', 1_000_000))
+
+CSV_ACCEPT_HEADER = {'Accept': 'application/vnd.sdmx.data+csv; charset=utf-8'}
+TIME_DIMENSION = 'TIME_PERIOD'
+VALUE_COLUMN = 'OBS_VALUE'
+
+# Words that ask for numbers rather than for the structure of the table. Words that are as common in questions about
+# the structure ("number", "total", "level of", "mean", "change", ...) do not count
+_DATA_INTENT = re.compile(r'\b(values?|how (many|much)|percentages?|percent|averages?|minimum|maximum|highest|lowest|'
+                          r'trends?|amounts?|figures?)\b', re.I)
+_YEAR = re.compile(r'\b(19[5-9]\d|20\d\d)\b')
+
+
+def data_url(dataflow_name, dimension_order, filters=None, start_year=None, end_year=None, base_url=None):
+    """
+    The SDMX REST URL of the observations of the dataflow: one key position per dimension, the selected codes
+    joined with '+', and an empty position (all codes) for the dimensions without a filter.
+    """
+    if base_url is None:
+        from grounded_llm import SDMX_REST_URL
+        base_url = SDMX_REST_URL
+    filters = filters or {}
+    unknown = set(filters) - set(dimension_order)
+    if unknown:
+        raise ValueError(f"Unknown dimensions {sorted(unknown)}, the dimensions of the key are {list(dimension_order)}")
+
+    agency, rest = dataflow_name.split(':')
+    id_part, version = rest.split('(')
+    key = '.'.join('+'.join(filters.get(dim, ())) for dim in dimension_order) or 'all'
+    params = ['dimensionAtObservation=AllDimensions']
+    if start_year is not None:
+        params.append(f'startPeriod={int(start_year)}')
+    if end_year is not None:
+        params.append(f'endPeriod={int(end_year)}')
+    return f"{base_url}/data/{agency},{id_part},{version.rstrip(')')}/{key}?{'&'.join(params)}"
+
+
+class ObservationTable:
+    """
+    The observations of a query in columns: the category codes of every dimension (the time period included) and the
+    values. `categories[dim][codes[dim][i]]` is the code of dimension `dim` of observation `i`.
+    """
+
+    def __init__(self, dimensions, codes, categories, values, url=None, truncated=False, fetched_at=None):
+        self.dimensions = list(dimensions)  # the dimension ids, the time dimension last
+        self.codes = codes                  # dimension id -> unsigned integer array of category codes
+        self.categories = categories        # dimension id -> list of the SDMX codes
+        self.values = values                # float64 array, NaN for the missing values
+        self.url = url
+        self.truncated = truncated          # only the first `max_observations` rows were read
+        self.fetched_at = fetched_at or time.time()
+        self._positions = {}                # dimension id -> {SDMX code: category code}, built when first needed
+
+    def __len__(self):
+        return len(self.values)
+
+    @property
+    def nbytes(self):
+        return int(self.values.nbytes + sum(codes.nbytes for codes in self.codes.values()))
+
+    @classmethod
+    def empty(cls, dimensions, url=None):
+        dimensions = [dim for dim in dimensions if dim != TIME_DIMENSION] + [TIME_DIMENSION]
+        return cls(dimensions, {dim: np.zeros(0, dtype=np.uint8) for dim in dimensions}, {dim: [] for dim in dimensions},
+                   np.zeros(0, dtype=np.float64), url)
+
+    @classmethod
+    def from_csv(cls, stream, dimensions, chunk_rows=DATA_CHUNK_ROWS, max_observations=DATA_MAX_OBSERVATIONS, url=None):
+        """
+        Read an SDMX-CSV stream `chunk_rows` at a time. Only the dimension, time and value columns are parsed, and
+        every chunk is turned into category codes right away: memory grows with the observations, not with the text.
+        """
+        wanted = set(dimensions) | {TIME_DIMENSION, VALUE_COLUMN}
+        reader = pd.read_csv(  stream
+                             , chunksize=chunk_rows
+                             , usecols=lambda column: column in wanted
+                             , dtype=str
+                             , keep_default_na=False)
+        columns, positions, pieces, values, rows, truncated = None, {}, {}, [], 0, False
+        for chunk in reader:
+            if columns is None:
+                if VALUE_COLUMN not in chunk.columns:
+                    raise ValueError(f'The response has no {VALUE_COLUMN} column: {list(chunk.columns)}')
+                columns = [dim for dim in dimensions if dim in chunk.columns]
+                if TIME_DIMENSION in chunk.columns:
+                    columns.append(TIME_DIMENSION)
+                positions = {dim: {} for dim in columns}
+                pieces = {dim: [] for dim in columns}
+            if rows + len(chunk) > max_observations:
+                chunk = chunk.iloc[:max_observations - rows]
+                truncated = True
+
+            for dim in columns:
+                # Factorize the chunk, then map its (few) distinct codes to the categories of the whole table
+                chunk_codes, uniques = pd.factorize(chunk[dim], sort=False)
+                known = positions[dim]
+                mapping = np.fromiter((known.setdefault(code, len(known)) for code in uniques), dtype=np.uint32, count=len(uniques))
+                pieces[dim].append(mapping[chunk_codes])
+            values.append(pd.to_numeric(chunk[VALUE_COLUMN], errors='coerce').to_numpy(dtype=np.float64))
+            rows += len(chunk)
+            if truncated:
+                break
+
+        if columns is None:
+            return cls.empty(dimensions, url)
+        codes = {dim: cls._narrow(np.concatenate(pieces[dim]), len(positions[dim])) for dim in columns}
+        return cls(columns, codes, {dim: list(positions[dim]) for dim in columns}, np.concatenate(values), url, truncated)
+
+    @staticmethod
+    def _narrow(codes, n_categories):
+        for dtype in (np.uint8, np.uint16):
+            if n_categories <= np.iinfo(dtype).max + 1:
+                return codes.astype(dtype)
+        return codes
+
+    def position(self, dim, code):
+        """The category code of an SDMX code of the dimension, None if the table has no observation with it."""
+        if dim not in self._positions:
+            self._positions[dim] = {category: i for i, category in enumerate(self.categories[dim])}
+        return self._positions[dim].get(code)
+
+    def years(self):
+        """The year of every observation (the first four characters of its period, e.g. '2020-Q1')."""
+        periods = self.categories.get(TIME_DIMENSION)
+        if periods is None:
+            return np.zeros(len(self), dtype=np.int16)
+        period_years = np.array([int(period[:4]) if period[:4].isdigit() else 0 for period in periods], dtype=np.int16)
+        return period_years[self.codes[TIME_DIMENSION]] if len(periods) else np.zeros(len(self), dtype=np.int16)
+
+    def mask(self, filters=None, start_year=None, end_year=None):
+        """A boolean array of the observations with one of the codes of every filtered dimension, within the years."""
+        mask = np.ones(len(self), dtype=bool)
+        for dim, wanted in (filters or {}).items():
+            if dim not in self.codes:
+                raise ValueError(f'Unknown dimension {dim}')
+            wanted = [wanted] if isinstance(wanted, str) else wanted
+            positions = [p for p in (self.position(dim, code) for code in wanted) if p is not None]
+            mask &= np.isin(self.codes[dim], positions)
+        if start_year is not None or end_year is not None:
+            years = self.years()
+            if start_year is not None:
+                mask &= years >= start_year
+            if end_year is not None:
+                mask &= years <= end_year
+        return mask
+
+    def select(self, filters=None, start_year=None, end_year=None):
+        """The observations matching the filters, as a new table (with the same categories)."""
+        mask = self.mask(filters, start_year, end_year)
+        return ObservationTable(self.dimensions, {dim: codes[mask] for dim, codes in self.codes.items()}, self.categories,
+                                self.values[mask], self.url, self.truncated, self.fetched_at)
+
+    def aggregate(self, by=(), how='mean', filters=None, start_year=None, end_year=None):
+        """
+        Aggregate the (non-missing) values of the selected observations by the given dimensions, without a Python loop
+        over the observations. `how` is one of 'sum', 'mean', 'min', 'max' and 'count'.
+        Returns one {dimension: code, ..., 'value': ..., 'count': ...} dict per group, in the order of the group codes.
+        """
+        if how not in ('sum', 'mean', 'min', 'max', 'count'):
+            raise ValueError(f'Unknown aggregation: {how}')
+        by = list(by)
+        mask = self.mask(filters, start_year, end_year) & ~np.isnan(self.values)
+        values = self.values[mask]
+        if not len(values):
+            return []
+
+        # One integer per combination of the codes of the grouping dimensions
+        shape = [len(self.categories[dim]) for dim in by]
+        keys = np.ravel_multi_index([self.codes[dim][mask].astype(np.int64) for dim in by], shape) if by else np.zeros(len(values), dtype=np.int64)
+        groups, inverse = np.unique(keys, return_inverse=True)
+        counts = np.bincount(inverse, minlength=len(groups))
+
+        if how in ('sum', 'mean'):
+            results = np.bincount(inverse, weights=values, minlength=len(groups))
+            if how == 'mean':
+                results = results / counts
+        elif how == 'count':
+            results = counts.astype(np.float64)
+        else:
+            order = np.argsort(inverse, kind='stable')
+            starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+            results = (np.minimum if how == 'min' else np.maximum).reduceat(values[order], starts)
+
+        group_codes = np.unravel_index(groups, shape) if by else []
+        return [{  **{dim: self.categories[dim][group_codes[j][i]] for j, dim in enumerate(by)}
+                 , 'value': float(results[i])
+                 , 'count': int(counts[i])} for i in range(len(groups))]
+
+    def to_frame(self):
+        """A pandas DataFrame of the observations, the dimensions as categoricals (sharing the code arrays)."""
+        return pd.DataFrame({  **{dim: pd.Categorical.from_codes(self.codes[dim].astype(np.int32), self.categories[dim])
+                                  for dim in self.dimensions}
+                             , VALUE_COLUMN: self.values})
+
+    def describe(self, df_info, max_rows=20):
+        """
+        The observations as statements for the prompt of a bot: the dimensions with a single code once, then up to
+        `max_rows` observations (latest first) with the codes that differ, and a summary of the values if there are more.
+        """
+        if not len(self):
+            return 'The data query returned no observations.'
+
+        def label(dim, code):
+            name = df_info.df_code_names.get(dim, {}).get(code)
+            return f'{name} ({code})' if name and name != code else code
+
+        constant = [dim for dim in self.dimensions if len(np.unique(self.codes[dim])) == 1]
+        varying = [dim for dim in self.dimensions if dim not in constant]
+        lines = [f"{len(self)} observations{' (the first ones only, the query has more)' if self.truncated else ''}."]
+        if constant:
+            lines.append('All of them are for: ' + '; '.join(
+                f"{df_info.df_dimension_names.get(dim, dim)} = {label(dim, self.categories[dim][int(self.codes[dim][0])])}"
+                for dim in constant))
+
+        order = np.argsort(-self.years(), kind='stable')[:max_rows]
+        for i in order:
+            value = self.values[i]
+            key = ', '.join(f"{dim}: {label(dim, self.categories[dim][int(self.codes[dim][i])])}" for dim in varying)
+            lines.append(f"- {key + ': ' if key else ''}{'no value' if np.isnan(value) else f'{value:g}'}")
+
+        if len(self) > max_rows:
+            summary = {how: self.aggregate(how=how) for how in ('min', 'max', 'mean')}
+            if summary['mean']:
+                lines.append(f"... and {len(self) - max_rows} more observations. Over all of them: minimum "
+                             f"{summary['min'][0]['value']:g}, maximum {summary['max'][0]['value']:g}, "
+                             f"mean {summary['mean'][0]['value']:g}.")
+        return '\n'.join(lines)
+
+    def save(self, path):
+        """Write the table to a directory of `.npy` arrays and a JSON file, atomically."""
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        os.makedirs(tmp_path, exist_ok=True)
+        for i, dim in enumerate(self.dimensions):
+            np.save(os.path.join(tmp_path, f'codes_{i}.npy'), self.codes[dim])
+        np.save(os.path.join(tmp_path, 'values.npy'), self.values)
+        with open(os.path.join(tmp_path, 'table.json'), 'w', encoding='utf-8') as f:
+            json.dump({  'dimensions': self.dimensions
+                       , 'categories': self.categories
+                       , 'url': self.url
+                       , 'truncated': self.truncated
+                       , 'fetched_at': self.fetched_at}, f, ensure_ascii=False)
+        shutil.rmtree(path, ignore_errors=True)
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            # Another thread or process has just written the same query
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+    @classmethod
+    def load(cls, path, use_mmap=True):
+        """Open a saved table, the arrays memory-mapped. Raises FileNotFoundError if there is none."""
+        with open(os.path.join(path, 'table.json'), encoding='utf-8') as f:
+            meta = json.load(f)
+        mmap_mode = 'r' if use_mmap else None
+        codes = {dim: np.load(os.path.join(path, f'codes_{i}.npy'), mmap_mode=mmap_mode) for i, dim in enumerate(meta['dimensions'])}
+        return cls(meta['dimensions'], codes, meta['categories'], np.load(os.path.join(path, 'values.npy'), mmap_mode=mmap_mode),
+                   meta['url'], meta['truncated'], meta['fetched_at'])
+
+
+class DataCache:
+    """The observation tables of the queries, on disk, keyed by query URL."""
+
+    def __init__(self, path=DATA_CACHE_PATH, ttl=DATA_CACHE_TTL):
+        self.path = path
+        self.ttl = ttl
+
+    def _table_path(self, url):
+        return os.path.join(self.path, hashlib.sha256(url.encode('utf-8')).hexdigest()[:32])
+
+    def get(self, url):
+        """The cached table of the query, None if it is not cached or older than the TTL."""
+        try:
+            table = ObservationTable.load(self._table_path(url))
+        except (FileNotFoundError, ValueError, KeyError):
+            return None
+        if table.url != url or time.time() - table.fetched_at > self.ttl:
+            return None
+        return table
+
+    def put(self, url, table):
+        os.makedirs(self.path, exist_ok=True)
+        table.save(self._table_path(url))
+
+    def invalidate(self, url=None):
+        """Remove a cached query result (or all of them, if no URL is given)."""
+        shutil.rmtree(self.path if url is None else self._table_path(url), ignore_errors=True)
+
+
+class DataEngine:
+    """Runs the data queries of the bots through the on-disk cache."""
+
+    def __init__(self, cache=None, session=None, chunk_rows=DATA_CHUNK_ROWS, max_observations=DATA_MAX_OBSERVATIONS):
+        self.cache = cache or DataCache()
+        self.session = session
+        self.chunk_rows = chunk_rows
+        self.max_observations = max_observations
+
+    def query(self, dataflow_name, df_info, filters=None, start_year=None, end_year=None):
+        """The observations of the dataflow for the given codes (dimension id -> codes) and years."""
+        filters = {dim: [codes] if isinstance(codes, str) else list(codes) for dim, codes in (filters or {}).items()}
+        url = data_url(dataflow_name, df_info.df_dimension_order, filters, start_year, end_year)
+
+        table = self.cache.get(url)
+        if table is not None:
+            METRICS.inc('data_queries', status='cached')
+            return table
+        with METRICS.timer('data_fetch'):
+            table = self._download(url, df_info.df_dimension_order)
+        METRICS.inc('data_queries', status='downloaded')
+        self.cache.put(url, table)
+        return table
+
+    def _download(self, url, dimensions):
+        session = self.session or get_shared_session()
+        response = session.session.get(url, headers=CSV_ACCEPT_HEADER, timeout=session.timeout, stream=True)
+        with response:
+            # The registry answers a query without observations with 404 (NoResultsFound)
+            if response.status_code == 404:
+                return ObservationTable.empty(dimensions, url)
+            response.raise_for_status()
+            response.raw.decode_content = True
+            return ObservationTable.from_csv(response.raw, dimensions, self.chunk_rows, self.max_observations, url)
+
+
+@dataclass
+class DataRequest:
+    """The observations a question asks for: codes by dimension and a year range (None: not restricted)."""
+    filters: dict[str, list[str]] = field(default_factory=dict)
+    start_year: int | None = None
+    end_year: int | None = None
+
+
+def parse_data_request(question, lookup_index, dimension_order):
+    """
+    The data query of a question that asks for numbers ("value", "how many", "average", ...) and mentions at least one
+    code (resolved with the LookupIndex of the dataflow), None otherwise. The years the question mentions, if any,
+    bound the query. Without a code the query would be the whole dataflow: a year alone (e.g. "ISCED 2011") is not
+    a data request.
+    """
+    if not _DATA_INTENT.search(question):
+        return None
+    filters = {dim: codes for dim, codes in lookup_index.mentions(question).items() if dim in dimension_order}
+    if not filters:
+        return None
+    years = sorted(int(year) for year in _YEAR.findall(question))
+    return DataRequest(filters, years[0] if years else None, years[-1] if years else None)
+
+
+# The data engine of the process, see Bot._data_context
+DATA_ENGINE = DataEngine()
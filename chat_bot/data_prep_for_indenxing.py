@@ -1,12 +1,29 @@
+import os
+
+# The number of codes per statement of a code list listing, see paged_code_list_statements
+CODE_LIST_PAGE_SIZE = int(os.getenv('CODE_LIST_PAGE_SIZE', 50))
+
+
 def flatten_info(info):
     """Flatten the dataflow information for embedding."""
-    flat_info_for_embedding = list(tuple())
-    flat_info_for_embedding.extend(flatten_name_and_description(info))
-    flat_info_for_embedding.extend(flatten_dimensions(info))
-    flat_info_for_embedding.extend(flatten_codes(info))
-    flat_info_for_embedding.extend(get_dataflow_struct_questions(info))
+    head, tail = flatten_info_in_stages(info)
+    return head + tail
+
+
+def flatten_info_in_stages(info):
+    """
+    Flatten the dataflow information for embedding in two parts: the name, description and dimension documents
+    (few, and enough to answer questions about the table) and the long tail of the code documents.
+    """
+    head = list(tuple())
+    head.extend(flatten_name_and_description(info))
+    head.extend(flatten_dimensions(info))
+
+    tail = list(tuple())
+    tail.extend(flatten_codes(info))
+    tail.extend(get_dataflow_struct_questions(info))
 
-    return flat_info_for_embedding
+    return head, tail
 
 
 def flatten_name_and_description(info):
@@ -19,52 +36,119 @@ def flatten_name_and_description(info):
     ]
 
 
+def dimension_meta_statement(code, name):
+    return f"The name that corresponds to the column code: '{code}' is {name}."
+
+
+def code_meta_statement(code_list_id, code, name):
+    return f"The English name of the code '{code}' within the code list ID '{code_list_id}' is '{name}'."
+
+
 def flatten_dimensions(info):
     ans = []
     for code, name in info.df_dimension_names.items():
-        meta_statement = f"The name that corresponds to the column code: '{code}' is {name}."
-        ans.append((code, meta_statement))
-        ans.append((name, meta_statement))
-        ans.append((f"What name corresponds to the column code: '{code}'?", meta_statement))
-        ans.append((f"What is the column code for '{name}'?", meta_statement))
+        ans.extend(flatten_dimension(code, name))
     return ans
 
 
+def flatten_dimension(code, name):
+    meta_statement = dimension_meta_statement(code, name)
+    return [
+          (code, meta_statement)
+        , (name, meta_statement)
+        , (f"What name corresponds to the column code: '{code}'?", meta_statement)
+        , (f"What is the column code for '{name}'?", meta_statement)
+    ]
+
+
 def flatten_codes(info):
     ans = []
     for code_list_id in info.df_code_names:
-        for code, name in info.df_code_names[code_list_id].items():
-            meta_statement = f"The English name of the code '{code}' within the code list ID '{code_list_id}' is '{name}'."
-            ans.append((code, meta_statement))
-            ans.append((name, meta_statement))
-            ans.append((f"What is the English name of the code '{code}' within the code list ID '{code_list_id}'?", meta_statement))
-            ans.append((f"What is the code for '{name}' within the code list ID '{code_list_id}'?", meta_statement))
+        ans.extend(flatten_codes_of_dimension(code_list_id, info.df_code_names[code_list_id]))
+    return ans
+
+
+def flatten_codes_of_dimension(code_list_id, code_names):
+    ans = []
+    for code, name in code_names.items():
+        meta_statement = code_meta_statement(code_list_id, code, name)
+        ans.append((code, meta_statement))
+        ans.append((name, meta_statement))
+        ans.append((f"What is the English name of the code '{code}' within the code list ID '{code_list_id}'?", meta_statement))
+        ans.append((f"What is the code for '{name}' within the code list ID '{code_list_id}'?", meta_statement))
     return ans
 
 
+def format_code_names(code_names):
+    """One 'CODE: Name' line per code (a readable listing instead of the repr of the dictionary)."""
+    return '\n'.join(f"{code}: {name}" for code, name in code_names.items())
+
+
+def paged_code_list_statements(header, code_names, page_size=CODE_LIST_PAGE_SIZE):
+    """
+    The listing of the codes as one statement per page of `page_size` codes, each page with the header.
+    A retrieved page of a large code list (e.g. countries) then does not fill the prompt on its own.
+    """
+    items = list(code_names.items())
+    if len(items) <= page_size:
+        return [f"{header}:\n{format_code_names(code_names)}"]
+
+    statements = []
+    for start in range(0, len(items), page_size):
+        page = dict(items[start:start + page_size])
+        statements.append(f"{header} (codes {start + 1}-{start + len(page)} of {len(items)}):\n{format_code_names(page)}")
+    return statements
+
+
 def get_dataflow_struct_questions(info):
     """
     If we want generic questions about the schema to be searchable, we need to put them explicitly in the vectorstore. 
     The two example use case here are when, the user asks for:
         1. All the columns in the data table.
         2. All the categories (codes) in a specific column.
+    Large code lists are split into pages (see paged_code_list_statements).
     """
 
-    ans = []
-    ans.append((   "What are the columns in this Tables?"
-                , f"These are all the dimension codes and associated English names in this DataFlow: {info.df_dimension_names}"))
-   
+    ans = columns_questions(info)
     for dim_code, dim_name in info.df_dimension_names.items():
-        try:
-            ans.append((  f"What are all the categories in the column: '{dim_code}'?"
-                        , f"""All codes and their English names corresponding to the dimension code: '{dim_code}' and dimension name '{dim_name}' are the follworing: 
-                          '''{info.df_code_names[dim_code]}'''.
-                          """))
-            ans.append((  f"What are all the categories in the column: '{dim_name}'?"
-                        , f"""All codes and their English names corresponding to the dimension code: '{dim_code}' and dimension name '{dim_name}' are the follworing: 
-                          '''{info.df_code_names[dim_code]}'''.
-                          """))
-        except:
+        if dim_code not in info.df_code_names:
             print(f"{dim_code} not found in the code names.")
+            continue
+        ans.extend(categories_questions(dim_code, dim_name, info.df_code_names[dim_code]))
+
+    return ans
+
 
-    return ans
\ No newline at end of file
+def columns_questions(info):
+    """The listing of all the columns of the table."""
+    ans = []
+    for statement in paged_code_list_statements(  "These are all the dimension codes and associated English names in this DataFlow"
+                                                , info.df_dimension_names):
+        ans.append(("What are the columns in this Tables?", statement))
+    return ans
+
+
+def categories_questions(dim_code, dim_name, code_names):
+    """The listing of all the categories (codes) of a column."""
+    ans = []
+    header = f"All codes and their English names corresponding to the dimension code: '{dim_code}' and dimension name '{dim_name}'"
+    for statement in paged_code_list_statements(header, code_names):
+        ans.append((f"What are all the categories in the column: '{dim_code}'?", statement))
+        ans.append((f"What are all the categories in the column: '{dim_name}'?", statement))
+    return ans
+
+
+def flatten_info_by_dimension(info):
+    """
+    The documents of `flatten_info`, grouped by the dimension they are about (None for the ones about the whole
+    table), e.g. to store the dimension as metadata of the documents (see catalogue_index.py).
+    """
+    groups = {None: flatten_name_and_description(info) + columns_questions(info)}
+    for code, name in info.df_dimension_names.items():
+        groups[code] = flatten_dimension(code, name)
+    for code_list_id, code_names in info.df_code_names.items():
+        groups.setdefault(code_list_id, []).extend(flatten_codes_of_dimension(code_list_id, code_names))
+    for dim_code, dim_name in info.df_dimension_names.items():
+        if dim_code in info.df_code_names:
+            groups[dim_code].extend(categories_questions(dim_code, dim_name, info.df_code_names[dim_code]))
+    return groups
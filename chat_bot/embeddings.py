@@ -0,0 +1,205 @@
+"""
+Embeddings Module
+
+Embedding backends and the batched, rate-limit-aware embedding of large document sets.
+
+Backends (both are ChromaDB embedding functions, so they can be attached to collections for querying):
+- 'openai':  OpenAI embeddings (text-embedding-3-small by default), the production backend
+- 'hashing': a deterministic local fake (hashed word and character n-grams), for tests and benchmarks:
+             no network, no API key, no cost, and the same text always gets the same vector
+
+Batching:
+- `chunk_by_token_budget` packs texts into requests that stay below the provider's per-request limits
+  (number of inputs and number of tokens)
+- `embed_with_backoff` retries a request on rate-limit errors with exponential backoff; the backoff is shared by
+  all the workers, so a 429 slows down the whole pool instead of every worker hammering the API in turn
+- `embed_in_batches` embeds a list of texts with a pool of workers and returns the embeddings in order
+
+Configuration (environment variables):
+    EMBEDDING_BACKEND: 'openai' (default) or 'hashing'
+    EMBEDDING_MODEL: the OpenAI embedding model (default: text-embedding-3-small)
+"""
+
+import hashlib
+import os
+import random
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from chromadb.api.types import EmbeddingFunction
+from chromadb.utils import embedding_functions
+from dotenv import load_dotenv
+
+try:
+    import tiktoken
+except ImportError:  # optional, the token counts are estimated without it
+    tiktoken = None
+
+EMBEDDING_BACKEND = os.getenv('EMBEDDING_BACKEND', 'openai')
+EMBEDDING_MODEL = os.getenv('EMBEDDING_MODEL', 'text-embedding-3-small')
+
+# OpenAI limits: 2048 inputs per request, 8191 tokens per input and 300k tokens per request (we stay well below)
+MAX_INPUTS_PER_REQUEST = 2048
+MAX_TOKENS_PER_REQUEST = 100_000
+
+
+class HashingEmbeddingFunction(EmbeddingFunction):
+    """Deterministic, local embedding function: signed feature hashing of words and character trigrams."""
+
+    def __init__(self, dimensions=256):
+        self.dimensions = dimensions
+        self.model_name = f'hashing-{dimensions}'
+
+    def __call__(self, input):
+        return [self._embed(text) for text in input]
+
+    def _embed(self, text):
+        vector = np.zeros(self.dimensions, dtype=np.float32)
+        words = re.findall(r'\w+', text.casefold())
+        features = words + [word[i:i + 3] for word in words for i in range(max(len(word) - 2, 1))]
+        for feature in features:
+            digest = hashlib.blake2b(feature.encode('utf-8'), digest_size=8).digest()
+            index = int.from_bytes(digest[:4], 'little') % self.dimensions
+            vector[index] += 1.0 if digest[4] & 1 else -1.0
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+
+def get_embedding_function(openai_api_key=None, backend=None):
+    """Return the embedding function of the configured backend."""
+    backend = backend or EMBEDDING_BACKEND
+    if backend == 'hashing':
+        return HashingEmbeddingFunction()
+    if backend != 'openai':
+        raise ValueError(f'Unknown embedding backend: {backend}')
+
+    load_dotenv()
+    if openai_api_key is None:
+        openai_api_key = os.getenv('OPENAI_API_KEY')
+    return embedding_functions.OpenAIEmbeddingFunction(
+        model_name=EMBEDDING_MODEL,
+        api_key=openai_api_key
+    )
+
+
+def embedding_model_name(embedding_function):
+    """The name of the model behind an embedding function: collections built with different models are not interchangeable."""
+    return (getattr(embedding_function, 'model_name', None)
+            or getattr(embedding_function, '_model_name', None)
+            or type(embedding_function).__name__)
+
+
+def count_tokens(text):
+    encoding = _get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text))
+    # Roughly 4 characters per token for English text
+    return len(text) // 4 + 1
+
+
+_encoding = None
+_encoding_unavailable = tiktoken is None
+
+
+def _get_encoding():
+    global _encoding, _encoding_unavailable
+    if _encoding is None and not _encoding_unavailable:
+        try:
+            _encoding = tiktoken.get_encoding('cl100k_base')
+        except Exception as e:
+            # tiktoken downloads the encoding on first use, that is not possible offline
+            print(f"Could not load the tokenizer ({e}), estimating the token counts instead")
+            _encoding_unavailable = True
+    return _encoding
+
+
+def chunk_by_token_budget(texts, max_tokens=MAX_TOKENS_PER_REQUEST, max_items=MAX_INPUTS_PER_REQUEST, precomputed=()):
+    """
+    Split the texts (in order) into chunks of at most `max_items` texts and `max_tokens` tokens.
+    The texts in `precomputed` (e.g. a mapping of text -> embedding) are not sent, so they are not counted.
+    """
+    chunks, chunk, chunk_tokens = [], [], 0
+    for text in texts:
+        tokens = 0 if text in precomputed else count_tokens(text)
+        if chunk and (len(chunk) >= max_items or chunk_tokens + tokens > max_tokens):
+            chunks.append(chunk)
+            chunk, chunk_tokens = [], 0
+        chunk.append(text)
+        chunk_tokens += tokens
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+class RateLimitBackoff:
+    """Exponential backoff shared by the workers of an ingestion: after a rate-limit error every worker waits."""
+
+    def __init__(self, initial_delay=1.0, max_delay=60.0):
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.delay = 0.0
+        self._resume_at = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            pause = self._resume_at - time.monotonic()
+        if pause > 0:
+            time.sleep(pause)
+
+    def penalize(self, retry_after=None):
+        with self._lock:
+            self.delay = min(self.max_delay, max(self.initial_delay, self.delay * 2))
+            delay = retry_after if retry_after is not None else self.delay * (0.5 + random.random())
+            self._resume_at = max(self._resume_at, time.monotonic() + delay)
+            return delay
+
+    def reward(self):
+        with self._lock:
+            self.delay /= 2
+
+
+def is_rate_limit_error(error):
+    status_code = getattr(error, 'status_code', None) or getattr(getattr(error, 'response', None), 'status_code', None)
+    return status_code == 429 or 'RateLimit' in type(error).__name__
+
+
+def _retry_after(error):
+    headers = getattr(getattr(error, 'response', None), 'headers', None) or {}
+    try:
+        return float(headers.get('retry-after'))
+    except (TypeError, ValueError):
+        return None
+
+
+def embed_with_backoff(texts, embedding_function, backoff=None, max_retries=8):
+    """Embed one request worth of texts, retrying on rate-limit errors."""
+    backoff = backoff or RateLimitBackoff()
+    for attempt in range(max_retries + 1):
+        backoff.wait()
+        try:
+            embeddings = embedding_function(texts)
+        except Exception as e:
+            if not is_rate_limit_error(e) or attempt == max_retries:
+                raise
+            delay = backoff.penalize(_retry_after(e))
+            print(f"Rate limited by the embedding API, retrying in {delay:.1f}s")
+            continue
+        backoff.reward()
+        return embeddings
+
+
+def embed_in_batches(texts, embedding_function, batch_size=MAX_INPUTS_PER_REQUEST,
+                     max_tokens=MAX_TOKENS_PER_REQUEST, workers=4):
+    """
+    Embed the texts with as few requests as possible, `workers` requests at a time.
+    Returns the embeddings in the order of the texts.
+    """
+    chunks = chunk_by_token_budget(texts, max_tokens=max_tokens, max_items=batch_size)
+    backoff = RateLimitBackoff()
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        results = executor.map(lambda chunk: embed_with_backoff(chunk, embedding_function, backoff), chunks)
+        return [embedding for chunk_embeddings in results for embedding in chunk_embeddings]
@@ -0,0 +1,309 @@
+"""
+Fakes Module
+
+Local stand-ins for the external services of the chat bot, so that it can be benchmarked (and tried out) offline:
+no network, no API key, no cost, and the same inputs always give the same results.
+
+- FakeSDMXServer: a local SDMX registry serving `references=all` structure messages, either a recorded payload
+  (e.g. a saved response of sdmx.oecd.org) or synthetic ones of configurable size. Supports ETag revalidation
+  and an artificial latency, like the real registry behind the on-disk cache of http_cache.py. Data queries
+  (`/data/...`) are answered with synthetic SDMX-CSV observations (see data_engine.py).
+- FakeChatClient / FakeAsyncChatClient: drop-in replacements of the OpenAI (async) client for chat completions,
+  with a configurable latency (to the first token and per token) and a deterministic answer, also streamed.
+- The fake embedder is the 'hashing' backend of embeddings.py.
+
+Usage:
+    ```python
+    with FakeSDMXServer(dimensions=6, codes_per_dimension=500) as server:
+        grounded_llm.SDMX_REST_URL = server.url
+        install_fake_chat_model(latency=0.2)
+        embeddings.EMBEDDING_BACKEND = 'hashing'
+        bot = Bot(server.dataflow_name(0))
+    ```
+"""
+
+import asyncio
+import hashlib
+import itertools
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+AGENCY = 'OECD.BENCH'
+
+# Words the synthetic names are made of, so that the embeddings and the lookups have something to work with
+_WORDS = ('education', 'primary', 'secondary', 'tertiary', 'upper', 'lower', 'expenditure', 'teachers', 'salary',
+          'students', 'enrolment', 'public', 'private', 'total', 'share', 'annual', 'adult', 'women', 'men', 'age',
+          'level', 'field', 'country', 'region', 'income', 'employment', 'rate', 'programme', 'vocational', 'general')
+
+
+def synthetic_structure(  dataflow_id
+                        , dimensions=5
+                        , codes_per_dimension=200
+                        , constrained_fraction=0.25
+                        , seed=0):
+    """
+    Build a synthetic `references=all` structure message.
+
+    The codelists only depend on the dimension (not on the dataflow), like the shared codelists of the OECD registry,
+    while the content constraint (the codes that are actually used) is different for every dataflow.
+    """
+    rng = random.Random(f'{seed}:{dataflow_id}')
+
+    def urn(codelist_id):
+        return f'urn:sdmx:org.sdmx.infomodel.codelist.Codelist=OECD:{codelist_id}(1.0)'
+
+    def name(rng, i):
+        return ' '.join(rng.choice(_WORDS) for _ in range(3)).capitalize() + f' {i}'
+
+    codelists, dimension_list, concepts, key_values = [], [], [], []
+    for d in range(dimensions):
+        dimension_id, codelist_id = f'DIM_{d}', f'CL_DIM_{d}'
+        codelist_rng = random.Random(f'{seed}:{codelist_id}')
+        codes = [{'id': f'D{d}_{i}', 'name': name(codelist_rng, i)} for i in range(codes_per_dimension)]
+
+        codelists.append({'id': codelist_id, 'links': [{'urn': urn(codelist_id)}], 'codes': codes})
+        dimension_list.append({'id': dimension_id, 'localRepresentation': {'enumeration': urn(codelist_id)}})
+        concepts.append({'id': dimension_id, 'name': name(codelist_rng, d)})
+
+        n_constrained = max(1, round(codes_per_dimension * constrained_fraction))
+        key_values.append({'id': dimension_id, 'values': [code['id'] for code in rng.sample(codes, n_constrained)]})
+
+    concepts.append({'id': 'TIME_PERIOD', 'name': 'Time period'})
+    key_values.append({'id': 'TIME_PERIOD', 'timeRange': {
+          'startPeriod': {'period': '2010-01-01T00:00:00', 'isInclusive': True}
+        , 'endPeriod': {'period': '2023-12-31T23:59:59', 'isInclusive': True}}})
+
+    return {'data': {
+          'dataflows': [{'id': dataflow_id, 'name': f'Synthetic dataflow {dataflow_id}', 'description': f'{name(rng, 0)} by {dimensions} dimensions'}]
+        , 'conceptSchemes': [{'concepts': concepts}]
+        , 'dataStructures': [{'dataStructureComponents': {'dimensionList': {
+              'dimensions': dimension_list
+            , 'timeDimensions': [{'id': 'TIME_PERIOD'}]}}}]
+        , 'codelists': codelists
+        , 'contentConstraints': [{'cubeRegions': [{'keyValues': key_values}]}]
+    }}
+
+
+def synthetic_data_csv(structure, dataflow_name, key, start_year=None, end_year=None, codes_per_dimension=3):
+    """
+    The SDMX-CSV observations of a data query of a synthetic structure: every combination of the codes of the key
+    (the first `codes_per_dimension` constrained codes of the dimensions left open) and of the years.
+    The value of an observation only depends on its codes and year.
+    """
+    key_values = structure['data']['contentConstraints'][0]['cubeRegions'][0]['keyValues']
+    constrained = {item['id']: item['values'] for item in key_values if 'values' in item}
+    time_range = next(item['timeRange'] for item in key_values if 'timeRange' in item)
+    dimensions = [dim['id'] for dim in structure['data']['dataStructures'][0]['dataStructureComponents']['dimensionList']['dimensions']]
+    positions = key.split('.') if key != 'all' else [''] * len(dimensions)
+
+    selected = []
+    for dim, position in zip(dimensions, positions):
+        codes = position.split('+') if position else constrained[dim][:codes_per_dimension]
+        selected.append([code for code in codes if code in constrained[dim]])
+    first, last = int(time_range['startPeriod']['period'][:4]), int(time_range['endPeriod']['period'][:4])
+    years = range(max(first, start_year or first), min(last, end_year or last) + 1)
+
+    lines = [','.join(['DATAFLOW', *dimensions, 'TIME_PERIOD', 'OBS_VALUE', 'OBS_STATUS'])]
+    for codes in itertools.product(*selected):
+        for year in years:
+            digest = hashlib.md5(f"{'.'.join(codes)}:{year}".encode('utf-8')).digest()
+            value = int.from_bytes(digest[:4], 'little') % 100000 / 100
+            lines.append(','.join([dataflow_name, *codes, str(year), f'{value:.2f}', 'A']))
+    return '\n'.join(lines).encode('utf-8') + b'\n' if len(lines) > 1 else b''
+
+
+class FakeSDMXServer:
+    """A local SDMX registry on a free port, serving recorded or synthetic structure messages."""
+
+    def __init__(  self
+                 , payload_path=None
+                 , dimensions=5
+                 , codes_per_dimension=200
+                 , constrained_fraction=0.25
+                 , latency=0.0
+                 , seed=0):
+        self.recorded = None
+        if payload_path is not None:
+            with open(payload_path, 'rb') as f:
+                self.recorded = f.read()
+        self.structure_params = dict(  dimensions=dimensions
+                                     , codes_per_dimension=codes_per_dimension
+                                     , constrained_fraction=constrained_fraction
+                                     , seed=seed)
+        self.latency = latency
+        self.requests = 0
+        self._bodies = {}
+        self._lock = threading.Lock()
+        self._server = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address
+        return f'http://{host}:{port}'
+
+    @staticmethod
+    def dataflow_name(i):
+        return f'{AGENCY}:DF_BENCH_{i}(1.0)'
+
+    def body(self, path):
+        """The structure message of a `/dataflow/{agency}/{id}/{version}` path (built once per dataflow)."""
+        if self.recorded is not None:
+            return self.recorded
+        dataflow_id = path.split('?')[0].rstrip('/').split('/')[-2]
+        with self._lock:
+            if dataflow_id not in self._bodies:
+                structure = synthetic_structure(dataflow_id, **self.structure_params)
+                self._bodies[dataflow_id] = json.dumps(structure).encode('utf-8')
+            return self._bodies[dataflow_id]
+
+    def data_body(self, path):
+        """The SDMX-CSV observations of a `/data/{agency},{id},{version}/{key}` path, empty if there are none."""
+        route, _, query = path.partition('?')
+        flow, key = route.split('/data/', 1)[1].split('/', 1)
+        agency, dataflow_id, version = flow.split(',')
+        params = dict(param.split('=', 1) for param in query.split('&') if '=' in param)
+        structure = synthetic_structure(dataflow_id, **self.structure_params)
+        return synthetic_data_csv(  structure
+                                  , f'{agency}:{dataflow_id}({version})'
+                                  , key
+                                  , int(params['startPeriod']) if 'startPeriod' in params else None
+                                  , int(params['endPeriod']) if 'endPeriod' in params else None)
+
+    def start(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                with fake._lock:
+                    fake.requests += 1
+                if fake.latency:
+                    time.sleep(fake.latency)
+
+                if '/data/' in self.path:
+                    body, content_type = fake.data_body(self.path), 'application/vnd.sdmx.data+csv; charset=utf-8'
+                    if not body:
+                        # Like the registry: no observations is "NoResultsFound"
+                        self.send_response(404)
+                        self.end_headers()
+                        return
+                else:
+                    body, content_type = fake.body(self.path), 'application/json'
+                etag = '"%s"' % hashlib.md5(body).hexdigest()
+                if self.headers.get('If-None-Match') == etag:
+                    self.send_response(304)
+                    self.end_headers()
+                    return
+
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.send_header('ETag', etag)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def _fake_message(messages, completion_tokens):
+    """A deterministic answer of `completion_tokens` words (tokens, for the fake)."""
+    prompt = messages[-1]['content']
+    digest = hashlib.sha1(prompt.encode('utf-8')).hexdigest()[:8]
+    words = ['Fake', 'answer', digest] + ['lorem'] * max(0, completion_tokens - 3)
+    return prompt, words[:max(completion_tokens, 1)]
+
+
+def _fake_usage(prompt, completion_tokens):
+    return SimpleNamespace(prompt_tokens=len(prompt) // 4 + 1, completion_tokens=completion_tokens)
+
+
+def _fake_completion(model, messages, completion_tokens):
+    prompt, words = _fake_message(messages, completion_tokens)
+    return SimpleNamespace(
+          model=model
+        , usage=_fake_usage(prompt, completion_tokens)
+        , choices=[SimpleNamespace(message=SimpleNamespace(content=' '.join(words)))]
+    )
+
+
+def _fake_chunk(model, content=None, usage=None):
+    choices = [] if content is None else [SimpleNamespace(delta=SimpleNamespace(content=content))]
+    return SimpleNamespace(model=model, choices=choices, usage=usage)
+
+
+class _FakeCompletions:
+    def __init__(self, latency, completion_tokens, token_latency):
+        self.latency = latency
+        self.completion_tokens = completion_tokens
+        self.token_latency = token_latency
+        self.calls = 0
+
+    def create(self, model, messages, stream=False, **kwargs):
+        self.calls += 1
+        time.sleep(self.latency)
+        if stream:
+            return self._stream(model, messages)
+        time.sleep(self.token_latency * self.completion_tokens)
+        return _fake_completion(model, messages, self.completion_tokens)
+
+    def _stream(self, model, messages):
+        """The first token comes after `latency`, every further token after `token_latency`, the usage comes last."""
+        prompt, words = _fake_message(messages, self.completion_tokens)
+        for i, word in enumerate(words):
+            if i:
+                time.sleep(self.token_latency)
+            yield _fake_chunk(model, word if i == 0 else f' {word}')
+        yield _fake_chunk(model, usage=_fake_usage(prompt, self.completion_tokens))
+
+
+class _FakeAsyncCompletions(_FakeCompletions):
+    async def create(self, model, messages, stream=False, **kwargs):
+        self.calls += 1
+        await asyncio.sleep(self.latency + self.token_latency * self.completion_tokens)
+        return _fake_completion(model, messages, self.completion_tokens)
+
+
+class FakeChatClient:
+    """
+    Stands in for `OpenAI`: `client.chat.completions.create(...)` answers after `latency` seconds plus
+    `token_latency` seconds per generated token, or streams the answer token by token with `stream=True`.
+    """
+
+    def __init__(self, latency=0.2, completion_tokens=50, token_latency=0.0):
+        self.chat = SimpleNamespace(completions=_FakeCompletions(latency, completion_tokens, token_latency))
+
+
+class FakeAsyncChatClient:
+    """Stands in for `AsyncOpenAI` (without streaming)."""
+
+    def __init__(self, latency=0.2, completion_tokens=50, token_latency=0.0):
+        self.chat = SimpleNamespace(completions=_FakeAsyncCompletions(latency, completion_tokens, token_latency))
+
+
+def install_fake_chat_model(latency=0.2, completion_tokens=50, token_latency=0.0):
+    """Replace the OpenAI clients of LLM.py with the fake chat model."""
+    import LLM
+
+    LLM.client = FakeChatClient(latency, completion_tokens, token_latency)
+    LLM.async_client = FakeAsyncChatClient(latency, completion_tokens, token_latency)
+    return LLM.client, LLM.async_client
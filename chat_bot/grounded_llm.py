@@ -1,33 +1,126 @@
+import asyncio
+import contextvars
+import time
+from concurrent.futures import ThreadPoolExecutor
 import LLM
 from SDMX_DataFlow import Dataflow
-from data_prep_for_indenxing import flatten_info
-from chromaDB import ChromaDBWrapper
+from compact_dataflow import CompactDataflow, SNAPSHOTS
+from data_prep_for_indenxing import flatten_info_in_stages
+from vector_index import create_vector_store, get_store_index_cache
+from context_builder import ContextBuilder
+from codelist_store import CODELISTS
+from lookup_index import LookupIndex
+from data_engine import DATA_ENGINE, parse_data_request
+from response_cache import SemanticCache
+from metrics import METRICS, current_dataflow, dataflow_context
+import os
+import requests
+
+# Can be pointed to a mirror (or to a local stand-in server for testing)
+SDMX_REST_URL = os.getenv('SDMX_REST_URL', 'https://sdmx.oecd.org/public/rest')
+
+# Optional semantic tier of the response cache: set SEMANTIC_CACHE_THRESHOLD (cosine similarity, e.g. 0.95) to enable it
+SEMANTIC_CACHE_THRESHOLD = os.getenv('SEMANTIC_CACHE_THRESHOLD')
+semantic_cache = SemanticCache(threshold=float(SEMANTIC_CACHE_THRESHOLD)) if SEMANTIC_CACHE_THRESHOLD else None
+
+# The number of concurrent LLM calls of a batch of questions (see Bot.answer_questions)
+BATCH_CONCURRENCY = int(os.getenv('BATCH_CONCURRENCY', 8))
+
+# Questions about the numbers are grounded in the observations of the table (see data_engine.py)
+DATA_GROUNDING = os.getenv('DATA_GROUNDING', 'true').lower() == 'true'
+# The most observations listed in the prompt
+DATA_CONTEXT_ROWS = int(os.getenv('DATA_CONTEXT_ROWS', 20))
 
 class Bot:
-    def __init__(self, dataflow_name):
+    # In speculative mode, a raw question match closer than this (squared L2 distance of normalized embeddings)
+    # is good enough to skip the search with the rephrased question
+    SPECULATIVE_DISTANCE_THRESHOLD = 0.3
+    # Documents retrieved per question: the same statement is indexed under several questions, so more documents
+    # are retrieved than statements end up in the prompt (see context_builder.py)
+    RETRIEVAL_CANDIDATES = 10
+
+    def __init__(self, dataflow_name, use_index_cache=True, progress_callback=None, ready_callback=None):
+        """
+        `progress_callback(stage, percent)` is called as the build goes on. `ready_callback(bot)` is called as soon as
+        the bot can answer questions: once the name and dimension documents are indexed, before the code documents.
+        """
         self.dataflow_name = dataflow_name
-        self.chroma_wrapper = self.setup_vector_store()
+        self.index_cache = get_store_index_cache() if use_index_cache else None
+        self.progress_callback = progress_callback
+        # False while the code documents are still being indexed
+        self.indexing_complete = False
+        self.context_builder = ContextBuilder()
+        self.vector_store = self.setup_vector_store(ready_callback)
+
+    def touch(self):
+        """Mark the collection of the bot as used in its index cache (see BotRegistry.get)."""
+        vector_store = getattr(self, 'vector_store', None)  # None while the bot is being built
+        index_cache = getattr(vector_store, 'index_cache', None)
+        if index_cache is not None:
+            index_cache.touch(vector_store.collection_name)
 
-    def setup_vector_store(self):
-        dataflow_details_url = self._get_dataflow_url_from_name(self.dataflow_name)
+    def _report_progress(self, stage, percent):
+        if self.progress_callback is not None:
+            self.progress_callback(stage, percent)
 
-        # Create an instance of the Dataflow class and populate the variables
-        df_info = Dataflow(dataflow_details_url)
+    def setup_vector_store(self, ready_callback=None):
+        self._report_progress('fetching', 0)
+        # A dataflow of the preloaded snapshot is used as it is (see compact_dataflow.py)
+        df_info = SNAPSHOTS.get(self.dataflow_name)
+        if df_info is None:
+            dataflow_details_url = self._get_dataflow_url_from_name(self.dataflow_name)
 
-        print("Populating variables...")
-        df_info.populate_variables()
-        print("Variables populated.")
+            # Create an instance of the Dataflow class and populate the variables
+            # The streaming parser only keeps the constrained codes of the (potentially huge) structure message in memory
+            parsed = Dataflow(dataflow_details_url, streaming=True)
+
+            print("Populating variables...")
+            parsed.populate_variables()
+            print("Variables populated.")
+            # The bot keeps the compact form of the dataflow, not the dictionaries
+            df_info = CompactDataflow.from_dataflow(parsed)
+        self.df_info = df_info
+        # Fast path for the plain code / dimension lookups, see answer_question
+        self.lookup_index = LookupIndex(df_info)
 
         # Flatten the dataflow information for embedding
-        flat_info_for_embedding = flatten_info(df_info)
+        self._report_progress('flattening', 10)
+        with METRICS.timer('flatten'):
+            head, tail = flatten_info_in_stages(df_info)
 
-        # Create the document store
+        # Create the document store (ChromaDB or the in-process NumPy index, see vector_index.py)
         print("Creating the document store...")
-        chroma_wrapper = ChromaDBWrapper(flat_info_for_embedding) 
+        vector_store = create_vector_store(  head + tail
+                                           , dataflow_name=self.dataflow_name
+                                           , index_cache=self.index_cache
+                                           , precomputed_embeddings=CODELISTS.shared_embeddings(df_info)
+                                           , ingest=False)
+        self.vector_store = vector_store
+
+        if not vector_store.from_cache:
+            # The names and the dimensions first: with them the bot can already answer questions about the table
+            self._report_progress('indexing_names', 15)
+            vector_store.add_data_to_collection(flat_info=head)
+            if ready_callback is not None:
+                ready_callback(self)
 
-        return chroma_wrapper
+            # Then the long tail of the codes, which the bot searches as soon as they are written
+            self._report_progress('indexing_codes', 25)
+            vector_store.add_data_to_collection(
+                  progress_callback=lambda done, total: self._report_progress('indexing_codes', 25 + 75 * done // max(total, 1))
+                , flat_info=tail)
+            vector_store.complete()
+        elif ready_callback is not None:
+            ready_callback(self)
 
-    def _get_dataflow_url_from_name(self, dataflow_name):
+        CODELISTS.share_embeddings(df_info, vector_store.computed_embeddings)
+        self.indexing_complete = True
+        self._report_progress('ready', 100)
+
+        return vector_store
+
+    @staticmethod
+    def _get_dataflow_url_from_name(dataflow_name):
         # Split the dataflow_name into agency and the rest
         agency, rest = dataflow_name.split(':')
         
@@ -38,34 +131,361 @@ class Bot:
         version = version.rstrip(')')
         
         # Return the dataflow url
-        return f'https://sdmx.oecd.org/public/rest/dataflow/{agency}/{id_part}/{version}?references=all'
+        return f'{SDMX_REST_URL}/dataflow/{agency}/{id_part}/{version}?references=all'
 
     def answer_question(self, user_question):
+        # The tokens and costs of the LLM calls are booked on this dataflow
+        with dataflow_context(self.dataflow_name), METRICS.timer('answer'):
+            return self._answer_question(user_question)
+
+    def _answer_question(self, user_question):
+        # Plain code / dimension lookups are answered from the index, without calling the LLM
+        fast_answer = self.lookup_index.answer(user_question)
+        if fast_answer is not None:
+            METRICS.inc('answers', path='lookup')
+            return fast_answer
+
+        # A similar enough question of this dataflow may have been answered already (unless it asks for numbers)
+        data_request = self._data_request(user_question)
+        cached_answer, question_embedding = self._semantic_cache_lookup(user_question, data_request)
+        if cached_answer is not None:
+            METRICS.inc('answers', path='semantic_cache')
+            return cached_answer
+
         # Re-phrase the user question to improve the semantic search results
-        rephrased_question = self._rephrase_user_question(user_question)
+        rephrased_question, rephrase_cost = self._rephrase_user_question(user_question)
 
-        # Get the 3 most relevant entries from the vector store
-        result_sets = self.chroma_wrapper.query(rephrased_question, n_results=3)
+        # Get the most relevant entries from the vector store, and the observations the question asks for
+        result_sets = self.vector_store.query(rephrased_question, n_results=self.RETRIEVAL_CANDIDATES)
+        data_context = self._data_context(data_request)
 
         # Generate the answer to the user question
+        persona, prompt = self._answer_prompt(user_question, result_sets, data_context=data_context)
+        with METRICS.timer('generate'):
+            ans, cost = LLM.model(persona, prompt, cache=self.indexing_complete)
+
+        METRICS.inc('answers', path='llm')
+        self._semantic_cache_store(question_embedding, ans, rephrase_cost + cost)
+        return ans
+
+    def answer_question_stream(self, user_question):
+        """
+        Streaming variant of `answer_question`: a generator of the pieces of the answer, as they are generated.
+        Answers that do not need the LLM (lookups, semantic cache hits) come in a single piece.
+        """
+        # The generator is resumed by whoever consumes it (e.g. the WSGI server), so it runs in a context of its own
+        # in which the LLM usage is booked on this dataflow
+        context = contextvars.copy_context()
+        context.run(current_dataflow.set, self.dataflow_name)
+        pieces = self._answer_question_stream(user_question)
+        while True:
+            try:
+                piece = context.run(next, pieces)
+            except StopIteration:
+                return
+            yield piece
+
+    def _answer_question_stream(self, user_question):
+        start = time.perf_counter()
+
+        fast_answer = self.lookup_index.answer(user_question)
+        if fast_answer is not None:
+            METRICS.inc('answers', path='lookup')
+            yield fast_answer
+            return
+
+        data_request = self._data_request(user_question)
+        cached_answer, question_embedding = self._semantic_cache_lookup(user_question, data_request)
+        if cached_answer is not None:
+            METRICS.inc('answers', path='semantic_cache')
+            yield cached_answer
+            return
+
+        rephrased_question, rephrase_cost = self._rephrase_user_question(user_question)
+        result_sets = self.vector_store.query(rephrased_question, n_results=self.RETRIEVAL_CANDIDATES)
+        data_context = self._data_context(data_request)
+
+        persona, prompt = self._answer_prompt(user_question, result_sets, data_context=data_context)
+        generation_start = time.perf_counter()
+        generation = LLM.model_stream(persona, prompt, cache=self.indexing_complete)
+        first_piece = True
+        while True:
+            try:
+                piece = next(generation)
+            except StopIteration as stop:
+                ans, cost = stop.value
+                break
+            if first_piece:
+                # With streaming, the time to the first token is the latency the user actually waits for
+                METRICS.observe('first_token', time.perf_counter() - start)
+                first_piece = False
+            yield piece
+
+        METRICS.observe('generate', time.perf_counter() - generation_start)
+        METRICS.observe('answer', time.perf_counter() - start)
+        METRICS.inc('answers', path='llm')
+        self._semantic_cache_store(question_embedding, ans, rephrase_cost + cost)
+
+    async def aanswer_question(self, user_question, speculative=False):
+        """
+        Async variant of `answer_question`.
+
+        In speculative mode the raw user question is searched in the vector store while the question is being rephrased.
+        If the raw question already has a close enough match, the search with the rephrased question is skipped
+        (saving a round trip), otherwise both result sets are merged.
+        """
+        with dataflow_context(self.dataflow_name), METRICS.timer('answer'):
+            return await self._aanswer_question(user_question, speculative)
+
+    async def _aanswer_question(self, user_question, speculative):
+        fast_answer = self.lookup_index.answer(user_question)
+        if fast_answer is not None:
+            METRICS.inc('answers', path='lookup')
+            return fast_answer
+
+        data_request = self._data_request(user_question)
+        cached_answer, question_embedding = await asyncio.to_thread(self._semantic_cache_lookup, user_question, data_request)
+        if cached_answer is not None:
+            METRICS.inc('answers', path='semantic_cache')
+            return cached_answer
+
+        # The data query runs while the question is being rephrased and searched
+        data_task = asyncio.create_task(asyncio.to_thread(self._data_context, data_request)) if data_request is not None else None
+
+        if speculative:
+            (rephrased_question, rephrase_cost), raw_result_sets = await asyncio.gather(
+                  self._arephrase_user_question(user_question)
+                , self.vector_store.aquery(user_question, n_results=self.RETRIEVAL_CANDIDATES)
+            )
+            if raw_result_sets['distances'][0] and raw_result_sets['distances'][0][0] <= self.SPECULATIVE_DISTANCE_THRESHOLD:
+                result_sets = raw_result_sets
+            else:
+                rephrased_result_sets = await self.vector_store.aquery(rephrased_question, n_results=self.RETRIEVAL_CANDIDATES)
+                result_sets = self._merge_result_sets(rephrased_result_sets, raw_result_sets, n_results=self.RETRIEVAL_CANDIDATES)
+        else:
+            rephrased_question, rephrase_cost = await self._arephrase_user_question(user_question)
+            result_sets = await self.vector_store.aquery(rephrased_question, n_results=self.RETRIEVAL_CANDIDATES)
+
+        data_context = await data_task if data_task is not None else None
+        persona, prompt = self._answer_prompt(user_question, result_sets, data_context=data_context)
+        with METRICS.timer('generate'):
+            ans, cost = await LLM.amodel(persona, prompt, cache=self.indexing_complete)
+
+        METRICS.inc('answers', path='llm')
+        self._semantic_cache_store(question_embedding, ans, rephrase_cost + cost)
+        return ans
+
+    def answer_questions(self, user_questions, concurrency=BATCH_CONCURRENCY):
+        """
+        Answer a batch of questions (e.g. an evaluation run). Returns one result per question, in order:
+        {'question', 'answer', 'path' ('lookup', 'semantic_cache', 'llm', 'duplicate' or 'error'), 'cost', 'latency'}
+        A question whose LLM call (or data query) failed has no answer and the 'error', the others are still answered.
+
+        Questions that are the same once normalized are answered once. The rephrasing and the generation calls run
+        `concurrency` at a time, and all the rephrased questions are searched with a single vector store query.
+        The latency of a question is the time spent on it: its LLM calls and its share of the batched retrieval.
+        """
+        with dataflow_context(self.dataflow_name), METRICS.timer('batch'):
+            return self._answer_questions(list(user_questions), concurrency)
+
+    def _answer_questions(self, user_questions, concurrency):
+        # Normalized question -> position of its first occurrence
+        first = {}
+        for i, user_question in enumerate(user_questions):
+            first.setdefault(self.lookup_index.normalize(user_question), i)
+        unique = sorted(first.values())
+        results = {}
+
+        def result(i, answer, path, cost=0.0, latency=0.0, **extra):
+            results[i] = {'question': user_questions[i], 'answer': answer, 'path': path, 'cost': cost, 'latency': latency, **extra}
+
+        todo = []
+        for i in unique:
+            start = time.perf_counter()
+            fast_answer = self.lookup_index.answer(user_questions[i])
+            if fast_answer is not None:
+                METRICS.inc('answers', path='lookup')
+                result(i, fast_answer, 'lookup', latency=time.perf_counter() - start)
+            else:
+                todo.append(i)
+
+        # The embeddings of the semantic cache lookups in one request (the questions about numbers are not looked up)
+        data_requests = {i: self._data_request(user_questions[i]) for i in todo}
+        cacheable = [i for i in todo if data_requests[i] is None]
+        embeddings = {}
+        if semantic_cache is not None and cacheable:
+            start = time.perf_counter()
+            embeddings = dict(zip(cacheable, self.vector_store.embedding_function([user_questions[i] for i in cacheable])))
+            share = (time.perf_counter() - start) / len(cacheable)
+            for i in cacheable:
+                cached = semantic_cache.lookup(self.dataflow_name, embeddings[i])
+                if cached is not None:
+                    answer, saved = cached
+                    LLM.record_cache_hit(answer, saved, tier='semantic')
+                    METRICS.inc('answers', path='semantic_cache')
+                    result(i, answer, 'semantic_cache', latency=share)
+                    todo.remove(i)
+
+        if todo:
+            # The worker threads book the LLM usage on this dataflow too: each task runs in a copy of the context
+            def submit_all(executor, function, arguments):
+                return [executor.submit(contextvars.copy_context().run, function, *args) for args in arguments]
+
+            def timed(function, *args):
+                # A failed call fails its question only, not the batch: (result, seconds, None) or (None, seconds, error)
+                start = time.perf_counter()
+                try:
+                    return function(*args), time.perf_counter() - start, None
+                except Exception as e:
+                    return None, time.perf_counter() - start, e
+
+            def failed(i, error, latency):
+                print(f"Answering the question {user_questions[i]!r} of {self.dataflow_name} failed: {error}")
+                METRICS.inc('answers', path='error')
+                result(i, None, 'error', latency=latency, error=str(error))
+
+            with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+                # The data queries run next to the rephrasing
+                data_contexts = dict(zip(todo, submit_all(  executor, timed
+                                                          , [(self._data_context, data_requests[i]) for i in todo])))
+                rephrasings = submit_all(executor, timed, [(self._rephrase_user_question, user_questions[i]) for i in todo])
+                rephrased = dict(zip(todo, [future.result() for future in rephrasings]))
+                for i in [i for i in todo if rephrased[i][2] is not None]:
+                    failed(i, rephrased[i][2], rephrased[i][1])
+                    todo.remove(i)
+
+                generated = {}
+                if todo:
+                    start = time.perf_counter()
+                    result_sets = self.vector_store.query_many([rephrased[i][0][0] for i in todo],
+                                                               n_results=self.RETRIEVAL_CANDIDATES)
+                    retrieval_share = (time.perf_counter() - start) / len(todo)
+
+                    prompts = {}
+                    for query_index, i in enumerate(todo):
+                        data_context, data_time, error = data_contexts[i].result()
+                        if error is not None:
+                            failed(i, error, rephrased[i][1] + retrieval_share + data_time)
+                        else:
+                            prompts[i] = self._answer_prompt(user_questions[i], result_sets, query_index, data_context)
+                    generations = submit_all(executor, timed, [(self._generate, *prompt) for prompt in prompts.values()])
+                    generated = dict(zip(prompts, [future.result() for future in generations]))
+
+            for i, (generation, generate_time, error) in generated.items():
+                (_, rephrase_cost), rephrase_time, _ = rephrased[i]
+                latency = rephrase_time + retrieval_share + generate_time
+                if error is not None:
+                    failed(i, error, latency)
+                    continue
+                answer, cost = generation
+                METRICS.inc('answers', path='llm')
+                self._semantic_cache_store(embeddings.get(i), answer, rephrase_cost + cost)
+                result(i, answer, 'llm', rephrase_cost + cost, latency)
+
+        # The repeated questions get the answer of their first occurrence, without cost
+        answers = []
+        for i, user_question in enumerate(user_questions):
+            j = first[self.lookup_index.normalize(user_question)]
+            answers.append(results[i] if i == j else {**results[j], 'question': user_question, 'path': 'duplicate',
+                                                       'cost': 0.0, 'latency': 0.0})
+        return answers
+
+    def _generate(self, persona, prompt):
+        with METRICS.timer('generate'):
+            return LLM.model(persona, prompt, cache=self.indexing_complete)
+
+    def _semantic_cache_lookup(self, user_question, data_request=None):
+        """
+        Return the cached answer of a similar question (or None) and the embedding of the question. The questions with
+        a data request are not looked up: "... France in 2020" and "... France in 2021" are similar, their answers are not.
+        """
+        if semantic_cache is None or data_request is not None:
+            return None, None
+
+        question_embedding = self.vector_store.embedding_function([user_question])[0]
+        cached = semantic_cache.lookup(self.dataflow_name, question_embedding)
+        if cached is None:
+            return None, question_embedding
+
+        answer, saved = cached
+        LLM.record_cache_hit(answer, saved, tier='semantic')
+        return answer, question_embedding
+
+    def _semantic_cache_store(self, question_embedding, answer, cost):
+        # An answer given while the code documents are still being indexed was retrieved without them: it is not
+        # kept (nor is the response in the exact-match cache, see `LLM.log_interaction`)
+        if semantic_cache is not None and question_embedding is not None and self.indexing_complete:
+            semantic_cache.store(self.dataflow_name, question_embedding, answer, cost)
+
+    def _data_request(self, user_question):
+        """The observations the question asks for (see data_engine.py), None if it does not ask for numbers."""
+        if not DATA_GROUNDING or not self.df_info.df_dimension_order:
+            return None
+        return parse_data_request(user_question, self.lookup_index, self.df_info.df_dimension_order)
+
+    def _data_context(self, data_request):
+        """The observations of the data request as statements for the prompt, None without a request (or on errors)."""
+        if data_request is None:
+            return None
+        try:
+            table = DATA_ENGINE.query(  self.dataflow_name
+                                      , self.df_info
+                                      , filters=data_request.filters
+                                      , start_year=data_request.start_year
+                                      , end_year=data_request.end_year)
+        except (requests.RequestException, ValueError) as e:
+            # The registry could not be reached or its response was not usable: the answer is still grounded in the
+            # structure. Anything else is a bug and is raised
+            print(f"The data query of {self.dataflow_name} failed: {e}")
+            METRICS.inc('data_queries', status='error')
+            return None
+        return table.describe(self.df_info, max_rows=DATA_CONTEXT_ROWS)
+
+    @staticmethod
+    def _merge_result_sets(*result_sets_list, n_results=3):
+        """Merge single-query result sets: drop the duplicates and keep the n closest entries."""
+        hits = {}
+        for result_sets in result_sets_list:
+            for id_, document, metadata, distance in zip(  result_sets['ids'][0]
+                                                         , result_sets['documents'][0]
+                                                         , result_sets['metadatas'][0]
+                                                         , result_sets['distances'][0]):
+                if id_ not in hits or distance < hits[id_][2]:
+                    hits[id_] = (document, metadata, distance)
+        closest = sorted(hits.items(), key=lambda item: item[1][2])[:n_results]
+        return {
+            'ids': [[id_ for id_, _ in closest]],
+            'documents': [[document for _, (document, _, _) in closest]],
+            'metadatas': [[metadata for _, (_, metadata, _) in closest]],
+            'distances': [[distance for _, (_, _, distance) in closest]],
+        }
+
+    def _answer_prompt(self, user_question, result_sets, query_index=0, data_context=None):
+        # The distinct retrieved statements, closest first, within the token budget of the context
+        context = self.context_builder.build(result_sets, query_index)
+        # The observations of the data query, if the question asks for numbers
+        data = f"""
+        The observations in the data of the table that match the question are:
+        '''
+{data_context}
+        '''
+        Please base the numbers in your answer on these observations only, and say which observations they are.
+        """ if data_context else ''
         persona = """You are a helpful data analyst working for OECD."""
         prompt = f"""
         Please provide the answer to the following user question: 
         {user_question}
         Please use the information from the source that was selected as the best source to answer the question!
-        These are the most similar questions to the user question:
-        '''{result_sets['documents'][0]}'''
-        
-        The metadata in your knowledgebase that corresponds most to the questions are:
-        '''{result_sets['metadatas']}'''
-        
+        The information in your knowledgebase that corresponds most to the question is (closest first):
+        '''
+{context}
+        '''
+        {data}
         Very important: Not having any relevant information in your knowledgebase related to the user's question is likely and acceptable. So, please make sure to:
             - ask for clarification, if the question is not clear.
             - let the user know if you don't have relevant information in your knowledgebase. 
         """
-
-        ans, cost = LLM.model(persona, prompt)
-        return ans
+        return persona, prompt
     
 
     def _rephrase_user_question(self, user_question):
@@ -74,6 +494,21 @@ class Bot:
         The idea is to provide consistency in the questions asked instead of having to store all possible ways of asking the same question.
         """
 
+        persona, prompt = self._rephrase_prompt(user_question)
+        with METRICS.timer('rephrase'):
+            rephrased_question, cost = LLM.model(persona, prompt)
+
+        return rephrased_question, cost
+
+    async def _arephrase_user_question(self, user_question):
+        persona, prompt = self._rephrase_prompt(user_question)
+        with METRICS.timer('rephrase'):
+            rephrased_question, cost = await LLM.amodel(persona, prompt)
+
+        return rephrased_question, cost
+
+    @staticmethod
+    def _rephrase_prompt(user_question):
         persona = """You are a helpful data analyst working for OECD."""
         prompt = f"""
         Your task is to rephrase the user question to improve the search results.
@@ -95,7 +530,4 @@ class Bot:
         Please rephrase the following user question:
         {user_question}
         """
-
-        rephrased_question, cost = LLM.model(persona, prompt)
-
-        return rephrased_question
+        return persona, prompt
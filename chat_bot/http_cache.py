@@ -0,0 +1,218 @@
+"""
+HTTP Cache Module
+
+A connection-pooled HTTP session with an on-disk cache for SDMX structure messages.
+
+Structures change maybe once a release, so there is no point in downloading them every time a bot is built.
+Responses are stored gzip-compressed on disk, keyed by URL and Accept header. Within the TTL they are served
+from disk without any request; after that they are revalidated with a conditional request (ETag /
+If-Modified-Since), so an unchanged structure only costs a 304.
+
+Key Features:
+- Keep-alive connection pool shared by every Dataflow (and thread) of the process
+- Timeouts, and retries with exponential backoff on connection errors, 429 and 5xx (honouring Retry-After)
+- Compressed on-disk cache with a configurable TTL and conditional revalidation
+- Falls back to the stale cached copy if the registry cannot be reached
+- Optionally keeps the copy that a download replaced, to compare the old and the new structure (see reindex.py)
+
+Usage:
+    ```python
+    session = get_shared_session()
+    with session.open(url, headers={'Accept': 'application/json'}) as f:
+        data = json.load(f)
+    ```
+
+Configuration (environment variables):
+    SDMX_CACHE_DIR: directory of the cache (default: .sdmx_cache)
+    SDMX_CACHE_TTL: seconds before a cached response is revalidated (default: 86400)
+"""
+
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+class CachedSession:
+    """A pooled `requests.Session` that caches the response bodies on disk."""
+
+    def __init__(  self
+                 , cache_dir='.sdmx_cache'
+                 , ttl=24 * 3600
+                 , timeout=(10, 120)
+                 , retries=5
+                 , backoff_factor=0.5
+                 , pool_maxsize=16
+                 , chunk_size=1 << 16):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.timeout = timeout
+        self.chunk_size = chunk_size
+
+        retry = Retry(  total=retries
+                      , backoff_factor=backoff_factor
+                      , status_forcelist=RETRY_STATUS_CODES
+                      , allowed_methods=frozenset(['GET', 'HEAD'])
+                      , respect_retry_after_header=True)
+        adapter = HTTPAdapter(pool_connections=pool_maxsize, pool_maxsize=pool_maxsize, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+
+    def open(self, url, headers=None, ttl=None):
+        """Return a binary file object of the (decompressed) response body, fetching or revalidating it if needed."""
+        return self.open_fetched(self.fetch(url, headers, ttl))
+
+    @staticmethod
+    def open_fetched(entry):
+        """Return a binary file object of the (decompressed) body of an entry returned by `fetch`, without any request."""
+        return gzip.open(entry['path'], 'rb')
+
+    def get_json(self, url, headers=None, ttl=None):
+        with self.open(url, headers, ttl) as f:
+            return json.load(f)
+
+    def fetch(self, url, headers=None, ttl=None, keep_previous=False):
+        """
+        Make sure that the cache holds an up-to-date copy of the response and return its metadata.
+        With `keep_previous`, the copy replaced by a new download is kept (see `open_previous`).
+        The 'status' of the returned metadata is one of:
+            'fresh'       - served from the cache, within the TTL
+            'revalidated' - the server confirmed that the cached copy is still valid (304)
+            'downloaded'  - the body was (re)downloaded, i.e. it is new or it has changed
+            'stale'       - the server could not be reached, the expired cached copy is served
+        """
+        headers = dict(headers or {})
+        ttl = self.ttl if ttl is None else ttl
+        key = self._cache_key(url, headers)
+
+        with self._lock_for(key):
+            meta = self._load_meta(key)
+            if meta is not None and time.time() - meta['fetched_at'] < ttl:
+                return {**meta, 'status': 'fresh'}
+
+            request_headers = dict(headers)
+            if meta is not None:
+                if meta.get('etag'):
+                    request_headers['If-None-Match'] = meta['etag']
+                if meta.get('last_modified'):
+                    request_headers['If-Modified-Since'] = meta['last_modified']
+
+            try:
+                response = self.session.get(url, headers=request_headers, timeout=self.timeout, stream=True)
+            except requests.RequestException as e:
+                if meta is None:
+                    raise
+                print(f"Could not revalidate {url} ({e}), using the cached copy")
+                return {**meta, 'status': 'stale'}
+
+            with response:
+                if response.status_code == 304 and meta is not None:
+                    meta['fetched_at'] = time.time()
+                    self._save_meta(key, meta)
+                    return {**meta, 'status': 'revalidated'}
+
+                response.raise_for_status()
+                if keep_previous and meta is not None:
+                    os.replace(self._body_path(key), self._previous_body_path(key))
+                meta = self._store(key, url, response)
+                return {**meta, 'status': 'downloaded'}
+
+    def open_previous(self, url, headers=None):
+        """
+        Return a binary file object of the copy that the last download of the URL replaced (see `fetch`).
+        Raises FileNotFoundError if there is none.
+        """
+        return gzip.open(self._previous_body_path(self._cache_key(url, dict(headers or {}))), 'rb')
+
+    def invalidate(self, url=None, headers=None):
+        """Remove a cached response (or every cached response, if no URL is given)."""
+        if url is None:
+            shutil.rmtree(self.cache_dir, ignore_errors=True)
+            return
+        key = self._cache_key(url, dict(headers or {}))
+        for path in (self._body_path(key), self._meta_path(key), self._previous_body_path(key)):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _store(self, key, url, response):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        body_path = self._body_path(key)
+        tmp_path = f'{body_path}.{threading.get_ident()}.tmp'
+        size = 0
+        with gzip.open(tmp_path, 'wb', compresslevel=6) as f:
+            for chunk in response.iter_content(chunk_size=self.chunk_size):
+                f.write(chunk)
+                size += len(chunk)
+        os.replace(tmp_path, body_path)
+
+        meta = {
+            'url': url,
+            'path': body_path,
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'fetched_at': time.time(),
+            'size': size,
+        }
+        self._save_meta(key, meta)
+        return meta
+
+    def _lock_for(self, key):
+        with self._locks_lock:
+            return self._locks.setdefault(key, threading.Lock())
+
+    @staticmethod
+    def _cache_key(url, headers):
+        accept = headers.get('Accept', '')
+        return hashlib.sha256(f'{url}|{accept}'.encode('utf-8')).hexdigest()
+
+    def _body_path(self, key):
+        return os.path.join(self.cache_dir, f'{key}.gz')
+
+    def _previous_body_path(self, key):
+        return os.path.join(self.cache_dir, f'{key}.previous.gz')
+
+    def _meta_path(self, key):
+        return os.path.join(self.cache_dir, f'{key}.meta.json')
+
+    def _load_meta(self, key):
+        try:
+            with open(self._meta_path(key), encoding='utf-8') as f:
+                meta = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        # The cache directory may have been moved since the metadata was written
+        meta['path'] = self._body_path(key)
+        return meta if os.path.exists(meta['path']) else None
+
+    def _save_meta(self, key, meta):
+        tmp_path = f'{self._meta_path(key)}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(meta, f, indent=2)
+        os.replace(tmp_path, self._meta_path(key))
+
+
+_shared_session = None
+_shared_session_lock = threading.Lock()
+
+
+def get_shared_session():
+    """Return the process-wide cached session, configured from the environment."""
+    global _shared_session
+    with _shared_session_lock:
+        if _shared_session is None:
+            _shared_session = CachedSession(  cache_dir=os.getenv('SDMX_CACHE_DIR', '.sdmx_cache')
+                                            , ttl=int(os.getenv('SDMX_CACHE_TTL', 24 * 3600)))
+        return _shared_session
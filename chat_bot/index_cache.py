@@ -0,0 +1,209 @@
+"""
+Index Cache Module
+
+Keeps track of the vector store collections that were built from dataflows, so that a dataflow that has
+already been embedded does not have to be embedded again.
+
+A collection is identified by the dataflow name (e.g. 'OECD.EDU.IMEP:DSD_EAG_IT@DF_EAG_IT_AGE(1.1)') and a hash
+of the flattened question/answer pairs produced by `flatten_info`. If either of them changes, a new collection is
+built; otherwise the existing one is reused. The bookkeeping lives in a small JSON manifest next to the ChromaDB
+files, and the number of cached collections is capped: the least recently used ones are deleted first.
+
+The cap is stored in the manifest too: a bulk build (see build_index.py) raises it to the size of the catalogue with
+`reserve`, so that the app, which opens the same manifest with the default cap, does not evict the collections that
+were built in advance. The manifest is re-read when another process (or IndexCache) has written it.
+
+Usage:
+    ```python
+    cache = IndexCache(client)
+    content_hash = IndexCache.content_hash(flat_info_for_embedding)
+    collection_name = cache.lookup(dataflow_name, content_hash)
+    if collection_name is None:
+        collection_name = IndexCache.collection_name(dataflow_name, content_hash)
+        ...  # build the collection
+        cache.register(dataflow_name, content_hash, collection_name)
+    ```
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+
+
+class IndexCache:
+    """LRU registry of the collections stored in the ChromaDB persistent client."""
+
+    MANIFEST_NAME = 'index_cache.json'
+    # `touch` writes the manifest at most this often (seconds) per collection
+    TOUCH_INTERVAL = 60
+
+    def __init__(self, client, path='.chroma.db', max_collections=20):
+        self.client = client
+        self.path = path
+        self.default_max_collections = max_collections
+        self.max_collections = max_collections
+        self.manifest_path = os.path.join(path, self.MANIFEST_NAME)
+        self._lock = threading.RLock()
+        self._manifest_version = None
+        self._entries = {}
+        self._reload()
+
+    @staticmethod
+    def content_hash(flat_info_for_embedding, embedding_model=''):
+        """Hash the flattened question/answer pairs (and the embedding model used to vectorize them)."""
+        digest = hashlib.sha256(embedding_model.encode('utf-8'))
+        for question, answer in flat_info_for_embedding:
+            digest.update(json.dumps([str(question), str(answer)], ensure_ascii=False).encode('utf-8'))
+        return digest.hexdigest()
+
+    @staticmethod
+    def collection_name(dataflow_name, content_hash):
+        """
+        ChromaDB only accepts short alphanumeric collection names, so the dataflow name cannot be used directly.
+        The name is derived from the cache key instead.
+        """
+        key = hashlib.sha1(f'{dataflow_name}|{content_hash}'.encode('utf-8')).hexdigest()
+        return f'df-{key[:32]}'
+
+    def lookup(self, dataflow_name, content_hash):
+        """Return the name of the cached collection for the key, or None if it has to be built."""
+        with self._lock:
+            self._reload()
+            collection_name = self.collection_name(dataflow_name, content_hash)
+            entry = self._entries.get(collection_name)
+            if entry is None:
+                return None
+            if collection_name not in self._existing_collection_names():
+                # The collection was deleted behind our back, forget about it
+                del self._entries[collection_name]
+                self._save_manifest()
+                return None
+            entry['last_used'] = time.time()
+            self._save_manifest()
+            return collection_name
+
+    def touch(self, collection_name):
+        """Mark a cached collection as used, e.g. by the resident bot answering from it, so that it is not evicted."""
+        with self._lock:
+            self._reload()
+            entry = self._entries.get(collection_name)
+            now = time.time()
+            if entry is not None and now - entry['last_used'] >= self.TOUCH_INTERVAL:
+                entry['last_used'] = now
+                self._save_manifest()
+
+    def register(self, dataflow_name, content_hash, collection_name):
+        """Record a freshly built collection and evict the least recently used ones above the cap."""
+        with self._lock:
+            self._reload()
+            now = time.time()
+            self._entries[collection_name] = {
+                'dataflow_name': dataflow_name,
+                'content_hash': content_hash,
+                'created': now,
+                'last_used': now,
+            }
+            self._evict(keep=collection_name)
+            self._save_manifest()
+
+    def replace(self, old_collection_name, dataflow_name, content_hash, collection_name):
+        """
+        Record that a cached collection was updated in place and renamed (see reindex.py): the old entry is
+        dropped without deleting the collection, and the collection is registered under its new key.
+        """
+        with self._lock:
+            self._reload()
+            self._entries.pop(old_collection_name, None)
+            self.register(dataflow_name, content_hash, collection_name)
+
+    def remove(self, collection_name):
+        """Delete a cached collection, e.g. one that an updated copy superseded."""
+        with self._lock:
+            self._reload()
+            self._delete_collection(collection_name)
+            self._save_manifest()
+
+    def invalidate(self, dataflow_name=None):
+        """
+        Delete the cached collections of a dataflow (or of all dataflows, if no name is given).
+        Returns the number of collections removed.
+        """
+        with self._lock:
+            self._reload()
+            to_remove = [
+                name for name, entry in self._entries.items()
+                if dataflow_name is None or entry['dataflow_name'] == dataflow_name
+            ]
+            for name in to_remove:
+                self._delete_collection(name)
+            self._save_manifest()
+            return len(to_remove)
+
+    def entries(self):
+        """Return a copy of the manifest, most recently used first."""
+        with self._lock:
+            self._reload()
+            return dict(sorted(self._entries.items(), key=lambda item: item[1]['last_used'], reverse=True))
+
+    def reserve(self, max_collections):
+        """Raise the cap to at least `max_collections`, for every IndexCache of the manifest (e.g. for a bulk build)."""
+        with self._lock:
+            self._reload()
+            if max_collections > self.max_collections:
+                self.max_collections = max_collections
+                self._save_manifest()
+
+    def _evict(self, keep=None):
+        candidates = sorted(
+            (name for name in self._entries if name != keep),
+            key=lambda name: self._entries[name]['last_used']
+        )
+        while len(self._entries) > self.max_collections and candidates:
+            name = candidates.pop(0)
+            print(f"Evicting cached collection {name} ({self._entries[name]['dataflow_name']})")
+            self._delete_collection(name)
+
+    def _delete_collection(self, name):
+        try:
+            self.client.delete_collection(name)
+        except Exception:
+            # Already gone from the vector store
+            pass
+        self._entries.pop(name, None)
+
+    def _existing_collection_names(self):
+        return {collection.name for collection in self.client.list_collections()}
+
+    def _version(self):
+        try:
+            stat = os.stat(self.manifest_path)
+        except FileNotFoundError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+    def _reload(self):
+        """Read the manifest again if it was written since this IndexCache last read or wrote it."""
+        version = self._version()
+        if version is None or version == self._manifest_version:
+            return
+        try:
+            with open(self.manifest_path, encoding='utf-8') as f:
+                manifest = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return
+        if 'collections' not in manifest:
+            # The manifests written before the cap was stored only hold the entries
+            manifest = {'collections': manifest}
+        self._entries = manifest['collections']
+        self.max_collections = max(self.default_max_collections, manifest.get('max_collections', 0))
+        self._manifest_version = version
+
+    def _save_manifest(self):
+        os.makedirs(self.path, exist_ok=True)
+        tmp_path = f'{self.manifest_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'max_collections': self.max_collections, 'collections': self._entries}, f, indent=2)
+        os.replace(tmp_path, self.manifest_path)
+        self._manifest_version = self._version()
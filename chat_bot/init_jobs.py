@@ -0,0 +1,155 @@
+"""
+Init Jobs Module
+
+Builds bots in the background, so that `/initialize_bot` answers at once with a job ID instead of holding the request
+(and a worker) for the whole fetch, parse and embedding of a dataflow.
+
+Key Features:
+- A small pool of worker threads builds the bots through the `BotRegistry`
+- Every job reports its stage ('queued', 'fetching', 'flattening', 'indexing_names', 'indexing_codes', 'ready') and
+  how far along it is in percent
+- The bot is put in the registry as soon as its name and dimension documents are indexed ("ready"), while the code
+  documents are still being indexed ("done" comes later)
+- Requests for a dataflow that is already being built get the job of the build in flight instead of a new one
+- Finished jobs are forgotten after `retention` seconds
+
+Usage:
+    ```python
+    jobs = InitJobManager(bot_registry, workers=2)
+    job = jobs.submit('OECD.EDU.IMEP:DSD_EAG_IT@DF_EAG_IT_AGE(1.1)')
+    jobs.get(job.job_id).to_dict()  # {'job_id': ..., 'stage': 'indexing_codes', 'percent': 40, 'ready': True, ...}
+    ```
+"""
+
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+
+class InitJob:
+    """The state of the background build of one bot."""
+
+    def __init__(self, dataflow_name):
+        self.job_id = uuid.uuid4().hex
+        self.dataflow_name = dataflow_name
+        self.stage = 'queued'
+        self.percent = 0
+        self.ready = False   # the bot answers questions
+        self.done = False    # the build is over (successfully or not)
+        self.error = None
+        self.created_at = time.time()
+        self.finished_at = None
+
+    @property
+    def status(self):
+        if self.error is not None:
+            return 'failed'
+        if self.done:
+            return 'done'
+        return 'ready' if self.ready else ('running' if self.stage != 'queued' else 'queued')
+
+    def update(self, stage, percent):
+        self.stage = stage
+        # The stages can be reported out of order by the threads of the build, the percentage never goes back
+        self.percent = max(self.percent, int(percent))
+
+    def finish(self, error=None):
+        self.error = error
+        if error is None:
+            self.ready = True
+            self.update('ready', 100)
+        self.done = True
+        self.finished_at = time.time()
+
+    def to_dict(self):
+        return {  'job_id': self.job_id
+                , 'dataflow': self.dataflow_name
+                , 'status': self.status
+                , 'stage': self.stage
+                , 'percent': self.percent
+                , 'ready': self.ready
+                , 'done': self.done
+                , 'error': self.error
+                , 'elapsed': round((self.finished_at or time.time()) - self.created_at, 1)}
+
+
+class InitJobManager:
+    """Runs the builds of the bots of a `BotRegistry` on a pool of worker threads."""
+
+    def __init__(self, bot_registry, workers=2, retention=60 * 60):
+        self.bot_registry = bot_registry
+        self.retention = retention
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='bot-init')
+        self._jobs = {}     # job id -> job
+        self._active = {}   # dataflow name -> job of the build in flight
+        self._latest = {}   # dataflow name -> last submitted job (e.g. to report its failure)
+        self._lock = threading.Lock()
+
+    def submit(self, dataflow_name):
+        """Start building the bot of the dataflow (unless it is already resident or being built) and return the job."""
+        with self._lock:
+            self._prune()
+            job = self._active.get(dataflow_name)
+            if job is not None:
+                return job
+
+            job = InitJob(dataflow_name)
+            self._jobs[job.job_id] = job
+            self._latest[dataflow_name] = job
+            # `get`, not `in`: a bot past its idle timeout is dropped and built again
+            if self.bot_registry.get(dataflow_name) is not None:
+                job.finish()
+                return job
+
+            self._active[dataflow_name] = job
+        self._executor.submit(self._run, job)
+        return job
+
+    def get(self, job_id):
+        """Return the job, or None if it is unknown (or has been forgotten)."""
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def active_job(self, dataflow_name):
+        """Return the job of the build of the dataflow in flight, if any."""
+        with self._lock:
+            return self._active.get(dataflow_name)
+
+    def last_job(self, dataflow_name):
+        """Return the last job submitted for the dataflow (in flight or finished), None if there is none."""
+        with self._lock:
+            return self._latest.get(dataflow_name)
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+    def _run(self, job):
+        def on_ready(bot):
+            # From now on the chat requests find the bot in the registry, while the codes are still being indexed
+            self.bot_registry.put(job.dataflow_name, bot)
+            job.ready = True
+
+        try:
+            self.bot_registry.get_or_create(  job.dataflow_name
+                                            , progress_callback=job.update
+                                            , ready_callback=on_ready)
+        except Exception as e:
+            print(f"Initializing the bot of {job.dataflow_name} failed: {e}")
+            # A partially built bot must not stay resident
+            if job.ready:
+                self.bot_registry.remove(job.dataflow_name)
+            job.finish(error=str(e))
+        else:
+            job.finish()
+        finally:
+            with self._lock:
+                self._active.pop(job.dataflow_name, None)
+
+    def _prune(self):
+        now = time.time()
+        for job_id, job in list(self._jobs.items()):
+            if job.done and now - job.finished_at > self.retention:
+                del self._jobs[job_id]
+                if self._latest.get(job.dataflow_name) is job:
+                    del self._latest[job.dataflow_name]
@@ -0,0 +1,236 @@
+"""
+Lookup Index Module
+
+An in-memory inverted index over the dimension and code names of a dataflow, used as a fast path in front of the LLM.
+
+A large share of the user questions are plain lookups that `flatten_dimensions` and `flatten_codes` already have the
+exact answer for (e.g. "What is the English name of the code 'FRA' within the code list ID 'REF_AREA'?", or just
+"ISCED11_2"). When a question resolves to a single code or dimension with high confidence, it is answered from the
+index, without the rephrase, retrieval and generation round trips. Anything ambiguous falls through to the LLM.
+
+Matching:
+- exact keys: the codes, the code names, the dimension codes and the dimension names as they are
+- normalized keys: case-folded, punctuation and whitespace collapsed
+- fuzzy keys: close matches of the normalized names (difflib), only if there is a single close match. difflib only
+  compares the names that share character trigrams with the term and have a length it can match with (see
+  `TrigramIndex`), not every name of the dataflow
+
+Usage:
+    ```python
+    lookup_index = LookupIndex(df_info)
+    answer = lookup_index.answer("What does 'FRA' mean?")  # None if the question is not a confident lookup
+    lookup_index.stats()                                     # {'hits': 1, 'misses': 0, 'hit_rate': 1.0}
+    lookup_index.mentions('Teachers in France in 2020')      # {'REF_AREA': ['FRA']}, e.g. to filter a data query
+    ```
+"""
+
+import difflib
+import re
+import threading
+from collections import Counter
+
+from data_prep_for_indenxing import code_meta_statement, dimension_meta_statement
+
+
+class TrigramIndex:
+    """
+    The candidates of a fuzzy match among a set of keys: the keys of a length within the bounds of the cutoff, sorted
+    by the number of character trigrams they share with the term. A key with a SequenceMatcher ratio of at least the
+    cutoff shares most of its characters, and so trigrams, with the term.
+    """
+
+    def __init__(self, keys):
+        self.keys = list(keys)
+        self.trigrams = {}  # trigram -> positions of the keys containing it
+        for position, key in enumerate(self.keys):
+            for trigram in self._trigrams(key):
+                self.trigrams.setdefault(trigram, []).append(position)
+
+    @staticmethod
+    def _trigrams(text):
+        padded = f'  {text} '
+        return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+    def candidates(self, term, cutoff, limit=20):
+        # ratio = 2 * matches / (len(a) + len(b)) <= 2 * min(len(a), len(b)) / (len(a) + len(b))
+        shortest, longest = len(term) * cutoff / (2 - cutoff), len(term) * (2 - cutoff) / cutoff
+        shared = Counter()
+        for trigram in self._trigrams(term):
+            shared.update(self.trigrams.get(trigram, ()))
+        ranked = [self.keys[position] for position, _ in shared.most_common()
+                  if shortest <= len(self.keys[position]) <= longest]
+        return ranked[:limit]
+
+
+class LookupIndex:
+    """Exact, normalized and fuzzy lookup of the codes and dimensions of a dataflow."""
+
+    FUZZY_CUTOFF = 0.92
+
+    # The templated questions of data_prep_for_indenxing and a few common variations of them
+    CODE_NAME_PATTERNS = [
+        re.compile(r"english name of the code '(?P<term>[^']+)'(?: within the code list id '(?P<dim>[^']+)')?", re.I),
+        re.compile(r"what (?:does|is) (?:the )?(?:code )?'(?P<term>[^']+)' (?:mean|stand for)", re.I),
+    ]
+    CODE_PATTERNS = [
+        re.compile(r"what is the code for '(?P<term>[^']+)'(?: within the code list id '(?P<dim>[^']+)')?", re.I),
+    ]
+    DIMENSION_NAME_PATTERNS = [
+        re.compile(r"what name corresponds to the column code:? '(?P<term>[^']+)'", re.I),
+    ]
+    DIMENSION_CODE_PATTERNS = [
+        re.compile(r"what is the column code for '(?P<term>[^']+)'", re.I),
+    ]
+
+    def __init__(self, df_info):
+        # key -> set of (dimension code, code, code name)
+        self.codes = {}
+        self.code_names = {}
+        # key -> set of (dimension code, dimension name)
+        self.dimension_codes = {}
+        self.dimension_names = {}
+
+        for dim_code, dim_name in df_info.df_dimension_names.items():
+            self._add(self.dimension_codes, dim_code, (dim_code, dim_name))
+            self._add(self.dimension_names, dim_name, (dim_code, dim_name))
+        for dim_code, code_names in df_info.df_code_names.items():
+            for code, name in code_names.items():
+                self._add(self.codes, code, (dim_code, code, name))
+                self._add(self.code_names, name, (dim_code, code, name))
+
+        # The longest code name, in words: the longest phrase of a question worth looking up (see `mentions`)
+        self.max_name_words = min(max((len(key.split()) for key in self.code_names), default=1), 12)
+
+        # Built on the first fuzzy lookup in the index: id of the index -> TrigramIndex of its normalized keys
+        self._trigram_indexes = {}
+
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def normalize(text):
+        """Case-fold, replace punctuation with spaces and collapse whitespace (underscores are part of SDMX codes)."""
+        return ' '.join(re.sub(r"[^\w]+", ' ', str(text).casefold()).split())
+
+    def _add(self, index, key, value):
+        for variant in {str(key), self.normalize(key)}:
+            index.setdefault(variant, set()).add(value)
+
+    def answer(self, question):
+        """Return the answer to the question if it is a confident single lookup, None otherwise."""
+        answer = self._resolve(question)
+        with self._lock:
+            if answer is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return answer
+
+    def mentions(self, question):
+        """
+        Return the codes the question mentions, by name or by code (as written, e.g. 'FRA'), grouped by dimension:
+        {dimension code: [codes]}. The longest matching phrase wins, and a name of several dimensions is ignored.
+        """
+        found = {}
+
+        def add(entries):
+            if len({dim_code for dim_code, _, _ in entries}) == 1:
+                for dim_code, code, _ in sorted(entries):
+                    codes = found.setdefault(dim_code, [])
+                    if code not in codes:
+                        codes.append(code)
+
+        words = self.normalize(question).split()
+        i = 0
+        while i < len(words):
+            for n in range(min(self.max_name_words, len(words) - i), 0, -1):
+                entries = self.code_names.get(' '.join(words[i:i + n]))
+                if entries:
+                    add(entries)
+                    i += n
+                    break
+            else:
+                i += 1
+
+        # Codes only count as written: 'FRA' is France, 'fra' or 'a' are just words
+        for token in re.findall(r'\w+', question):
+            if len(token) > 1:
+                add({entry for entry in self.codes.get(token, ()) if entry[1] == token})
+        return found
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / total if total else 0.0}
+
+    def _resolve(self, question):
+        question = question.strip()
+
+        for pattern in self.CODE_NAME_PATTERNS:
+            match = pattern.search(question)
+            if match:
+                return self._code_answer(self._find(self.codes, match['term'], fuzzy=False), match.groupdict().get('dim'))
+        for pattern in self.CODE_PATTERNS:
+            match = pattern.search(question)
+            if match:
+                return self._code_answer(self._find(self.code_names, match['term']), match['dim'])
+        for pattern in self.DIMENSION_NAME_PATTERNS:
+            match = pattern.search(question)
+            if match:
+                return self._dimension_answer(self._find(self.dimension_codes, match['term'], fuzzy=False))
+        for pattern in self.DIMENSION_CODE_PATTERNS:
+            match = pattern.search(question)
+            if match:
+                return self._dimension_answer(self._find(self.dimension_names, match['term']))
+
+        # A bare code or name, e.g. "FRA" or "Upper secondary education?"
+        term = question.rstrip('?!. ').strip('\'"')
+        if not term:
+            return None
+        dimension_hits = self._find(self.dimension_codes, term, fuzzy=False) | self._find(self.dimension_names, term, fuzzy=False)
+        code_hits = self._find(self.codes, term, fuzzy=False) | self._find(self.code_names, term, fuzzy=False)
+        if dimension_hits and not code_hits:
+            return self._dimension_answer(dimension_hits)
+        if code_hits and not dimension_hits:
+            return self._code_answer(code_hits)
+        return None
+
+    def _find(self, index, term, fuzzy=True):
+        """Return the entries of the term: exact key first, then normalized key, then a single fuzzy match."""
+        if term in index:
+            return index[term]
+        normalized = self.normalize(term)
+        if normalized in index:
+            return index[normalized]
+        if fuzzy and normalized:
+            close_matches = difflib.get_close_matches(  normalized
+                                                      , self._trigram_index(index).candidates(normalized, self.FUZZY_CUTOFF)
+                                                      , n=5
+                                                      , cutoff=self.FUZZY_CUTOFF)
+            # The raw and the normalized key of the same name may both match, that is still a single match
+            entries = set().union(*(index[key] for key in close_matches))
+            if len(entries) == 1:
+                return entries
+        return set()
+
+    def _trigram_index(self, index):
+        trigram_index = self._trigram_indexes.get(id(index))
+        if trigram_index is None:
+            # Built twice at worst, by concurrent first lookups. Every key is in the index normalized too (see `_add`)
+            trigram_index = self._trigram_indexes[id(index)] = TrigramIndex({self.normalize(key) for key in index})
+        return trigram_index
+
+    def _code_answer(self, entries, dim=None):
+        if dim is not None:
+            entries = {entry for entry in entries if self.normalize(entry[0]) == self.normalize(dim)}
+        if len(entries) != 1:
+            return None
+        dim_code, code, name = next(iter(entries))
+        return code_meta_statement(dim_code, code, name)
+
+    def _dimension_answer(self, entries):
+        if len(entries) != 1:
+            return None
+        dim_code, dim_name = next(iter(entries))
+        return dimension_meta_statement(dim_code, dim_name)
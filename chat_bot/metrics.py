@@ -0,0 +1,232 @@
+"""
+Metrics Module
+
+A small, thread-safe instrumentation layer: counters, latency histograms per pipeline stage, token and cost
+accounting by model and dataflow, and a non-blocking, batched log writer.
+
+Stages:
+    building a bot:          fetch, parse, flatten, embed (one observation per embedding request)
+    answering a question:    retrieve, rephrase, generate, answer (the whole question)
+
+The dataflow that a token / cost is booked on is taken from a context variable (`dataflow_context`), so it follows
+the request through threads started with `asyncio.to_thread` and through the awaits of the async views.
+
+Usage:
+    ```python
+    with METRICS.timer('retrieve'):
+        result_sets = vector_store.query(question)
+
+    with dataflow_context('OECD.EDU.IMEP:DSD_EAG_IT@DF_EAG_IT_AGE(1.1)'):
+        METRICS.record_llm_usage('gpt-4o-mini', prompt_tokens=812, completion_tokens=64, cost=0.00016)
+
+    METRICS.snapshot()  # everything as a JSON-serializable dict, e.g. for the /metrics endpoint
+    ```
+"""
+
+import atexit
+import contextvars
+import logging
+import math
+import queue
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from logging.handlers import QueueHandler
+
+import numpy as np
+
+current_dataflow = contextvars.ContextVar('current_dataflow', default=None)
+
+
+@contextmanager
+def dataflow_context(dataflow_name):
+    """Book the tokens and costs of the block on the given dataflow."""
+    token = current_dataflow.set(dataflow_name)
+    try:
+        yield
+    finally:
+        current_dataflow.reset(token)
+
+
+class LatencyHistogram:
+    """Cumulative latency buckets, plus a window of the most recent samples for the percentiles."""
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, math.inf)
+
+    def __init__(self, window=1024):
+        self.bucket_counts = [0] * len(self.BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self._recent = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def observe(self, seconds):
+        with self._lock:
+            self.count += 1
+            self.sum += seconds
+            self.max = max(self.max, seconds)
+            self._recent.append(seconds)
+            for i, bound in enumerate(self.BUCKETS):
+                if seconds <= bound:
+                    self.bucket_counts[i] += 1
+                    break
+
+    def snapshot(self):
+        with self._lock:
+            recent = np.fromiter(self._recent, dtype=np.float64)
+            snapshot = {  'count': self.count
+                        , 'sum': self.sum
+                        , 'mean': self.sum / self.count if self.count else 0.0
+                        , 'max': self.max
+                        , 'buckets': {str(bound): count for bound, count
+                                      in zip(self.BUCKETS, np.cumsum(self.bucket_counts).tolist())}}
+        if recent.size:
+            p50, p95, p99 = np.percentile(recent, [50, 95, 99])
+            snapshot.update(p50=float(p50), p95=float(p95), p99=float(p99))
+        return snapshot
+
+
+class Metrics:
+    """Process-wide registry of the counters, the stage latencies and the LLM usage."""
+
+    def __init__(self):
+        self._counters = defaultdict(float)   # (name, sorted label items) -> value
+        self._stages = {}                     # stage -> LatencyHistogram
+        self._usage = {}                      # (model, dataflow) -> token, cost and saving totals
+        self._lock = threading.Lock()
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] += value
+
+    def observe(self, stage, seconds):
+        with self._lock:
+            histogram = self._stages.get(stage)
+            if histogram is None:
+                histogram = self._stages[stage] = LatencyHistogram()
+        histogram.observe(seconds)
+
+    @contextmanager
+    def timer(self, stage):
+        """Record the duration of the block in the latency histogram of the stage (also if it raises)."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def record_llm_usage(self, model, prompt_tokens, completion_tokens, cost):
+        with self._lock:
+            usage = self._usage_entry(model)
+            usage['calls'] += 1
+            usage['prompt_tokens'] += prompt_tokens
+            usage['completion_tokens'] += completion_tokens
+            usage['cost'] += cost
+
+    def record_cache_hit(self, model, saved, tier='exact'):
+        self.inc('llm_cache_hits', tier=tier)
+        with self._lock:
+            usage = self._usage_entry(model)
+            usage['cache_hits'] += 1
+            usage['saved'] += saved
+
+    def total_cost(self):
+        with self._lock:
+            return sum(usage['cost'] for usage in self._usage.values())
+
+    def total_saved(self):
+        with self._lock:
+            return sum(usage['saved'] for usage in self._usage.values())
+
+    def snapshot(self):
+        with self._lock:
+            counters = {}
+            for (name, labels), value in self._counters.items():
+                label = ','.join(f'{key}={value}' for key, value in labels)
+                counters[f'{name}{{{label}}}' if label else name] = value
+            usage = [{'model': model, 'dataflow': dataflow, **values} for (model, dataflow), values in self._usage.items()]
+            stages = dict(self._stages)
+        return {  'counters': counters
+                , 'stages': {stage: histogram.snapshot() for stage, histogram in stages.items()}
+                , 'llm_usage': usage
+                , 'total_cost': sum(entry['cost'] for entry in usage)
+                , 'total_saved': sum(entry['saved'] for entry in usage)}
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._stages.clear()
+            self._usage.clear()
+
+    def _usage_entry(self, model):
+        key = (model, current_dataflow.get())
+        if key not in self._usage:
+            self._usage[key] = {'calls': 0, 'prompt_tokens': 0, 'completion_tokens': 0, 'cost': 0.0,
+                                'cache_hits': 0, 'saved': 0.0}
+        return self._usage[key]
+
+
+METRICS = Metrics()
+
+
+class _BatchedFileWriter(threading.Thread):
+    """Drains the log queue on a background thread and writes the records in batches, one write and flush per batch."""
+
+    _STOP = object()
+
+    def __init__(self, log_queue, filename, formatter, batch_size=100, flush_interval=1.0):
+        super().__init__(name='log-writer', daemon=True)
+        self.log_queue = log_queue
+        self.filename = filename
+        self.formatter = formatter
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+    def run(self):
+        with open(self.filename, 'a', encoding='utf-8') as f:
+            while True:
+                try:
+                    batch = [self.log_queue.get(timeout=self.flush_interval)]
+                except queue.Empty:
+                    continue
+                while len(batch) < self.batch_size:
+                    try:
+                        batch.append(self.log_queue.get_nowait())
+                    except queue.Empty:
+                        break
+
+                f.write(''.join(f'{self.formatter.format(record)}\n' for record in batch if record is not self._STOP))
+                f.flush()
+                if any(record is self._STOP for record in batch):
+                    return
+
+    def stop(self):
+        self.log_queue.put(self._STOP)
+        self.join(timeout=5)
+
+
+_loggers = {}
+_loggers_lock = threading.Lock()
+
+
+def get_batched_logger(name, filename, fmt='%(asctime)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S'):
+    """
+    Return a logger whose records are queued on the calling thread and written to `filename` by a background thread,
+    so that logging never blocks a request on file I/O. The queue is flushed when the process exits.
+    """
+    with _loggers_lock:
+        if name not in _loggers:
+            log_queue = queue.SimpleQueue()
+            writer = _BatchedFileWriter(log_queue, filename, logging.Formatter(fmt, datefmt))
+            writer.start()
+            atexit.register(writer.stop)
+
+            logger = logging.getLogger(name)
+            logger.setLevel(logging.INFO)
+            logger.addHandler(QueueHandler(log_queue))
+            logger.propagate = False
+            _loggers[name] = logger
+        return _loggers[name]
@@ -0,0 +1,481 @@
+"""
+Incremental Re-indexing
+
+Keeps the vector stores of the catalogue up to date when the OECD publishes a new version of a dataflow or changes
+its content constraint, without rebuilding them from scratch.
+
+A collection is content-addressed (see index_cache.py), so any change to a dataflow used to mean a new collection and
+every document embedded again. Instead:
+    1. the structure is revalidated with a conditional request: an unchanged structure costs a 304 and nothing else
+    2. a changed structure is compared with the copy it replaced (kept by the HTTP cache): `diff_dataflows` reports
+       the changed names, dimensions, codes, labels and constraints
+    3. the documents of the old and the new structure are compared by their deterministic IDs: only the documents
+       that are new are embedded (the embedding of a question whose answer changed is reused), the ones that are
+       gone are deleted, and the existing collection is renamed to its new content address
+    4. the cached answers of a changed dataflow (see response_cache.py) are dropped
+
+Usage:
+    ```python
+    report = refresh_catalogue(load_catalogue(DEFAULT_CATALOGUE), check_versions=True)
+    print(format_report(report))
+
+    # In the app: refresh every CATALOGUE_REFRESH_INTERVAL seconds in the background
+    refresher = CatalogueRefresher(dataflow_names, interval=24 * 3600, bot_registry=bot_registry).start()
+    refresher.last_report
+    ```
+
+    python reindex.py                          # check the catalogue once and print what changed
+    python reindex.py --check-versions         # also move to the latest version of every dataflow
+    python reindex.py --interval 86400         # keep checking, once a day
+"""
+
+import argparse
+import json
+import math
+import os
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+
+from SDMX_DataFlow import Dataflow
+from data_prep_for_indenxing import flatten_info
+from chromaDB import ChromaDBWrapper, get_client, get_index_cache, document_id
+from vector_index import NumpyVectorIndex, VECTOR_BACKEND
+from embeddings import get_embedding_function, embedding_model_name
+from http_cache import get_shared_session
+from index_cache import IndexCache
+from codelist_store import CODELISTS
+from compact_dataflow import CompactDataflow, SNAPSHOTS
+from metrics import METRICS
+import grounded_llm
+
+DEFAULT_CATALOGUE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'grouped_edu_dataflows.json')
+
+
+@dataclass
+class DataflowDiff:
+    """The structural differences between two versions of a dataflow."""
+    name_changed: bool = False
+    description_changed: bool = False
+    dimensions_added: list[str] = field(default_factory=list)
+    dimensions_removed: list[str] = field(default_factory=list)
+    dimensions_renamed: dict[str, tuple[str, str]] = field(default_factory=dict)   # id -> (old name, new name)
+    codes_added: dict[str, list[str]] = field(default_factory=dict)               # dimension -> codes now allowed
+    codes_removed: dict[str, list[str]] = field(default_factory=dict)             # dimension -> codes not allowed anymore
+    labels_changed: dict[str, dict[str, tuple[str, str]]] = field(default_factory=dict)  # dimension -> code -> (old, new)
+
+    @property
+    def changed(self) -> bool:
+        return any((  self.name_changed, self.description_changed, self.dimensions_added, self.dimensions_removed
+                    , self.dimensions_renamed, self.codes_added, self.codes_removed, self.labels_changed))
+
+    def summary(self) -> str:
+        parts = []
+        if self.name_changed:
+            parts.append('name changed')
+        if self.description_changed:
+            parts.append('description changed')
+        for label, items in (('dimensions added', self.dimensions_added), ('dimensions removed', self.dimensions_removed),
+                             ('dimensions renamed', self.dimensions_renamed)):
+            if items:
+                parts.append(f"{label}: {', '.join(items)}")
+        for label, by_dimension in (('codes added', self.codes_added), ('codes removed', self.codes_removed),
+                                    ('labels changed', self.labels_changed)):
+            if by_dimension:
+                parts.append(f"{label}: " + ', '.join(f'{dimension} ({len(codes)})' for dimension, codes in by_dimension.items()))
+        return '; '.join(parts) if parts else 'no structural change'
+
+    def to_dict(self) -> dict:
+        return {  'name_changed': self.name_changed
+                , 'description_changed': self.description_changed
+                , 'dimensions_added': self.dimensions_added
+                , 'dimensions_removed': self.dimensions_removed
+                , 'dimensions_renamed': {key: list(names) for key, names in self.dimensions_renamed.items()}
+                , 'codes_added': self.codes_added
+                , 'codes_removed': self.codes_removed
+                , 'labels_changed': {dimension: {code: list(labels) for code, labels in codes.items()}
+                                     for dimension, codes in self.labels_changed.items()}}
+
+
+def diff_dataflows(old: Dataflow, new: Dataflow) -> DataflowDiff:
+    """Compare the names, the dimensions, the constrained codes and their labels of two versions of a dataflow."""
+    diff = DataflowDiff(  name_changed=old.df_name != new.df_name
+                        , description_changed=old.df_description != new.df_description)
+
+    old_dimensions, new_dimensions = old.df_dimension_names, new.df_dimension_names
+    diff.dimensions_added = [key for key in new_dimensions if key not in old_dimensions]
+    diff.dimensions_removed = [key for key in old_dimensions if key not in new_dimensions]
+    diff.dimensions_renamed = {key: (old_dimensions[key], name) for key, name in new_dimensions.items()
+                               if key in old_dimensions and old_dimensions[key] != name}
+
+    for dimension in dict.fromkeys([*old.df_code_names, *new.df_code_names]):
+        old_codes, new_codes = old.df_code_names.get(dimension, {}), new.df_code_names.get(dimension, {})
+        added = [code for code in new_codes if code not in old_codes]
+        removed = [code for code in old_codes if code not in new_codes]
+        relabelled = {code: (old_codes[code], name) for code, name in new_codes.items()
+                      if code in old_codes and old_codes[code] != name}
+        if added:
+            diff.codes_added[dimension] = added
+        if removed:
+            diff.codes_removed[dimension] = removed
+        if relabelled:
+            diff.labels_changed[dimension] = relabelled
+    return diff
+
+
+def diff_documents(old_flat_info, new_flat_info):
+    """Return the documents (id -> (question, answer)) that are new, and the IDs of the documents that are gone."""
+    old_ids = {document_id(question, answer) for question, answer in old_flat_info}
+    added = {}
+    for question, answer in new_flat_info:
+        id_ = document_id(question, answer)
+        if id_ not in old_ids:
+            added.setdefault(id_, (question, answer))
+    new_ids = {document_id(question, answer) for question, answer in new_flat_info}
+    return added, sorted(old_ids - new_ids)
+
+
+class _CachedCopy:
+    """Stands in for the HTTP session of a Dataflow, to parse a copy from the cache without any request."""
+
+    def __init__(self, session, previous=False):
+        self.session = session
+        self.previous = previous
+
+    def fetch(self, url, headers=None, ttl=None):
+        return {'status': 'cached', 'url': url, 'headers': headers}
+
+    def open_fetched(self, entry):
+        return self.open(entry['url'], entry['headers'])
+
+    def open(self, url, headers=None, ttl=None):
+        if self.previous:
+            return self.session.open_previous(url, headers)
+        return self.session.open(url, headers, ttl=math.inf)
+
+
+def _parse(url, session):
+    # The labels as published, not the ones of the codelist store (which may be the ones being replaced)
+    df_info = Dataflow(url, streaming=True, session=session, share_codelists=False)
+    df_info.populate_variables()
+    return df_info
+
+
+def latest_version_name(dataflow_name, session=None):
+    """Return the name of the latest version of the dataflow, e.g. '...DF_EAG_IT_AGE(1.2)' for '...DF_EAG_IT_AGE(1.1)'."""
+    agency, rest = dataflow_name.split(':')
+    id_part = rest.split('(')[0]
+    url = f'{grounded_llm.SDMX_REST_URL}/dataflow/{agency}/{id_part}/latest'
+    # The dataflow alone, without the referenced structures: a small message, revalidated like the others
+    dataflow = (session or get_shared_session()).get_json(url, headers=Dataflow.ACCEPT_HEADER, ttl=0)['data']['dataflows'][0]
+    version = dataflow.get('version')
+    return f'{agency}:{id_part}({version})' if version else dataflow_name
+
+
+def check_dataflow(dataflow_name, session=None, check_versions=False):
+    """
+    Revalidate the structure of the dataflow. Returns a dict with the 'status' of the check ('unchanged', 'changed'
+    or 'failed') and, if it changed, the parsed old and new structures (the old one is None if it is not known).
+    """
+    session = session or get_shared_session()
+    check = {'dataflow': dataflow_name, 'previous_name': None}
+    try:
+        if check_versions:
+            latest = latest_version_name(dataflow_name, session)
+            if latest != dataflow_name:
+                check.update(dataflow=latest, previous_name=dataflow_name)
+
+        url = grounded_llm.Bot._get_dataflow_url_from_name(check['dataflow'])
+        cached = session.fetch(url, headers=Dataflow.ACCEPT_HEADER, ttl=0, keep_previous=True)
+        METRICS.inc('structure_fetches', status=cached['status'])
+        if cached['status'] == 'stale':
+            return {**check, 'status': 'failed', 'error': 'the registry could not be reached'}
+        if cached['status'] != 'downloaded' and check['previous_name'] is None:
+            return {**check, 'status': 'unchanged'}
+
+        new_info = _parse(url, _CachedCopy(session))
+        if check['previous_name'] is not None:
+            # A new version: compare with the current copy of the version in the catalogue
+            old_url = grounded_llm.Bot._get_dataflow_url_from_name(check['previous_name'])
+            old_info = _parse(old_url, _CachedCopy(session))
+        else:
+            try:
+                old_info = _parse(url, _CachedCopy(session, previous=True))
+            except FileNotFoundError:
+                # First download of this structure: there is nothing to compare it with
+                old_info = None
+        return {**check, 'status': 'changed', 'new_info': new_info, 'old_info': old_info}
+    except Exception as e:
+        return {**check, 'status': 'failed', 'error': str(e)}
+
+
+def invalidate_answers(*dataflow_names):
+    """Forget the cached answers of the dataflows (see response_cache.py): they were given from the old structure."""
+    if grounded_llm.semantic_cache is not None:
+        for dataflow_name in set(dataflow_names):
+            grounded_llm.semantic_cache.invalidate(dataflow_name)
+
+
+def reindex_dataflow(  dataflow_name
+                     , new_info
+                     , old_info=None
+                     , previous_name=None
+                     , index_cache=None
+                     , embedding_function=None
+                     , backend=None
+                     , build_missing=False):
+    """
+    Bring the vector store of the dataflow up to date with `new_info`, starting from the store of `old_info`
+    (of `previous_name`, for a new version). The cached answers of the dataflow are dropped if its documents changed.
+    Returns what was done:
+        'status': 'unchanged' (the store is up to date), 'updated' (changed documents applied to the old store),
+                  'rebuilt' (no old store; only with `build_missing`) or 'not_indexed'
+    """
+    embedding_function = embedding_function or get_embedding_function()
+    backend = backend or VECTOR_BACKEND
+    model = embedding_model_name(embedding_function)
+    previous_name = previous_name or dataflow_name
+
+    new_flat_info = flatten_info(new_info)
+    new_hash = IndexCache.content_hash(new_flat_info, model)
+    old_flat_info = flatten_info(old_info) if old_info is not None else []
+    added, removed = diff_documents(old_flat_info, new_flat_info)
+    if added or removed:
+        invalidate_answers(dataflow_name, previous_name)
+    result = {  'dataflow': dataflow_name
+              , 'documents_added': len(added)
+              , 'documents_removed': len(removed)
+              , 'embedded': 0}
+
+    if backend == 'numpy':
+        return _reindex_numpy(result, new_info, new_flat_info, old_flat_info, previous_name, embedding_function, build_missing)
+
+    index_cache = index_cache or get_index_cache()
+    if index_cache.lookup(dataflow_name, new_hash) is not None:
+        return {**result, 'status': 'unchanged'}
+
+    old_collection_name = None
+    if old_info is not None:
+        old_collection_name = index_cache.lookup(previous_name, IndexCache.content_hash(old_flat_info, model))
+    if old_collection_name is None:
+        if not build_missing:
+            return {'dataflow': dataflow_name, 'status': 'not_indexed'}
+        store = ChromaDBWrapper(  new_flat_info
+                                , dataflow_name=dataflow_name
+                                , index_cache=index_cache
+                                , precomputed_embeddings=CODELISTS.shared_embeddings(new_info)
+                                , embedding_function=embedding_function)
+        CODELISTS.share_embeddings(new_info, store.computed_embeddings)
+        return {**result, 'status': 'rebuilt', 'embedded': len(store.computed_embeddings)}
+
+    client = get_client()
+    old_collection = client.get_collection(name=old_collection_name, embedding_function=embedding_function)
+    # The embedding is the one of the question text: a document of which only the answer changed keeps it
+    reusable = {}
+    for start in range(0, len(removed), 5000):
+        rows = old_collection.get(ids=removed[start:start + 5000], include=['documents', 'embeddings'])
+        reusable.update(zip(rows['documents'], rows['embeddings']))
+
+    new_collection_name = IndexCache.collection_name(dataflow_name, new_hash)
+    in_place = previous_name == dataflow_name
+    if in_place:
+        try:
+            # The leftover of an interrupted update under the new name
+            client.delete_collection(new_collection_name)
+        except Exception:
+            pass
+        old_collection.modify(name=new_collection_name)
+    else:
+        # A new version gets a collection of its own (the catalogue may still use the old one): only the embeddings
+        # are carried over
+        rows = old_collection.get(include=['documents', 'embeddings'])
+        reusable.update(zip(rows['documents'], rows['embeddings']))
+
+    # Opens the renamed collection (or creates the one of the new version) without writing anything yet
+    store = ChromaDBWrapper(  new_flat_info
+                            , dataflow_name=dataflow_name
+                            , precomputed_embeddings={**CODELISTS.shared_embeddings(new_info), **reusable}
+                            , embedding_function=embedding_function
+                            , ingest=False)
+    if in_place:
+        for start in range(0, len(removed), 5000):
+            store.collection.delete(ids=removed[start:start + 5000])
+    # The rows that are already in the collection are skipped, only the new documents are written
+    store.add_data_to_collection()
+
+    if in_place:
+        index_cache.replace(old_collection_name, dataflow_name, new_hash, new_collection_name)
+    else:
+        index_cache.register(dataflow_name, new_hash, new_collection_name)
+    CODELISTS.share_embeddings(new_info, store.computed_embeddings)
+    return {**result, 'status': 'updated', 'embedded': len(store.computed_embeddings)}
+
+
+def _reindex_numpy(result, new_info, new_flat_info, old_flat_info, previous_name, embedding_function, build_missing):
+    """The NumPy index files are rewritten as a whole, but only the new documents are embedded."""
+    dataflow_name = result['dataflow']
+    old_index = None
+    if old_flat_info:
+        old_index = NumpyVectorIndex(  old_flat_info
+                                     , dataflow_name=previous_name
+                                     , embedding_function=embedding_function
+                                     , ingest=False)
+    if old_index is None or not old_index.from_cache:
+        probe = NumpyVectorIndex(new_flat_info, dataflow_name=dataflow_name, embedding_function=embedding_function, ingest=False)
+        if probe.from_cache:
+            return {**result, 'status': 'unchanged'}
+        if not build_missing:
+            return {'dataflow': dataflow_name, 'status': 'not_indexed'}
+
+    reusable = dict(zip(old_index.documents, old_index.matrix)) if old_index is not None and old_index.from_cache else {}
+    index = NumpyVectorIndex(  new_flat_info
+                             , dataflow_name=dataflow_name
+                             , precomputed_embeddings={**CODELISTS.shared_embeddings(new_info), **reusable}
+                             , embedding_function=embedding_function)
+    if index.from_cache:
+        return {**result, 'status': 'unchanged'}
+    if reusable and previous_name == dataflow_name:
+        index.index_cache.remove(old_index.collection_name)
+    CODELISTS.share_embeddings(new_info, index.computed_embeddings)
+    return {**result, 'status': 'updated' if reusable else 'rebuilt', 'embedded': len(index.computed_embeddings)}
+
+
+def refresh_catalogue(  dataflow_names
+                      , workers=8
+                      , check_versions=False
+                      , bot_registry=None
+                      , build_missing=False
+                      , backend=None):
+    """
+    Check every dataflow of the catalogue and re-index the ones that changed. The checks (conditional requests)
+    run concurrently, the updates one after the other. The bots of updated dataflows are dropped from `bot_registry`,
+    so that they are rebuilt (from the updated store) on their next use. Returns the report.
+    """
+    started = time.time()
+    session = get_shared_session()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        checks = list(executor.map(lambda name: check_dataflow(name, session, check_versions), dataflow_names))
+
+    embedding_function = get_embedding_function()
+    report = {}
+    for name, check in zip(dataflow_names, checks):
+        entry = {key: check[key] for key in ('dataflow', 'previous_name', 'status', 'error') if check.get(key) is not None}
+        if check['status'] == 'changed':
+            new_info, old_info = check['new_info'], check['old_info']
+            if old_info is not None:
+                diff = diff_dataflows(old_info, new_info)
+                entry.update(diff=diff.to_dict(), summary=diff.summary())
+                if diff.changed:
+                    invalidate_answers(check['dataflow'], check['previous_name'] or check['dataflow'])
+            try:
+                entry.update(reindex_dataflow(  check['dataflow']
+                                              , new_info
+                                              , old_info
+                                              , previous_name=check['previous_name']
+                                              , embedding_function=embedding_function
+                                              , backend=backend
+                                              , build_missing=build_missing))
+            except Exception as e:
+                entry.update(status='failed', error=str(e))
+            if old_info is not None:
+                # The shared copies of the codelists that gained, lost or relabelled codes are out of date (an
+                # unversioned codelist changes under the same key)
+                for dimension in {*diff.codes_added, *diff.codes_removed, *diff.labels_changed}:
+                    for info in (old_info, new_info):
+                        if dimension in info.df_code_list_keys:
+                            CODELISTS.discard(info.df_code_list_keys[dimension])
+            if check['dataflow'] in SNAPSHOTS or check['previous_name'] in SNAPSHOTS:
+                # The preloaded copy is out of date (the snapshot file is rewritten by compact_dataflow.py)
+                SNAPSHOTS.put(check['dataflow'], CompactDataflow.from_dataflow(new_info))
+            if bot_registry is not None and entry['status'] == 'updated':
+                # The resident bot of a dataflow that moved to a new version is still under the previous name
+                bot_registry.remove(check['dataflow'])
+                if check['previous_name'] is not None:
+                    bot_registry.remove(check['previous_name'])
+        METRICS.inc('reindex', status=entry['status'])
+        report[name] = entry
+
+    return {  'started': started
+            , 'seconds': round(time.time() - started, 2)
+            , 'summary': dict(Counter(entry['status'] for entry in report.values()))
+            , 'dataflows': report}
+
+
+def format_report(report):
+    lines = [f"Checked {len(report['dataflows'])} dataflows in {report['seconds']}s: "
+             + ', '.join(f'{count} {status}' for status, count in report['summary'].items())]
+    for name, entry in report['dataflows'].items():
+        if entry['status'] == 'unchanged':
+            continue
+        line = f"  {name}: {entry['status']}"
+        if entry.get('previous_name'):
+            line += f" (new version {entry['dataflow']})"
+        if 'documents_added' in entry:
+            line += (f", {entry['documents_added']} documents added, {entry['documents_removed']} removed, "
+                     f"{entry['embedded']} embedded")
+        if entry.get('summary'):
+            line += f" - {entry['summary']}"
+        if entry.get('error'):
+            line += f" - {entry['error']}"
+        lines.append(line)
+    return '\n'.join(lines)
+
+
+class CatalogueRefresher(threading.Thread):
+    """Refreshes the catalogue every `interval` seconds in the background; the latest report is in `last_report`."""
+
+    def __init__(self, dataflow_names, interval=24 * 3600, **refresh_kwargs):
+        super().__init__(name='catalogue-refresh', daemon=True)
+        self.dataflow_names = list(dataflow_names)
+        self.interval = interval
+        self.refresh_kwargs = refresh_kwargs
+        self.last_report = None
+        self._stop_event = threading.Event()
+
+    def start(self):
+        super().start()
+        return self
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            try:
+                self.last_report = refresh_catalogue(self.dataflow_names, **self.refresh_kwargs)
+                print(format_report(self.last_report))
+            except Exception as e:
+                print(f"Refreshing the catalogue failed: {e}")
+
+    def stop(self):
+        self._stop_event.set()
+
+
+def main():
+    from build_index import load_catalogue
+
+    parser = argparse.ArgumentParser(description='Re-index the dataflows of the catalogue whose structure changed.')
+    parser.add_argument('--catalogue', default=DEFAULT_CATALOGUE, help='JSON file of categories -> dataflow names')
+    parser.add_argument('--workers', type=int, default=8, help='number of concurrent structure requests')
+    parser.add_argument('--check-versions', action='store_true', help='move to the latest version of every dataflow')
+    parser.add_argument('--build-missing', action='store_true', help='also build the stores of dataflows not indexed yet')
+    parser.add_argument('--interval', type=float, default=0, help='keep refreshing every INTERVAL seconds')
+    parser.add_argument('--output', help='write the (last) report to this JSON file')
+    args = parser.parse_args()
+
+    dataflow_names = load_catalogue(args.catalogue)
+    while True:
+        report = refresh_catalogue(  dataflow_names
+                                   , workers=args.workers
+                                   , check_versions=args.check_versions
+                                   , build_missing=args.build_missing)
+        print(format_report(report))
+        if args.output:
+            with open(args.output, 'w', encoding='utf-8') as f:
+                json.dump(report, f, indent=2)
+        if not args.interval:
+            break
+        time.sleep(args.interval)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,174 @@
+"""
+Response Cache Module
+
+Caches the LLM responses, so that the same handful of questions does not cost full latency and money every time.
+
+Two tiers:
+- ResponseCache: exact lookup by a hash of (model, persona, prompt). Since every call is made with `temperature=0`,
+  the same prompt gets the same answer. Bounded in memory (LRU), entries expire after a TTL, and it can be backed by
+  an SQLite file so that the cache survives restarts and is shared by the workers of a host.
+- SemanticCache: reuses the answer of an earlier question of the same dataflow if the embedding of the new question
+  is within a cosine similarity threshold of it (e.g. "what are the columns in this table?" vs "which columns does
+  the table have?").
+
+Usage:
+    ```python
+    cache = ResponseCache(max_entries=1024, ttl=24 * 3600, path='llm_cache.sqlite')
+    cached = cache.get(model, persona, prompt)  # (message, cost of the original call) or None
+    cache.put(model, persona, prompt, message, cost)
+
+    semantic_cache = SemanticCache(threshold=0.95)
+    cached = semantic_cache.lookup(dataflow_name, question_embedding)
+    semantic_cache.store(dataflow_name, question_embedding, answer, cost)
+    ```
+"""
+
+import hashlib
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+
+class ResponseCache:
+    """Exact-match LRU + TTL cache of (model, persona, prompt) -> (message, cost), optionally backed by SQLite."""
+
+    def __init__(self, max_entries=1024, ttl=24 * 3600, path=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key -> (message, cost, created), least recently used first
+        self._lock = threading.Lock()
+
+        self._db = None
+        if path is not None:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute('CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, message TEXT, cost REAL, created REAL)')
+            self._db.commit()
+
+    @staticmethod
+    def key(model, persona, prompt):
+        return hashlib.sha256('\x00'.join((model, persona, prompt)).encode('utf-8')).hexdigest()
+
+    def get(self, model, persona, prompt):
+        """Return the cached (message, cost of the original call), or None."""
+        key = self.key(model, persona, prompt)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None and self._db is not None:
+                row = self._db.execute('SELECT message, cost, created FROM responses WHERE key = ?', (key,)).fetchone()
+                if row is not None:
+                    entry = tuple(row)
+                    self._remember(key, entry)
+
+            if entry is not None and time.time() - entry[2] > self.ttl:
+                self._forget(key)
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return entry[0], entry[1]
+
+    def put(self, model, persona, prompt, message, cost):
+        key = self.key(model, persona, prompt)
+        entry = (message, cost, time.time())
+        with self._lock:
+            self._remember(key, entry)
+            if self._db is not None:
+                self._db.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)', (key, *entry))
+                self._db.commit()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            if self._db is not None:
+                self._db.execute('DELETE FROM responses')
+                self._db.commit()
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'hits': self.hits, 'misses': self.misses}
+
+    def _remember(self, key, entry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _forget(self, key):
+        self._entries.pop(key, None)
+        if self._db is not None:
+            self._db.execute('DELETE FROM responses WHERE key = ?', (key,))
+            self._db.commit()
+
+
+class SemanticCache:
+    """Per-namespace (dataflow) cache of question embedding -> (answer, cost), matched by cosine similarity."""
+
+    def __init__(self, threshold=0.95, max_entries_per_namespace=256, ttl=24 * 3600):
+        self.threshold = threshold
+        self.max_entries_per_namespace = max_entries_per_namespace
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._namespaces = {}  # namespace -> OrderedDict of id -> (normalized embedding, answer, cost, created)
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _normalize(embedding):
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def lookup(self, namespace, embedding):
+        """Return the (answer, cost of the original answer) of the most similar cached question, or None."""
+        query = self._normalize(embedding)
+        now = time.time()
+        with self._lock:
+            entries = self._namespaces.get(namespace, OrderedDict())
+            for entry_id in [entry_id for entry_id, entry in entries.items() if now - entry[3] > self.ttl]:
+                del entries[entry_id]
+
+            if entries:
+                ids = list(entries)
+                similarities = np.stack([entries[entry_id][0] for entry_id in ids]) @ query
+                best = int(np.argmax(similarities))
+                if similarities[best] >= self.threshold:
+                    self.hits += 1
+                    entries.move_to_end(ids[best])
+                    _, answer, cost, _ = entries[ids[best]]
+                    return answer, cost
+
+            self.misses += 1
+            return None
+
+    def store(self, namespace, embedding, answer, cost):
+        with self._lock:
+            entries = self._namespaces.setdefault(namespace, OrderedDict())
+            entries[self._next_id] = (self._normalize(embedding), answer, cost, time.time())
+            self._next_id += 1
+            while len(entries) > self.max_entries_per_namespace:
+                entries.popitem(last=False)
+
+    def invalidate(self, namespace=None):
+        with self._lock:
+            if namespace is None:
+                self._namespaces.clear()
+            else:
+                self._namespaces.pop(namespace, None)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': sum(len(entries) for entries in self._namespaces.values()),
+                'hits': self.hits,
+                'misses': self.misses,
+            }
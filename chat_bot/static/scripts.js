@@ -65,12 +65,34 @@ document.addEventListener('DOMContentLoaded', () => {
                     dataflow: selectedDataflow
                 }),
             }).then(response => response.json())
-            .then(data => {
-                appendMessage('llm', `Bot initialized with dataflow: ${selectedDataflow}`);
+            .then(job => {
+                // The bot is built in the background: follow the job until the bot can answer
+                const statusElement = appendMessage('llm', `Initializing the bot with dataflow: ${selectedDataflow}...`);
+                pollInitialization(job, selectedDataflow, statusElement);
             });
         }
     });
 
+    function pollInitialization(job, dataflow, statusElement) {
+        if (job.status === 'failed') {
+            statusElement.textContent = `Initializing the bot with dataflow ${dataflow} failed: ${job.error}`;
+            return;
+        }
+        if (job.ready) {
+            statusElement.textContent = `Bot initialized with dataflow: ${dataflow}`;
+            if (!job.done) statusElement.textContent += ` (still indexing the codes, ${job.percent}%)`;
+        } else {
+            statusElement.textContent = `Initializing the bot with dataflow: ${dataflow} (${job.stage.replace('_', ' ')}, ${job.percent}%)`;
+        }
+        if (job.done) return;
+
+        setTimeout(() => {
+            fetch(`/initialize_status/${job.job_id}`)
+                .then(response => response.json())
+                .then(next => pollInitialization(next, dataflow, statusElement));
+        }, 1000);
+    }
+
     // Chat form submission event listener
     chatForm.addEventListener('submit', async (e) => {
         e.preventDefault();
@@ -80,7 +102,7 @@ document.addEventListener('DOMContentLoaded', () => {
         appendMessage('user', message);
         userInput.value = '';
 
-        const response = await fetch('/chat', {
+        const response = await fetch('/chat/stream', {
             method: 'POST',
             headers: {
                 'Content-Type': 'application/json',
@@ -88,15 +110,57 @@ document.addEventListener('DOMContentLoaded', () => {
             body: JSON.stringify({ message: message }),
         });
 
-        const data = await response.json();
-        appendMessage('llm', data.response);
+        // Plain JSON if the bot is not initialized, server-sent events otherwise
+        if (!response.headers.get('Content-Type').startsWith('text/event-stream')) {
+            const data = await response.json();
+            appendMessage('llm', data.response);
+            return;
+        }
+
+        // Render the answer while it is being generated
+        const messageElement = appendMessage('llm', '');
+        await readEvents(response, (event, data) => {
+            if (event === 'error') {
+                messageElement.textContent += `\n[Error: ${data.message}]`;
+            } else if (data.delta) {
+                messageElement.textContent += data.delta;
+            }
+            chatBox.scrollTop = chatBox.scrollHeight;
+        });
     });
 
+    // Read the server-sent events of a fetch response as they arrive, calling onEvent(event name, parsed data)
+    async function readEvents(response, onEvent) {
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+
+        while (true) {
+            const { done, value } = await reader.read();
+            if (done) break;
+            buffer += decoder.decode(value, { stream: true });
+
+            // Events are separated by a blank line, the last part may be incomplete
+            const events = buffer.split('\n\n');
+            buffer = events.pop();
+            events.forEach(rawEvent => {
+                let event = 'message';
+                let data = '';
+                rawEvent.split('\n').forEach(line => {
+                    if (line.startsWith('event: ')) event = line.slice(7);
+                    else if (line.startsWith('data: ')) data += line.slice(6);
+                });
+                if (data) onEvent(event, JSON.parse(data));
+            });
+        }
+    }
+
     function appendMessage(sender, message) {
         const messageElement = document.createElement('div');
         messageElement.classList.add('message', sender);
         messageElement.textContent = message;
         chatBox.appendChild(messageElement);
         chatBox.scrollTop = chatBox.scrollHeight;
+        return messageElement;
     }
 });
@@ -0,0 +1,92 @@
+import os
+import sys
+from types import SimpleNamespace
+
+import pytest
+
+# The modules of the chat bot import each other as top-level modules
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fakes import FakeSDMXServer
+
+
+@pytest.fixture(scope='session')
+def sdmx_server():
+    with FakeSDMXServer(codes_per_dimension=40) as server:
+        yield server
+
+
+@pytest.fixture
+def fake_dataflow():
+    """A small parsed dataflow (`fake_dataflow(version, countries)`): the attributes the consumers of a Dataflow read."""
+    def make(version='1.0', countries=('FRA', 'DEU')):
+        return SimpleNamespace(  url=f'https://sdmx.example.org/dataflow/OECD/DF_TEST/{version}'
+                               , df_name=f'Test dataflow {version}'
+                               , df_description='A dataflow for the tests'
+                               , df_dimension_names={'REF_AREA': 'Reference area', 'SEX': 'Sex'}
+                               , df_code_names={  'REF_AREA': {code: f'Country {code} ({version})' for code in countries}
+                                                , 'SEX': {'F': 'Female', 'M': 'Male'}}
+                               , df_code_list_keys={'REF_AREA': ('OECD', 'CL_AREA', '1.0'), 'SEX': ('OECD', 'CL_SEX', '1.0')}
+                               , df_dimension_order=('REF_AREA', 'SEX')
+                               , df_time_range=(2015, 2020))
+
+    return make
+
+
+@pytest.fixture
+def codelists():
+    """The process-wide codelist store, empty before and after the test."""
+    from codelist_store import CODELISTS
+    CODELISTS.clear()
+    yield CODELISTS
+    CODELISTS.clear()
+
+
+@pytest.fixture
+def parse_dataflow(sdmx_server, tmp_path):
+    """Parse a dataflow of the fake registry (the `index`-th one), through an HTTP cache of the test."""
+    from SDMX_DataFlow import Dataflow
+    from http_cache import CachedSession
+
+    def parse(index=0, streaming=False, server=sdmx_server, cache_dir='cache', ttl=24 * 3600):
+        agency, rest = server.dataflow_name(index).split(':')
+        id_part, version = rest.rstrip(')').split('(')
+        df_info = Dataflow(  f'{server.url}/dataflow/{agency}/{id_part}/{version}?references=all'
+                           , streaming=streaming
+                           , session=CachedSession(cache_dir=str(tmp_path / cache_dir), ttl=ttl))
+        df_info.populate_variables()
+        return df_info
+
+    return parse
+
+
+@pytest.fixture
+def make_bot(sdmx_server, tmp_path, monkeypatch):
+    """
+    Build bots of the dataflows of the fake registry (`make_bot(index, **bot_kwargs)`) offline: hashing embeddings,
+    NumPy index, fake chat model, and caches and files of the test only.
+    """
+    import LLM
+    import embeddings
+    import grounded_llm
+    import http_cache
+    import vector_index
+    from fakes import install_fake_chat_model
+    from response_cache import ResponseCache, SemanticCache
+
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(grounded_llm, 'SDMX_REST_URL', sdmx_server.url)
+    monkeypatch.setattr(embeddings, 'EMBEDDING_BACKEND', 'hashing')
+    monkeypatch.setattr(vector_index, 'VECTOR_BACKEND', 'numpy')
+    monkeypatch.setattr(vector_index, '_index_caches', {})
+    monkeypatch.setattr(http_cache, '_shared_session', http_cache.CachedSession(cache_dir=str(tmp_path / 'sdmx_cache')))
+    monkeypatch.setattr(grounded_llm, 'semantic_cache', SemanticCache(threshold=0.95))
+    monkeypatch.setattr(LLM, 'response_cache', ResponseCache())
+    monkeypatch.setattr(LLM, 'client', None)
+    monkeypatch.setattr(LLM, 'async_client', None)
+    install_fake_chat_model(latency=0, completion_tokens=5)
+
+    def make(index=0, **bot_kwargs):
+        return grounded_llm.Bot(sdmx_server.dataflow_name(index), use_index_cache=False, **bot_kwargs)
+
+    return make
@@ -0,0 +1,24 @@
+from benchmark import compare, flatten_metrics
+
+
+def test_only_the_numbers_are_flattened():
+    results = {  'revision': 'abc123'
+               , 'query': {'p50': 0.5, 'count': 40, 'cached': True}
+               , 'init': {'cold': {'seconds': 2}}}
+    assert flatten_metrics(results) == {'query.p50': 0.5, 'query.count': 40, 'init.cold.seconds': 2}
+
+
+def test_regressions_are_changes_for_the_worse_above_the_tolerance(capsys):
+    baseline = {'query': {'p50': 1.0, 'p99': 2.0, 'requests_per_second': 100.0, 'count': 40}, 'memory_mb': 0}
+    results = {'query': {'p50': 1.05, 'p99': 1.0, 'requests_per_second': 80.0, 'count': 80}, 'memory_mb': 50}
+
+    # A 5% slower median is within the tolerance, half the p99 is an improvement, 20% less throughput is a regression
+    assert compare(results, baseline, tolerance=0.1) == ['query.requests_per_second']
+    printed = capsys.readouterr().out
+    # Counts and metrics without a baseline value are not compared
+    assert 'query.count' not in printed and 'memory_mb' not in printed
+
+
+def test_metrics_of_one_side_only_are_not_compared(capsys):
+    assert compare({'query': {'p50': 9.0}}, {'init': {'seconds': 1.0}}) == []
+    assert capsys.readouterr().out == ''
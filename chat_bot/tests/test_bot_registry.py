@@ -0,0 +1,62 @@
+import time
+
+from bot_registry import BotRegistry, IdleEvictor
+
+
+def test_an_idle_bot_is_not_returned():
+    registry = BotRegistry(bot_factory=lambda name: object(), idle_timeout=0.05)
+    bot = registry.get_or_create('DF_A')
+    assert registry.get('DF_A') is bot
+
+    time.sleep(0.1)
+    assert registry.get('DF_A') is None
+    assert 'DF_A' not in registry
+    assert registry.get_or_create('DF_A') is not bot
+
+
+def test_idle_bots_are_evicted_in_the_background():
+    registry = BotRegistry(bot_factory=lambda name: object(), idle_timeout=0.05)
+    registry.get_or_create('DF_A')
+    evictor = IdleEvictor(registry, interval=0.02).start()
+    try:
+        deadline = time.monotonic() + 2
+        while len(registry) and time.monotonic() < deadline:
+            time.sleep(0.01)
+    finally:
+        evictor.stop()
+    assert len(registry) == 0
+
+
+def test_using_a_bot_touches_its_collection():
+    class TouchedBot:
+        touched = 0
+
+        def touch(self):
+            self.touched += 1
+
+    registry = BotRegistry(bot_factory=lambda name: TouchedBot())
+    bot = registry.get_or_create('DF_A')
+    registry.get('DF_A')
+    registry.get('DF_A')
+    assert bot.touched >= 2
+
+
+def test_an_idle_bot_is_built_again_by_an_init_job():
+    from init_jobs import InitJobManager
+    from metrics import METRICS
+
+    built = []
+    registry = BotRegistry(bot_factory=lambda name, **kwargs: built.append(name) or object(), idle_timeout=0.05)
+    jobs = InitJobManager(registry, workers=1)
+    try:
+        registry.get_or_create('DF_A')
+        time.sleep(0.1)
+        evictions = METRICS.snapshot()['counters'].get('bot_evictions{reason=idle}', 0)
+
+        job = jobs.submit('DF_A')
+        jobs.shutdown(wait=True)
+    finally:
+        jobs.shutdown(wait=False)
+    assert built == ['DF_A', 'DF_A']
+    assert job.status == 'done'
+    assert METRICS.snapshot()['counters']['bot_evictions{reason=idle}'] == evictions + 1
@@ -0,0 +1,49 @@
+import json
+
+import numpy as np
+
+import catalogue_index
+import embeddings
+from catalogue_index import CatalogueIndex, catalogue_bot_error, get_catalogue_bot
+
+
+def test_an_index_built_with_another_embedding_model_is_unavailable(tmp_path, monkeypatch):
+    monkeypatch.setattr(catalogue_index, '_catalogue_bot', None)
+    monkeypatch.setattr(catalogue_index, '_catalogue_bot_error', None)
+    monkeypatch.setattr(embeddings, 'EMBEDDING_BACKEND', 'hashing')
+    assert get_catalogue_bot(str(tmp_path)) is None
+    assert isinstance(catalogue_bot_error(), FileNotFoundError)
+
+    with open(tmp_path / 'catalogue.json', 'w', encoding='utf-8') as f:
+        json.dump({  'dataflows': [], 'texts': [], 'answers': [], 'dimensions': []
+                   , 'embedding_model': 'text-embedding-3-small'}, f)
+    for name in CatalogueIndex.FILES:
+        np.save(tmp_path / f'{name}.npy', np.zeros(0, dtype=np.int32))
+
+    assert get_catalogue_bot(str(tmp_path)) is None
+    assert isinstance(catalogue_bot_error(), ValueError)
+    assert 'text-embedding-3-small' in str(catalogue_bot_error())
+
+
+def test_search_scores_the_candidates_and_a_rebuilt_index_is_reopened(tmp_path, monkeypatch, parse_dataflow, codelists):
+    monkeypatch.setattr(catalogue_index, '_catalogue_bot', None)
+    monkeypatch.setattr(catalogue_index, '_catalogue_bot_error', None)
+    monkeypatch.setattr(embeddings, 'EMBEDDING_BACKEND', 'hashing')
+    dataflows = {f'DF_{i}': parse_dataflow(i) for i in range(2)}
+    path = str(tmp_path / 'index')
+    index = CatalogueIndex.build({'Tests': list(dataflows)}, dataflows, path=path)
+
+    question = index.texts[int(index.doc_text[index.documents_of(1)[0]])]
+    for filters in ({}, {'dataflows': ['DF_1']}):
+        result = index.query(question, n_results=3, **filters)
+        documents = index.candidates(**filters)
+        expected = np.sort(1 - np.asarray(index.embedding_function([question]))[0]
+                           @ index.matrix[index.doc_text[documents]].T)[:3] * 2
+        np.testing.assert_allclose(result['distances'][0], expected, atol=1e-5)
+        assert result['documents'][0][0] == question
+
+    bot = get_catalogue_bot(path)
+    assert get_catalogue_bot(path) is bot
+    CatalogueIndex.build({'Tests': ['DF_0']}, {'DF_0': dataflows['DF_0']}, path=path)
+    rebuilt = get_catalogue_bot(path)
+    assert rebuilt is not bot and len(rebuilt.index.dataflows) == 1
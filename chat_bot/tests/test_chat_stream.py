@@ -0,0 +1,77 @@
+import json
+from types import SimpleNamespace
+
+import pytest
+
+import app as chat_app
+from bot_registry import BotRegistry
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(chat_app, 'bot_registry', BotRegistry())
+    return chat_app.app.test_client()
+
+
+def events(response):
+    """The (event, data) pairs of a server-sent event stream."""
+    parsed = []
+    for block in response.get_data(as_text=True).split('\n\n'):
+        if not block:
+            continue
+        fields = dict(line.split(': ', 1) for line in block.split('\n'))
+        parsed.append((fields.get('event'), json.loads(fields['data'])))
+    return parsed
+
+
+def test_the_answer_is_streamed_in_pieces_and_ends_with_an_end_event(client, make_bot):
+    bot = make_bot()
+    chat_app.bot_registry.put(bot.dataflow_name, bot)
+    question = 'Which countries does the table cover?'
+
+    response = client.post('/chat/stream', json={'message': question, 'dataflow': bot.dataflow_name})
+    assert response.mimetype == 'text/event-stream'
+    streamed = events(response)
+
+    assert streamed[-1] == ('end', {})
+    deltas = [data['delta'] for event, data in streamed[:-1] if event is None]
+    assert len(deltas) == len(streamed) - 1 > 1
+    # The same answer as without streaming (now from the exact cache)
+    assert ''.join(deltas) == bot.answer_question(question)
+
+
+def test_a_failure_while_streaming_is_sent_as_an_error_event(client, make_bot, monkeypatch):
+    bot = make_bot()
+    chat_app.bot_registry.put(bot.dataflow_name, bot)
+
+    def failing_stream(user_question):
+        yield 'The beginning'
+        raise RuntimeError('the model went away')
+
+    monkeypatch.setattr(bot, 'answer_question_stream', failing_stream)
+    response = client.post('/chat/stream', json={'message': 'Anything?', 'dataflow': bot.dataflow_name})
+    assert events(response) == [(None, {'delta': 'The beginning'}), ('error', {'message': 'the model went away'})]
+
+
+def test_a_bot_that_is_not_resident_is_built_in_the_background(client, monkeypatch):
+    submitted = []
+
+    def submit(dataflow):
+        submitted.append(dataflow)
+        return SimpleNamespace(job_id='job-1', stage='indexing_codes', percent=40)
+
+    monkeypatch.setattr(chat_app.init_jobs, 'last_job', lambda dataflow: None)
+    monkeypatch.setattr(chat_app.init_jobs, 'submit', submit)
+    response = client.post('/chat/stream', json={'message': 'Anything?', 'dataflow': 'OECD:DF_EVICTED(1.0)'})
+
+    assert submitted == ['OECD:DF_EVICTED(1.0)']
+    (_, data), end = events(response)
+    assert data['job_id'] == 'job-1' and 'indexing codes, 40%' in data['delta']
+    assert end == ('end', {})
+
+
+def test_without_a_dataflow_or_a_catalogue_index_the_user_is_asked_to_initialize(client, monkeypatch):
+    monkeypatch.setattr(chat_app, 'get_catalogue_bot', lambda: None)
+    response = client.post('/chat/stream', json={'message': 'Anything?'})
+    assert response.mimetype == 'application/json'
+    assert 'Initialize Bot' in response.get_json()['response']
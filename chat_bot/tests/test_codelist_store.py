@@ -0,0 +1,55 @@
+import json
+
+from fakes import FakeSDMXServer, synthetic_structure
+
+
+def test_streamed_dataflows_with_the_same_constraint_share_the_codes(parse_dataflow, tmp_path, codelists):
+    # Two dataflows of the same structure, i.e. with the same codelists and content constraint
+    payload = tmp_path / 'structure.json'
+    payload.write_text(json.dumps(synthetic_structure('DF_SHARED', codes_per_dimension=40)))
+    with FakeSDMXServer(payload_path=str(payload)) as server:
+        first, second = parse_dataflow(0, streaming=True, server=server), parse_dataflow(1, streaming=True, server=server)
+
+    assert first.df_code_names
+    for dim, code_names in first.df_code_names.items():
+        assert second.df_code_names[dim] is code_names
+    assert codelists.stats()['partial_codelists'] == len(first.df_code_list_keys)
+
+
+def test_partial_codelists_are_interned_across_dataflows(parse_dataflow, codelists):
+    first, second = parse_dataflow(0, streaming=True), parse_dataflow(1, streaming=True)
+
+    for dim, key in first.df_code_list_keys.items():
+        urn = f'urn:sdmx:org.sdmx.infomodel.codelist.Codelist={key[0]}:{key[1]}({key[2]})'
+        partial = codelists.intern_partial(urn, ())
+        # The codes collected for both dataflows, every name stored once
+        assert set(first.df_code_names[dim]) | set(second.df_code_names[dim]) <= set(partial)
+        for df_info in (first, second):
+            for code, name in df_info.df_code_names[dim].items():
+                assert name is partial[code]
+
+
+def test_the_embeddings_of_the_least_recently_used_codelists_are_dropped(fake_dataflow):
+    from codelist_store import CodelistStore
+    from data_prep_for_indenxing import flatten_codes_of_dimension
+
+    def embeddings_of(df_info):
+        return {str(question): [1.0, 0.0] for dim, code_names in df_info.df_code_names.items()
+                for question, _ in flatten_codes_of_dimension(dim, code_names)}
+
+    store = CodelistStore(max_embeddings=24)
+    first, second = fake_dataflow('1.0'), fake_dataflow('2.0')
+    second.df_code_list_keys = {'REF_AREA': ('OECD', 'CL_AREA', '2.0'), 'SEX': ('OECD', 'CL_SEX', '2.0')}
+    store.share_embeddings(first, embeddings_of(first))
+    assert store.stats()['embeddings'] == 16
+
+    # The sex codelist of the first dataflow is used again, its area codelist is the least recently used one
+    sex_only = fake_dataflow('1.0')
+    sex_only.df_code_list_keys = {'SEX': ('OECD', 'CL_SEX', '1.0')}
+    assert len(store.shared_embeddings(sex_only)) == 8
+    store.share_embeddings(second, embeddings_of(second))
+
+    assert store.stats()['embeddings'] == 24
+    assert set(store.shared_embeddings(first)) == set(store.shared_embeddings(sex_only))
+    store.discard(('OECD', 'CL_SEX', '1.0'))
+    assert store.stats()['embeddings'] == 16
@@ -0,0 +1,26 @@
+from compact_dataflow import CompactDataflow, SnapshotCatalogue, load_snapshot, save_snapshot
+
+
+def test_a_replaced_dataflow_does_not_keep_its_strings_in_a_shared_pool(fake_dataflow):
+    catalogue = SnapshotCatalogue()
+    first = CompactDataflow.from_dataflow(fake_dataflow('1.0'))
+    catalogue.put('DF_TEST', first)
+    second = CompactDataflow.from_dataflow(fake_dataflow('2.0'))
+    catalogue.put('DF_TEST', second)
+
+    # Every dataflow built in memory has a pool of its own, dropped with it
+    pool = second.df_dimension_names.pool
+    assert pool is not first.df_dimension_names.pool
+    assert all(table.pool is pool for _, table in second.code_tables())
+    assert 'Country FRA (1.0)' not in {pool[i] for i in range(len(pool))}
+    assert dict(catalogue.get('DF_TEST').df_code_names['REF_AREA']) == {'FRA': 'Country FRA (2.0)', 'DEU': 'Country DEU (2.0)'}
+
+
+def test_the_dataflows_of_a_snapshot_share_its_pool(tmp_path, fake_dataflow):
+    path = str(tmp_path / 'catalogue.snap')
+    save_snapshot({'DF_A': fake_dataflow('1.0'), 'DF_B': fake_dataflow('2.0', countries=('FRA', 'ITA'))}, path)
+    dataflows = load_snapshot(path)
+
+    assert dataflows['DF_A'].df_dimension_names.pool is dataflows['DF_B'].df_dimension_names.pool
+    assert dict(dataflows['DF_B'].df_code_names['REF_AREA']) == {'FRA': 'Country FRA (2.0)', 'ITA': 'Country ITA (2.0)'}
+    assert list(dataflows['DF_A'].df_code_names['SEX'].items()) == [('F', 'Female'), ('M', 'Male')]
@@ -0,0 +1,49 @@
+from context_builder import ContextBuilder
+from embeddings import count_tokens
+
+
+def result_sets(*queries):
+    """Chroma-shaped result sets, one list of (statement, distance) hits per query."""
+    return {  'metadatas': [[{'answer': statement} for statement, _ in hits] for hits in queries]
+            , 'distances': [[distance for _, distance in hits] for hits in queries]}
+
+
+def code_list(dimension, count):
+    return '\n'.join([f'The codes of {dimension} are:'] + [f'- CODE_{i}: the name of code {i}' for i in range(count)])
+
+
+def test_repeated_statements_are_kept_once_at_their_closest_rank():
+    hits = [('Sex: F is Female', 0.4), ('The table covers 2015-2020', 0.3), ('Sex: F is Female ', 0.1), ('Sex: M is Male', 0.5)]
+    builder = ContextBuilder(max_statements=10)
+
+    assert builder.statements(result_sets(hits)) == ['Sex: F is Female', 'The table covers 2015-2020', 'Sex: M is Male']
+    assert builder.build(result_sets(hits)) == 'Sex: F is Female\n\nThe table covers 2015-2020\n\nSex: M is Male'
+
+
+def test_the_statements_of_the_given_query_are_used():
+    sets = result_sets([('First query', 0.1)], [('Second query', 0.1)])
+    assert ContextBuilder().build(sets, query_index=1) == 'Second query'
+
+
+def test_at_most_max_statements_are_added():
+    hits = [(f'Statement {i}', i / 10) for i in range(5)]
+    assert ContextBuilder(max_statements=2).build(result_sets(hits)) == 'Statement 0\n\nStatement 1'
+
+
+def test_the_last_statement_is_cut_at_a_line_to_fit_the_budget():
+    short = 'The table covers 2015-2020'
+    builder = ContextBuilder(max_tokens=200)
+    context = builder.build(result_sets([(short, 0.1), (code_list('REF_AREA', 100), 0.2), ('Never reached', 0.3)]))
+
+    first, cut = context.split('\n\n')
+    assert first == short
+    assert cut.startswith('The codes of REF_AREA are:\n- CODE_0: the name of code 0\n')
+    assert cut.endswith('more lines not shown)')
+    assert count_tokens(context) <= builder.max_tokens
+
+
+def test_a_statement_is_left_out_if_too_little_of_it_would_fit():
+    builder = ContextBuilder(max_tokens=ContextBuilder.MIN_PARTIAL_TOKENS + 20)
+    filler = ' '.join(['word'] * 40)
+    assert count_tokens(filler) > builder.max_tokens - ContextBuilder.MIN_PARTIAL_TOKENS
+    assert builder.build(result_sets([(filler, 0.1), (code_list('SEX', 50), 0.2)])) == filler
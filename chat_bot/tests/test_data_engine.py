@@ -0,0 +1,25 @@
+from data_engine import DataRequest, parse_data_request
+
+
+class FakeLookupIndex:
+    """Resolves 'France' to REF_AREA=FRA, like the LookupIndex of a dataflow with a country dimension."""
+
+    def mentions(self, question):
+        return {'REF_AREA': ['FRA']} if 'France' in question else {}
+
+
+def parse(question):
+    return parse_data_request(question, FakeLookupIndex(), ['REF_AREA', 'EDUCATION_LEV'])
+
+
+def test_a_data_request_needs_a_code_and_a_question_about_numbers():
+    assert parse('What was the value for France in 2020?') == DataRequest({'REF_AREA': ['FRA']}, 2020, 2020)
+    assert parse('How many teachers in France between 2019 and 2015?') == DataRequest({'REF_AREA': ['FRA']}, 2015, 2019)
+    assert parse('What is the average for France?') == DataRequest({'REF_AREA': ['FRA']}, None, None)
+
+
+def test_years_alone_do_not_make_an_unfiltered_data_request():
+    assert parse('What does ISCED 2011 level 3 mean?') is None
+    assert parse('What was the value in 2020?') is None
+    assert parse('Which dimensions changed in 2020 for France?') is None
+    assert parse('What is the total number of dimensions?') is None
@@ -0,0 +1,39 @@
+import pytest
+
+from data_prep_for_indenxing import flatten_info
+from index_cache import IndexCache
+
+
+def content_hash(df_info):
+    return IndexCache.content_hash(flatten_info(df_info))
+
+
+def test_streaming_and_in_memory_parses_index_the_same_documents(parse_dataflow, codelists):
+    cold_streamed = parse_dataflow(streaming=True)
+    codelists.clear()
+    in_memory = parse_dataflow()
+    # The in-memory parse has filled the codelist store
+    warm_streamed = parse_dataflow(streaming=True)
+
+    for df_info in (cold_streamed, warm_streamed):
+        assert {dim: list(codes) for dim, codes in df_info.df_code_names.items()} == \
+               {dim: list(codes) for dim, codes in in_memory.df_code_names.items()}
+        assert flatten_info(df_info) == flatten_info(in_memory)
+        assert content_hash(df_info) == content_hash(in_memory)
+
+
+def test_codes_are_in_the_order_of_the_content_constraint(parse_dataflow, codelists):
+    df_info = parse_dataflow(streaming=True)
+    df_info._stream_df_details_json()
+    constrained = df_info._parse_content_constraints()
+    for dim, codes in df_info.df_code_names.items():
+        assert list(codes) == constrained[dim]
+
+
+@pytest.mark.parametrize('streaming', [False, True])
+def test_the_structure_is_requested_once_per_parse(parse_dataflow, sdmx_server, codelists, streaming):
+    # Without a TTL every fetch is a (conditional) request: the parse must read the body of its own fetch
+    parse_dataflow(index=1, streaming=streaming, ttl=0)
+    requests_before = sdmx_server.requests
+    parse_dataflow(index=1, streaming=streaming, ttl=0)
+    assert sdmx_server.requests - requests_before == 1
@@ -0,0 +1,91 @@
+from types import SimpleNamespace
+from unittest.mock import Mock
+
+import pytest
+import requests
+
+import LLM
+import grounded_llm
+from metrics import METRICS
+
+
+def test_answers_given_before_the_codes_are_indexed_are_not_cached(make_bot):
+    question = 'Which countries does the table cover?'
+    early = {}
+
+    def ready(bot):
+        # Only the names and dimensions are indexed at this point
+        early['answer'] = bot.answer_question(question)
+        early['indexing_complete'] = bot.indexing_complete
+
+    bot = make_bot(ready_callback=ready)
+    assert early == {'answer': early['answer'], 'indexing_complete': False}
+    assert grounded_llm.semantic_cache.stats()['entries'] == 0
+    # Only the rephrased question, which does not depend on the index
+    assert LLM.response_cache.stats()['entries'] == 1
+
+    bot.answer_question(question)
+    assert grounded_llm.semantic_cache.stats()['entries'] == 1
+    assert LLM.response_cache.stats()['entries'] == 2
+
+
+def test_a_failed_data_query_is_counted_and_the_answer_goes_on_without_data(make_bot, monkeypatch):
+    bot = make_bot()
+    request = SimpleNamespace(filters={}, start_year=None, end_year=None)
+    errors = METRICS.snapshot()['counters'].get('data_queries{status=error}', 0)
+
+    for error in (requests.ConnectionError('registry unreachable'), ValueError('no OBS_VALUE column')):
+        monkeypatch.setattr(grounded_llm.DATA_ENGINE, 'query', Mock(side_effect=error))
+        assert bot._data_context(request) is None
+    assert METRICS.snapshot()['counters']['data_queries{status=error}'] == errors + 2
+
+    monkeypatch.setattr(grounded_llm.DATA_ENGINE, 'query', Mock(side_effect=KeyError('REF_AREA')))
+    with pytest.raises(KeyError):
+        bot._data_context(request)
+
+
+def test_a_batch_is_answered_in_order_with_each_question_answered_once(make_bot):
+    bot = make_bot()
+    dimension, code_names = next(iter(bot.df_info.df_code_names.items()))
+    code = next(iter(code_names))
+    questions = [  'Which countries does the table cover?'
+                 , f"What is the English name of the code '{code}' within the code list ID '{dimension}'?"
+                 , 'What is the unit of measure?'
+                 , 'which countries does the TABLE cover']
+
+    results = bot.answer_questions(questions)
+    assert [result['question'] for result in results] == questions
+    assert [result['path'] for result in results] == ['llm', 'lookup', 'llm', 'duplicate']
+    assert results[1]['answer'] == bot.lookup_index.answer(questions[1])
+    assert results[3]['answer'] == results[0]['answer'] and results[3]['cost'] == 0.0
+    assert results[0]['answer'] == bot.answer_question(questions[0])
+    assert results[0]['answer'] != results[2]['answer']
+
+
+def test_a_failed_question_does_not_fail_the_batch(make_bot, monkeypatch):
+    bot = make_bot()
+    rephrase, generate = bot._rephrase_user_question, bot._generate
+
+    def failing_rephrase(user_question):
+        if 'rephrasing' in user_question:
+            raise RuntimeError('the rephrasing failed')
+        return rephrase(user_question)
+
+    def failing_generate(persona, prompt):
+        if 'generation' in prompt:
+            raise TimeoutError('the generation timed out')
+        return generate(persona, prompt)
+
+    monkeypatch.setattr(bot, '_rephrase_user_question', failing_rephrase)
+    monkeypatch.setattr(bot, '_generate', failing_generate)
+    errors = METRICS.snapshot()['counters'].get('answers{path=error}', 0)
+    results = bot.answer_questions([  'Which countries does the table cover? (rephrasing)'
+                                    , 'What is the unit of measure?'
+                                    , 'Which years does the table cover? (generation)'
+                                    , 'Which countries does the table cover? (rephrasing)'])
+
+    assert [result['path'] for result in results] == ['error', 'llm', 'error', 'duplicate']
+    assert [result.get('error') for result in results] == \
+           ['the rephrasing failed', None, 'the generation timed out', 'the rephrasing failed']
+    assert results[1]['answer'] and results[0]['answer'] is None
+    assert METRICS.snapshot()['counters']['answers{path=error}'] == errors + 2
@@ -0,0 +1,58 @@
+import json
+
+from index_cache import IndexCache
+from vector_index import IndexFiles
+
+
+def open_cache(tmp_path, max_collections=2):
+    return IndexCache(IndexFiles(str(tmp_path)), path=str(tmp_path), max_collections=max_collections)
+
+
+def register(index_cache, dataflow_name):
+    index_cache.register(dataflow_name, 'hash', IndexCache.collection_name(dataflow_name, 'hash'))
+
+
+def test_the_cap_of_a_bulk_build_is_kept_by_the_other_index_caches(tmp_path):
+    # The app opened the manifest with the default cap before the bulk build
+    app_cache = open_cache(tmp_path)
+    bulk_cache = open_cache(tmp_path)
+    bulk_cache.reserve(5 + bulk_cache.default_max_collections)
+    for i in range(5):
+        register(bulk_cache, f'DF_BULK_{i}')
+
+    register(app_cache, 'DF_NEW')
+    assert app_cache.max_collections == 7
+    assert len(app_cache.entries()) == 6
+    # A cache opened later reads the cap from the manifest
+    assert open_cache(tmp_path).max_collections == 7
+
+
+def test_above_the_cap_the_least_recently_used_collection_is_evicted(tmp_path):
+    first = open_cache(tmp_path)
+    first.reserve(3)
+    for name in ('DF_1', 'DF_2', 'DF_3'):
+        register(first, name)
+
+    register(open_cache(tmp_path), 'DF_4')
+    assert sorted(entry['dataflow_name'] for entry in first.entries().values()) == ['DF_2', 'DF_3', 'DF_4']
+
+
+def test_a_manifest_without_a_cap_is_read(tmp_path):
+    name = IndexCache.collection_name('DF_OLD', 'hash')
+    (tmp_path / IndexCache.MANIFEST_NAME).write_text(json.dumps({name: {  'dataflow_name': 'DF_OLD', 'content_hash': 'hash'
+                                                                         , 'created': 0, 'last_used': 0}}))
+    index_cache = open_cache(tmp_path)
+    assert list(index_cache.entries()) == [name]
+    assert index_cache.max_collections == 2
+
+
+def test_a_collection_in_use_is_not_the_least_recently_used(tmp_path, monkeypatch):
+    monkeypatch.setattr(IndexCache, 'TOUCH_INTERVAL', 0)
+    index_cache = open_cache(tmp_path)
+    register(index_cache, 'DF_BUSY')
+    register(index_cache, 'DF_IDLE')
+
+    # The resident bot of DF_BUSY answers from its collection
+    index_cache.touch(IndexCache.collection_name('DF_BUSY', 'hash'))
+    register(index_cache, 'DF_NEW')
+    assert sorted(entry['dataflow_name'] for entry in index_cache.entries().values()) == ['DF_BUSY', 'DF_NEW']
@@ -0,0 +1,42 @@
+import difflib
+import random
+
+from data_prep_for_indenxing import code_meta_statement, dimension_meta_statement
+from lookup_index import LookupIndex, TrigramIndex
+
+
+def test_the_templated_questions_are_answered_from_the_index(fake_dataflow):
+    index = LookupIndex(fake_dataflow())
+    france = code_meta_statement('REF_AREA', 'FRA', 'Country FRA (1.0)')
+
+    assert index.answer("What is the English name of the code 'FRA' within the code list ID 'REF_AREA'?") == france
+    assert index.answer("What does 'FRA' mean?") == france
+    assert index.answer("What is the code for 'Female' within the code list ID 'SEX'?") == \
+           code_meta_statement('SEX', 'F', 'Female')
+    assert index.answer("What name corresponds to the column code: 'SEX'?") == dimension_meta_statement('SEX', 'Sex')
+    assert index.answer("What is the column code for 'reference AREA'?") == \
+           dimension_meta_statement('REF_AREA', 'Reference area')
+    assert index.answer('FRA') == france
+    assert index.stats() == {'hits': 6, 'misses': 0, 'hit_rate': 1.0}
+
+
+def test_a_misspelled_name_matches_only_if_it_is_close_to_a_single_name(fake_dataflow):
+    index = LookupIndex(fake_dataflow())
+    assert index.answer("What is the code for 'Countri FRA (1.0)'?") == code_meta_statement('REF_AREA', 'FRA', 'Country FRA (1.0)')
+    # Close to two countries
+    assert LookupIndex(fake_dataflow(countries=('FRA', 'FRB'))).answer("What is the code for 'Country FRX (1.0)'?") is None
+    # The other dimension of the code list does not have it
+    assert index.answer("What is the code for 'Female' within the code list ID 'REF_AREA'?") is None
+    # Not a lookup
+    assert index.answer('How did the share of women change since 2015?') is None
+
+
+def test_the_trigram_candidates_keep_every_close_match():
+    random.seed(0)
+    words = ['education', 'tertiary', 'upper', 'secondary', 'short', 'cycle', 'bachelor', 'master', 'doctoral', 'level']
+    keys = {' '.join(random.sample(words, 3)) + f' {i}' for i in range(2000)}
+    trigram_index = TrigramIndex(keys)
+    for key in random.sample(sorted(keys), 50):
+        term = key[:3] + key[4:]  # one character dropped
+        assert set(difflib.get_close_matches(term, keys, n=5, cutoff=0.92)) <= \
+               set(difflib.get_close_matches(term, trigram_index.candidates(term, 0.92), n=5, cutoff=0.92))
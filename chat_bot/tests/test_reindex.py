@@ -0,0 +1,45 @@
+import numpy as np
+
+import grounded_llm
+import reindex
+from bot_registry import BotRegistry
+from embeddings import get_embedding_function
+from reindex import reindex_dataflow
+from response_cache import SemanticCache
+
+
+def test_a_changed_dataflow_loses_its_cached_answers(parse_dataflow, sdmx_server, tmp_path, monkeypatch, codelists):
+    monkeypatch.chdir(tmp_path)
+    cache = SemanticCache(threshold=0.9)
+    monkeypatch.setattr(grounded_llm, 'semantic_cache', cache)
+    name = sdmx_server.dataflow_name(0)
+    embedding = np.ones(8, dtype=np.float32)
+    cache.store(name, embedding, 'The old answer', cost=1.0)
+    old_info, new_info = parse_dataflow(0, streaming=True), parse_dataflow(1, streaming=True)
+
+    # Unchanged documents: the answers are still valid
+    reindex_dataflow(name, old_info, old_info, embedding_function=get_embedding_function(backend='hashing'), backend='numpy')
+    assert cache.lookup(name, embedding) == ('The old answer', 1.0)
+
+    reindex_dataflow(name, new_info, old_info, embedding_function=get_embedding_function(backend='hashing'), backend='numpy')
+    assert cache.lookup(name, embedding) is None
+
+
+def test_a_changed_codelist_is_discarded_and_the_bot_of_the_previous_version_removed(monkeypatch, fake_dataflow, codelists):
+    old_info, new_info = fake_dataflow('1.0'), fake_dataflow('1.0', countries=('FRA', 'DEU', 'ITA'))
+    codelists.intern('urn:sdmx:org.sdmx.infomodel.codelist.Codelist=OECD:CL_AREA(1.0)', old_info.df_code_names['REF_AREA'].items())
+    codelists.intern('urn:sdmx:org.sdmx.infomodel.codelist.Codelist=OECD:CL_SEX(1.0)', old_info.df_code_names['SEX'].items())
+    monkeypatch.setattr(reindex, 'check_dataflow', lambda name, session, check_versions: {
+        'dataflow': 'OECD:DF_TEST(2.0)', 'previous_name': name, 'status': 'changed', 'new_info': new_info, 'old_info': old_info})
+    monkeypatch.setattr(reindex, 'reindex_dataflow', lambda *args, **kwargs: {'status': 'updated'})
+    monkeypatch.setattr(reindex, 'get_embedding_function', lambda: None)
+    registry = BotRegistry(bot_factory=lambda name: object())
+    registry.get_or_create('OECD:DF_TEST(1.0)')
+
+    report = reindex.refresh_catalogue(['OECD:DF_TEST(1.0)'], bot_registry=registry)
+
+    assert report['dataflows']['OECD:DF_TEST(1.0)']['diff']['codes_added'] == {'REF_AREA': ['ITA']}
+    # Only the codelist that gained a code is out of date
+    assert codelists.get('urn:sdmx:org.sdmx.infomodel.codelist.Codelist=OECD:CL_AREA(1.0)') is None
+    assert codelists.get('urn:sdmx:org.sdmx.infomodel.codelist.Codelist=OECD:CL_SEX(1.0)') is not None
+    assert len(registry) == 0
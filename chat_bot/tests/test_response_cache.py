@@ -0,0 +1,82 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+import response_cache
+from response_cache import ResponseCache, SemanticCache
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """The time seen by the caches, moved on by assigning `clock.now`."""
+    clock = SimpleNamespace(now=1000.0)
+    monkeypatch.setattr(response_cache, 'time', SimpleNamespace(time=lambda: clock.now))
+    return clock
+
+
+def test_the_least_recently_used_responses_are_evicted():
+    cache = ResponseCache(max_entries=2)
+    cache.put('model', 'persona', 'first', 'First answer', 0.1)
+    cache.put('model', 'persona', 'second', 'Second answer', 0.2)
+    # Reading the first response makes the second one the least recently used
+    assert cache.get('model', 'persona', 'first') == ('First answer', 0.1)
+    cache.put('model', 'persona', 'third', 'Third answer', 0.3)
+
+    assert cache.get('model', 'persona', 'second') is None
+    assert cache.get('model', 'persona', 'first') == ('First answer', 0.1)
+    assert cache.get('model', 'persona', 'third') == ('Third answer', 0.3)
+    assert cache.stats() == {'entries': 2, 'hits': 3, 'misses': 1}
+
+
+def test_the_model_persona_and_prompt_are_all_part_of_the_key():
+    cache = ResponseCache()
+    cache.put('model', 'persona', 'prompt', 'Answer', 0.1)
+    assert cache.get('other model', 'persona', 'prompt') is None
+    assert cache.get('model', 'other persona', 'prompt') is None
+    assert cache.get('model', 'persona', 'other prompt') is None
+
+
+def test_responses_expire_after_the_ttl_also_on_disk(tmp_path, clock):
+    path = str(tmp_path / 'llm_cache.sqlite')
+    cache = ResponseCache(ttl=60, path=path)
+    cache.put('model', 'persona', 'prompt', 'Answer', 0.1)
+
+    # Another worker (or a restart) reads the response from the file
+    assert ResponseCache(ttl=60, path=path).get('model', 'persona', 'prompt') == ('Answer', 0.1)
+
+    clock.now += 61
+    assert cache.get('model', 'persona', 'prompt') is None
+    assert ResponseCache(ttl=60, path=path).get('model', 'persona', 'prompt') is None
+
+
+def test_similar_questions_of_the_same_dataflow_share_an_answer():
+    cache = SemanticCache(threshold=0.95)
+    question = np.array([1.0, 0.0, 0.0])
+    cache.store('DF_A', question, 'The answer', 0.5)
+
+    # Cosine similarity of about 0.995, the norm does not matter
+    assert cache.lookup('DF_A', 3 * np.array([1.0, 0.1, 0.0])) == ('The answer', 0.5)
+    # Cosine similarity of about 0.7
+    assert cache.lookup('DF_A', np.array([1.0, 1.0, 0.0])) is None
+    assert cache.lookup('DF_B', question) is None
+    assert cache.stats() == {'entries': 1, 'hits': 1, 'misses': 2}
+
+
+def test_the_semantic_cache_is_bounded_per_dataflow_and_invalidated_per_dataflow(clock):
+    cache = SemanticCache(threshold=0.99, max_entries_per_namespace=2, ttl=60)
+    questions = np.eye(3)
+    for i, question in enumerate(questions):
+        cache.store('DF_A', question, f'Answer {i}', 0.1)
+    cache.store('DF_B', questions[0], 'Answer of B', 0.1)
+
+    assert cache.lookup('DF_A', questions[0]) is None
+    assert cache.lookup('DF_A', questions[2]) == ('Answer 2', 0.1)
+
+    cache.invalidate('DF_A')
+    assert cache.lookup('DF_A', questions[2]) is None
+    assert cache.lookup('DF_B', questions[0]) == ('Answer of B', 0.1)
+
+    clock.now += 61
+    assert cache.lookup('DF_B', questions[0]) is None
+    assert cache.stats()['entries'] == 0
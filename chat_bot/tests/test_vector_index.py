@@ -0,0 +1,73 @@
+import os
+
+import numpy as np
+
+from embeddings import get_embedding_function, chunk_by_token_budget, count_tokens
+from vector_index import IndexFiles, NumpyVectorIndex, create_vector_store
+from index_cache import IndexCache
+
+
+def documents(dataflow, count):
+    return [(f'What is code {i} of {dataflow}?', f'Code {i} of {dataflow} is the name {i}') for i in range(count)]
+
+
+def build(tmp_path, dataflow, count, index_cache, ingest=True, **kwargs):
+    return NumpyVectorIndex(  documents(dataflow, count)
+                            , dataflow_name=dataflow
+                            , embedding_function=get_embedding_function(backend='hashing')
+                            , path=str(tmp_path)
+                            , index_cache=index_cache
+                            , ingest=ingest
+                            , **kwargs)
+
+
+def test_documents_added_in_stages_are_searchable_and_saved_once(tmp_path):
+    index_cache = IndexCache(IndexFiles(str(tmp_path)), path=str(tmp_path))
+    # Small requests: every stage is embedded in several chunks
+    staged = build(tmp_path, 'DF_STAGED', 300, index_cache, ingest=False, max_tokens_per_request=200)
+    staged.add_data_to_collection(flat_info=staged.flat_info_for_embedding[:100])
+    assert staged.count() == 100
+    assert staged.query('What is code 42 of DF_STAGED?', n_results=1)['ids'][0][0] == staged.ids[42]
+
+    staged.add_data_to_collection()
+    staged.complete()
+    assert staged.count() == 300
+    whole = build(tmp_path / 'whole', 'DF_STAGED', 300, IndexCache(IndexFiles(str(tmp_path / 'whole')), path=str(tmp_path / 'whole')))
+    np.testing.assert_allclose(staged.matrix, whole.matrix, atol=1e-6)
+    assert staged.ids == whole.ids
+
+    reopened = build(tmp_path, 'DF_STAGED', 300, index_cache)
+    assert reopened.from_cache and reopened.ids == staged.ids
+
+
+def test_the_least_recently_used_index_files_are_deleted(tmp_path):
+    index_cache = IndexCache(IndexFiles(str(tmp_path)), path=str(tmp_path), max_collections=2)
+    first, second = build(tmp_path, 'DF_1', 10, index_cache), build(tmp_path, 'DF_2', 10, index_cache)
+    # Using the first index again makes the second one the least recently used
+    assert build(tmp_path, 'DF_1', 10, index_cache).from_cache
+    build(tmp_path, 'DF_3', 10, index_cache)
+
+    assert os.path.exists(first.matrix_path) and os.path.exists(first.ids_path)
+    assert not os.path.exists(second.matrix_path) and not os.path.exists(second.ids_path)
+    assert sorted(entry['dataflow_name'] for entry in index_cache.entries().values()) == ['DF_1', 'DF_3']
+
+
+def test_the_numpy_store_is_registered_with_the_given_index_cache(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    # A cache of its own over the default directory of the indexes, not the process-wide one
+    index_cache = IndexCache(IndexFiles('.vector_index'), path='.vector_index')
+    store = create_vector_store(  documents('DF_GIVEN', 10)
+                                , dataflow_name='DF_GIVEN'
+                                , index_cache=index_cache
+                                , embedding_function=get_embedding_function(backend='hashing')
+                                , backend='numpy')
+    assert store.index_cache is index_cache
+    assert index_cache.lookup('DF_GIVEN', store.content_hash) == store.collection_name
+
+
+def test_precomputed_documents_do_not_count_towards_the_token_budget():
+    texts = [question for question, _ in documents('DF_BUDGET', 40)]
+    budget = sum(count_tokens(text) for text in texts[:20])
+    assert len(chunk_by_token_budget(texts, max_tokens=budget)) == 2
+    precomputed = {text: [0.0] for text in texts[:20]}
+    assert chunk_by_token_budget(texts, max_tokens=budget, precomputed=precomputed) == [texts]
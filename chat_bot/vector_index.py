@@ -0,0 +1,322 @@
+"""
+Vector Index Module
+
+An in-process alternative to ChromaDB for the documents of a single dataflow, behind the same interface
+(`query(query_text, n_results)` returning Chroma-shaped result sets).
+
+A dataflow is a few thousand short documents: a contiguous matrix of normalized float32 embeddings and one
+matrix-vector product answer a query in well under a millisecond, without SQLite, collections or a server.
+
+Key Features:
+- Embeddings are normalized at build time, so the search is a dot product; top-k with `np.argpartition`
+- Distances are squared L2 distances of the normalized vectors (2 - 2 * cosine similarity), like Chroma's default,
+  so thresholds tuned on Chroma results keep their meaning
+- Batched search of several queries with one matrix product (`query_many`)
+- The matrix is saved as a `.npy` file and opened memory-mapped and read-only: the workers of a host
+  (e.g. gunicorn processes) share one copy through the page cache instead of holding one each
+- Files are content-addressed (dataflow name + hash of the documents and the embedding model), so an unchanged
+  dataflow is loaded from disk without embedding anything
+- The index files are registered with an IndexCache (see index_cache.py), like the Chroma collections: above
+  VECTOR_INDEX_MAX_INDEXES, the files of the least recently used indexes are deleted
+
+Usage:
+    ```python
+    index = NumpyVectorIndex(flat_info_for_embedding, dataflow_name='OECD.EDU.IMEP:DSD_EAG_IT@DF_EAG_IT_AGE(1.1)')
+    index.query('What are the columns in this table?', n_results=3)
+    index.query_many(['What is FRA?', 'What is ISCED11_2?'], n_results=3)
+
+    # The backend of the bots is selected with VECTOR_BACKEND=chroma (default) or VECTOR_BACKEND=numpy
+    vector_store = create_vector_store(flat_info_for_embedding, dataflow_name=..., index_cache=get_store_index_cache())
+    ```
+
+Configuration (environment variables):
+    VECTOR_BACKEND: 'chroma' (default) or 'numpy'
+    VECTOR_INDEX_PATH: directory of the NumPy index files (default: .vector_index)
+    VECTOR_INDEX_MAX_INDEXES: number of NumPy indexes kept on disk (default: 20)
+"""
+
+import asyncio
+import json
+import os
+import threading
+from types import SimpleNamespace
+
+import numpy as np
+
+from chromaDB import ChromaDBWrapper, document_id, get_index_cache
+from concurrent.futures import ThreadPoolExecutor
+
+from embeddings import (get_embedding_function, embed_with_backoff, embedding_model_name, chunk_by_token_budget,
+                        RateLimitBackoff, MAX_TOKENS_PER_REQUEST)
+from index_cache import IndexCache
+from metrics import METRICS
+
+VECTOR_BACKEND = os.getenv('VECTOR_BACKEND', 'chroma')
+VECTOR_INDEX_PATH = os.getenv('VECTOR_INDEX_PATH', '.vector_index')
+VECTOR_INDEX_MAX_INDEXES = int(os.getenv('VECTOR_INDEX_MAX_INDEXES', '20'))
+
+_index_caches = {}
+_lock = threading.Lock()
+
+
+class IndexFiles:
+    """The NumPy indexes saved in a directory, seen through the two methods of the ChromaDB client that IndexCache uses."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def list_collections(self):
+        try:
+            names = os.listdir(self.path)
+        except FileNotFoundError:
+            return []
+        return [SimpleNamespace(name=name[:-len('.npy')]) for name in names if name.endswith('.npy')]
+
+    def delete_collection(self, name):
+        for suffix in ('.npy', '.ids.json'):
+            try:
+                os.remove(os.path.join(self.path, name + suffix))
+            except FileNotFoundError:
+                pass
+
+
+def get_vector_index_cache(path=VECTOR_INDEX_PATH, max_indexes=VECTOR_INDEX_MAX_INDEXES):
+    """Return the (process-wide) index cache of the NumPy indexes saved at the given path."""
+    with _lock:
+        if path not in _index_caches:
+            _index_caches[path] = IndexCache(IndexFiles(path), path=path, max_collections=max_indexes)
+        return _index_caches[path]
+
+
+def get_store_index_cache(backend=None):
+    """Return the index cache of the vector stores of VECTOR_BACKEND (or `backend`)."""
+    return get_vector_index_cache() if (backend or VECTOR_BACKEND) == 'numpy' else get_index_cache()
+
+
+class NumpyVectorIndex:
+    """Exact nearest-neighbour search over a memory-mapped matrix of normalized embeddings."""
+
+    def __init__(  self
+                 , flat_info_for_embedding
+                 , openai_api_key=None
+                 , dataflow_name=None
+                 , precomputed_embeddings=None
+                 , embedding_function=None
+                 , workers=4
+                 , max_tokens_per_request=MAX_TOKENS_PER_REQUEST
+                 , path=VECTOR_INDEX_PATH
+                 , index_cache=None
+                 , ingest=True):
+        """
+        With `ingest=False` the index starts empty (unless it is on disk already): the caller adds the documents
+        (possibly in stages, with `add_data_to_collection(flat_info=...)`) and calls `complete()` to save it.
+        The saved index is registered with `index_cache` (default: the one of `path`).
+        """
+        self.flat_info_for_embedding = flat_info_for_embedding
+        self.embedding_function = embedding_function or get_embedding_function(openai_api_key)
+        self.precomputed_embeddings = precomputed_embeddings or {}
+        self.computed_embeddings = {}
+        self.workers = workers
+        self.max_tokens_per_request = max_tokens_per_request
+        self.path = path
+        self.index_cache = index_cache or get_vector_index_cache(path)
+        self.from_cache = False
+        self._lock = threading.Lock()
+
+        self.dataflow_name = dataflow_name or 'default'
+        self.content_hash = IndexCache.content_hash(flat_info_for_embedding, embedding_model_name(self.embedding_function))
+        self.collection_name = IndexCache.collection_name(self.dataflow_name, self.content_hash)
+
+        # The documents that are searchable, in the order of the rows of the matrix
+        self.matrix = np.zeros((0, 0), dtype=np.float32)
+        self.ids, self.documents, self.metadatas = [], [], []
+
+        if self._load():
+            self.from_cache = True
+            if self.index_cache.lookup(self.dataflow_name, self.content_hash) is None:
+                # Saved before it was registered (or by another process)
+                self.index_cache.register(self.dataflow_name, self.content_hash, self.collection_name)
+            print(f"Reusing the vector index {self.collection_name} ({len(self.ids)} documents)")
+        elif ingest:
+            self.add_data_to_collection()
+            self.complete()
+
+    @property
+    def matrix_path(self):
+        return os.path.join(self.path, f'{self.collection_name}.npy')
+
+    @property
+    def ids_path(self):
+        return os.path.join(self.path, f'{self.collection_name}.ids.json')
+
+    def count(self):
+        return len(self.ids)
+
+    def query(self, query_text, n_results=3):
+        return self.query_many([query_text], n_results=n_results)
+
+    def query_many(self, query_texts, n_results=3):
+        """Search several queries at once; the result sets have one list per query, like Chroma's."""
+        with METRICS.timer('retrieve'):
+            return self.search(self.embedding_function(list(query_texts)), n_results=n_results)
+
+    async def aquery(self, query_text, n_results=3):
+        # The embedding of the query is a network call with the OpenAI backend
+        return await asyncio.to_thread(self.query, query_text, n_results)
+
+    def search(self, query_embeddings, n_results=3):
+        """Return the `n_results` nearest documents of each of the query embeddings."""
+        # The documents may be being added by another thread: search the rows that are complete. The lists only grow,
+        # so the first rows of the matrix keep their documents
+        with self._lock:
+            matrix, ids, documents, metadatas = self.matrix, self.ids, self.documents, self.metadatas
+
+        queries = self._normalize(np.asarray(query_embeddings, dtype=np.float32).reshape(len(query_embeddings), -1))
+        n_results = min(n_results, matrix.shape[0])
+        if n_results == 0:
+            empty = [[] for _ in range(len(queries))]
+            return {'ids': empty, 'documents': empty, 'metadatas': empty, 'distances': empty}
+
+        similarities = queries @ matrix.T  # (queries, documents)
+        if n_results < similarities.shape[1]:
+            top = np.argpartition(-similarities, n_results - 1, axis=1)[:, :n_results]
+        else:
+            top = np.broadcast_to(np.arange(similarities.shape[1]), similarities.shape)
+        top_similarities = np.take_along_axis(similarities, top, axis=1)
+        order = np.argsort(-top_similarities, axis=1)
+        top = np.take_along_axis(top, order, axis=1)
+        distances = np.maximum(2.0 - 2.0 * np.take_along_axis(top_similarities, order, axis=1), 0.0)
+
+        return {
+            'ids': [[ids[i] for i in row] for row in top],
+            'documents': [[documents[i] for i in row] for row in top],
+            'metadatas': [[metadatas[i] for i in row] for row in top],
+            'distances': distances.tolist(),
+        }
+
+    def add_data_to_collection(self, progress_callback=None, flat_info=None):
+        """
+        Embed the documents (default: all of them) and make them searchable, a chunk at a time.
+        `progress_callback(done, total)` is called after every chunk.
+        """
+        rows = {}
+        for question, answer in (self.flat_info_for_embedding if flat_info is None else flat_info):
+            rows.setdefault(document_id(question, answer), (str(question), answer))
+        with self._lock:
+            present = set(self.ids)
+        todo = [id_ for id_ in rows if id_ not in present]
+
+        chunks = chunk_by_token_budget(  [rows[id_][0] for id_ in todo]
+                                       , max_tokens=self.max_tokens_per_request
+                                       , precomputed=self.precomputed_embeddings)
+        backoff = RateLimitBackoff()
+
+        def embed_chunk(documents):
+            missing = list(dict.fromkeys(document for document in documents if document not in self.precomputed_embeddings))
+            computed = {}
+            if missing:
+                with METRICS.timer('embed'):
+                    computed = dict(zip(missing, embed_with_backoff(missing, self.embedding_function, backoff)))
+            return computed, [computed[document] if document in computed else self.precomputed_embeddings[document]
+                              for document in documents]
+
+        # The rows are written into a matrix allocated once for all the chunks; the searchable matrix is a view of
+        # its rows written so far
+        buffer = None
+        done = 0
+        with ThreadPoolExecutor(max_workers=max(1, self.workers)) as executor:
+            # map returns the chunks in order, so the rows of the matrix stay in the order of the documents
+            for computed, embeddings in executor.map(embed_chunk, chunks):
+                chunk_ids = todo[done:done + len(embeddings)]
+                vectors = self._normalize(np.asarray(embeddings, dtype=np.float32))
+                with self._lock:
+                    self.computed_embeddings.update(computed)
+                    start = len(self.ids)
+                    if buffer is None:
+                        buffer = np.empty((start + len(todo), vectors.shape[1]), dtype=np.float32)
+                        if start:
+                            buffer[:start] = self.matrix
+                    buffer[start:start + len(chunk_ids)] = vectors
+                    self.ids.extend(chunk_ids)
+                    self.documents.extend(rows[id_][0] for id_ in chunk_ids)
+                    self.metadatas.extend({'answer': rows[id_][1]} for id_ in chunk_ids)
+                    self.matrix = buffer[:start + len(chunk_ids)]
+                done += len(chunk_ids)
+                if progress_callback is not None:
+                    progress_callback(done, len(todo))
+
+        print(f"{len(self.computed_embeddings)} embeddings created and {done} documents indexed in {self.collection_name}.")
+
+    def complete(self):
+        """Save the index, register it with the index cache and reopen it memory-mapped."""
+        if self.from_cache:
+            return
+        # Write to temporary files and rename, so that a concurrent reader never sees a half-written index
+        os.makedirs(self.path, exist_ok=True)
+        suffix = f'.{os.getpid()}.{threading.get_ident()}.tmp'
+        with self._lock:
+            matrix, ids = self.matrix, list(self.ids)
+        with open(self.matrix_path + suffix, 'wb') as f:
+            np.save(f, matrix)
+        with open(self.ids_path + suffix, 'w', encoding='utf-8') as f:
+            json.dump(ids, f)
+        os.replace(self.matrix_path + suffix, self.matrix_path)
+        os.replace(self.ids_path + suffix, self.ids_path)
+
+        with self._lock:
+            self.matrix = np.load(self.matrix_path, mmap_mode='r')
+        self.index_cache.register(self.dataflow_name, self.content_hash, self.collection_name)
+
+    @staticmethod
+    def _normalize(vectors):
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.where(norms == 0, 1.0, norms)
+
+    def _load(self):
+        """Open the saved matrix (memory-mapped, read-only). Returns False if this content has not been indexed yet."""
+        rows = {}
+        for question, answer in self.flat_info_for_embedding:
+            rows.setdefault(document_id(question, answer), (str(question), answer))
+        try:
+            with open(self.ids_path, encoding='utf-8') as f:
+                saved_ids = json.load(f)
+            matrix = np.load(self.matrix_path, mmap_mode='r')
+        except (FileNotFoundError, ValueError):
+            return False
+        if set(saved_ids) != set(rows) or matrix.shape[0] != len(saved_ids):
+            return False
+
+        self.matrix = matrix
+        self.ids = saved_ids
+        self.documents = [rows[id_][0] for id_ in saved_ids]
+        self.metadatas = [{'answer': rows[id_][1]} for id_ in saved_ids]
+        return True
+
+
+def create_vector_store(  flat_info_for_embedding
+                        , dataflow_name=None
+                        , index_cache=None
+                        , precomputed_embeddings=None
+                        , embedding_function=None
+                        , backend=None
+                        , ingest=True):
+    """
+    Return the vector store of a dataflow, with the backend of VECTOR_BACKEND (or `backend`).
+    `index_cache` must be one of that backend (see `get_store_index_cache`); the NumPy indexes always have one.
+    """
+    backend = backend or VECTOR_BACKEND
+    if backend == 'numpy':
+        return NumpyVectorIndex(  flat_info_for_embedding
+                                , dataflow_name=dataflow_name
+                                , index_cache=index_cache
+                                , precomputed_embeddings=precomputed_embeddings
+                                , embedding_function=embedding_function
+                                , ingest=ingest)
+    if backend != 'chroma':
+        raise ValueError(f'Unknown vector backend: {backend}')
+    return ChromaDBWrapper(  flat_info_for_embedding
+                           , dataflow_name=dataflow_name
+                           , index_cache=index_cache
+                           , precomputed_embeddings=precomputed_embeddings
+                           , embedding_function=embedding_function
+                           , ingest=ingest)